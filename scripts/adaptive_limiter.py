@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+"""
+自适应并发控制 (AIMD)
+
+延迟和错误率正常时加性增大在途请求窗口（每完成约一个窗口的请求 +1），
+遇到 429 / 5xx / 超时时乘性减小窗口，并遵守服务端的 retry-after。
+实时统计当前窗口和 p50/p95 延迟，用于找到后端可持续的最高吞吐。
+"""
+
+import asyncio
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Optional
+
+
+class OverloadError(Exception):
+    """后端过载（429 / 5xx / 超时），应减小并发窗口"""
+
+    def __init__(self, message: str, status: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """解析 retry-after 头（秒数；HTTP 日期格式按 HTTP 规范解析）"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    from email.utils import parsedate_to_datetime
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def is_overload_status(status: int) -> bool:
+    """429 和 5xx（含 Anthropic 的 529 overloaded）视为过载"""
+    return status == 429 or status >= 500
+
+
+def percentile(values, q: float) -> float:
+    """最近邻百分位数"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[idx]
+
+
+class _Slot:
+    """一次请求占用的并发名额，用于上报结果"""
+
+    def __init__(self):
+        self.overload: Optional[OverloadError] = None
+        self.failed = False
+
+    def record_overload(self, error: OverloadError):
+        self.overload = error
+
+    def record_error(self):
+        """非过载类错误（如解析失败）：不调整窗口"""
+        self.failed = True
+
+
+class AdaptiveLimiter:
+    """AIMD 并发限制器"""
+
+    def __init__(
+        self,
+        initial: int = 4,
+        min_limit: int = 1,
+        max_limit: int = 32,
+        decrease_factor: float = 0.5,
+        latency_tolerance: float = 2.0,
+        sample_size: int = 200,
+        name: str = "llm"
+    ):
+        self.name = name
+        self.limit = float(max(min_limit, min(initial, max_limit)))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease_factor = decrease_factor
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.successes = 0
+        self.overloads = 0
+        self.errors = 0
+        self.peak_limit = self.limit
+        self._latencies = deque(maxlen=sample_size)
+        self._min_latency: Optional[float] = None
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._cond = asyncio.Condition()
+
+    @property
+    def window(self) -> int:
+        return int(self.limit)
+
+    async def acquire(self):
+        """等待可用名额（遵守 retry-after 暂停）"""
+        async with self._cond:
+            while True:
+                wait = self._paused_until - time.monotonic()
+                if wait > 0:
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), timeout=wait)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if self.in_flight < self.window:
+                    self.in_flight += 1
+                    return
+                await self._cond.wait()
+
+    async def release(self, latency: float, slot: _Slot):
+        """归还名额并根据结果调整窗口"""
+        async with self._cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if slot.overload is not None:
+                self.overloads += 1
+                # 同一批在途请求一起失败时只减一次（冷却期约为一个 p50 延迟）
+                cooldown = percentile(self._latencies, 0.5) if self._latencies else 1.0
+                if now - self._last_decrease >= cooldown:
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    self._last_decrease = now
+                if slot.overload.retry_after:
+                    self._paused_until = max(self._paused_until, now + slot.overload.retry_after)
+            elif slot.failed:
+                self.errors += 1
+            else:
+                self.successes += 1
+                self._latencies.append(latency)
+                if self._min_latency is None or latency < self._min_latency:
+                    self._min_latency = latency
+                # 延迟没有明显劣化时加性增大：每完成约一个窗口的请求 +1
+                healthy = percentile(self._latencies, 0.5) <= self._min_latency * self.latency_tolerance
+                if healthy and self.in_flight + 1 >= self.window:
+                    self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+                    self.peak_limit = max(self.peak_limit, self.limit)
+            self._cond.notify_all()
+
+    @asynccontextmanager
+    async def slot(self):
+        """占用一个名额执行一次请求
+
+        用法：
+            async with limiter.slot() as slot:
+                ...
+                slot.record_overload(OverloadError(...))
+        块内抛出 OverloadError 时自动记为过载并继续向外抛出。
+        """
+        await self.acquire()
+        slot = _Slot()
+        start = time.monotonic()
+        try:
+            yield slot
+        except OverloadError as e:
+            slot.record_overload(e)
+            raise
+        except BaseException:
+            slot.record_error()
+            raise
+        finally:
+            await self.release(time.monotonic() - start, slot)
+
+    def stats(self) -> dict:
+        return {
+            "window": self.window,
+            "peak_window": int(self.peak_limit),
+            "in_flight": self.in_flight,
+            "p50": percentile(self._latencies, 0.5),
+            "p95": percentile(self._latencies, 0.95),
+            "successes": self.successes,
+            "overloads": self.overloads,
+            "errors": self.errors,
+        }
+
+    def summary(self) -> str:
+        s = self.stats()
+        return (
+            f"Limiter [{self.name}]: window={s['window']} (peak {s['peak_window']}), "
+            f"p50={s['p50']:.2f}s p95={s['p95']:.2f}s, "
+            f"{s['successes']} ok, {s['overloads']} overloaded, {s['errors']} errors"
+        )
+
+
+def add_limiter_args(parser, initial: Optional[int], max_limit: Optional[int]):
+    """为脚本添加并发控制参数"""
+    parser.add_argument("--concurrency", "-c", type=int, default=initial,
+                        help="初始在途请求窗口，之后按 AIMD 自适应调整")
+    parser.add_argument("--max-concurrency", type=int, default=max_limit,
+                        help="在途请求窗口上限（同时也是 worker 数）")
+
+
+def open_limiter(args, name: str) -> AdaptiveLimiter:
+    """根据命令行参数创建限制器"""
+    max_limit = max(args.max_concurrency, args.concurrency)
+    return AdaptiveLimiter(initial=args.concurrency, max_limit=max_limit, name=name)
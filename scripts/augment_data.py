@@ -5,19 +5,29 @@
 为每条训练数据生成 2-3 个描述变体，扩展数据集规模
 """
 
-import json
 import os
 import asyncio
+from contextlib import AsyncExitStack
 from pathlib import Path
-from typing import Optional
-import anthropic
-from tqdm.asyncio import tqdm_asyncio
+
+from batch_jobs import BatchRunner, add_batch_args, batch_state_path
+from checkpoint import JsonlCheckpoint, iter_jsonl, journal_path, load_records
+from dead_letter import DeadLetterQueue, add_dead_letter_args, dead_letter_path, retry_pass
+from dedup import DedupReport, NearDuplicateIndex, add_dedup_args, shingles
+from llm_client import LLMClient, add_client_args, open_client
+from packing import Packer, add_pack_args, run_packed
+from pipeline import run_pipeline
+from rule_augment import add_rule_args, rule_variants
+from shards import add_shard_args, shard_output_path, write_manifest
+from token_budget import add_budget_args, dry_run
 
 # 配置
 BASE_DIR = Path(__file__).parent.parent
 INPUT_PATH = BASE_DIR / "data/processed/raw_training_data.json"
 OUTPUT_PATH = BASE_DIR / "data/processed/augmented_training_data.json"
 
+MODEL = "claude-sonnet-4-20250514"
+
 # 系统提示词
 SYSTEM_PROMPT = """你是一个专业的文本改写专家。你的任务是为给定的图像描述生成不同风格的变体。
 
@@ -33,119 +43,285 @@ USER_PROMPT_TEMPLATE = """原始描述：{description}
 
 请生成 2 个不同风格的变体描述。每行一个，不要编号或其他标记。"""
 
+# 打包模式的用户消息开头，后接编号的原始描述
+PACKED_HEADER = "为以下 {count} 条原始描述分别生成 2 个不同风格的变体描述："
+PACKED_EXAMPLE = '{"1": ["变体一", "变体二"], "2": ["变体一", "变体二"]}'
+
+
+MAX_TOKENS = 200
+
+
+def parse_variants(text: str | None) -> list[str]:
+    """解析输出，每行一个变体"""
+    if not text:
+        return []
+    lines = text.split('\n')
+    variants = [line.strip() for line in lines if line.strip()]
+    return variants[:2]  # 最多取 2 个
+
+
+def valid_variants(value) -> list[str] | None:
+    """校验打包结果中的一个槽位：1-2 个单行字符串"""
+    if not isinstance(value, list):
+        return None
+    variants = [v.strip() for v in value if isinstance(v, str) and v.strip() and "\n" not in v]
+    return variants[:2] or None
+
 
 async def generate_variants(
-    client: anthropic.AsyncAnthropic,
-    description: str,
-    semaphore: asyncio.Semaphore,
-    max_retries: int = 3
+    client: LLMClient,
+    description: str
 ) -> list[str]:
     """生成描述变体"""
-    async with semaphore:
-        for attempt in range(max_retries):
-            try:
-                message = await client.messages.create(
-                    model="claude-sonnet-4-20250514",
-                    max_tokens=200,
-                    system=SYSTEM_PROMPT,
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": USER_PROMPT_TEMPLATE.format(description=description)
-                        }
-                    ]
-                )
-                # 解析输出
-                lines = message.content[0].text.strip().split('\n')
-                variants = [line.strip() for line in lines if line.strip()]
-                return variants[:2]  # 最多取 2 个
-            except Exception as e:
-                if attempt == max_retries - 1:
-                    print(f"Error: {e}")
-                    return []
-                await asyncio.sleep(2 ** attempt)
-    return []
+    text = await client.complete(
+        SYSTEM_PROMPT,
+        USER_PROMPT_TEMPLATE.format(description=description),
+        max_tokens=MAX_TOKENS
+    )
+    return parse_variants(text)
 
 
 async def main():
-    # 检查 API Key
+    import argparse
+    parser = argparse.ArgumentParser(description="为训练数据生成描述变体")
+    add_client_args(parser, "anthropic")
+    parser.add_argument("--engine", choices=["llm", "rules", "hybrid"], default="llm",
+                        help="变体来源：llm 调用模型；rules 只用本地规则（无需 API Key）；"
+                             "hybrid 先用规则，变体不足 2 个的再交给模型")
+    add_rule_args(parser)
+    parser.add_argument("--no-compact", action="store_true",
+                        help="结束时不把 JSONL 日志压缩成 JSON（下游直接读日志）")
+    add_batch_args(parser)
+    add_budget_args(parser)
+    add_dedup_args(parser, threshold=0.8, ngram=3)
+    add_shard_args(parser)
+    add_dead_letter_args(parser)
+    add_pack_args(parser)
+    args = parser.parse_args()
+    # 分片运行时使用独立的输出、日志和批任务状态文件
+    output_path = shard_output_path(OUTPUT_PATH, args.shard)
+
+    # 检查 API Key（只读回放和 dry-run 不发请求，无需 Key）
     api_key = os.environ.get("ANTHROPIC_API_KEY")
-    if not api_key:
+    if not api_key and args.cache_mode != "replay" and not args.dry_run and args.engine != "rules":
         print("Error: ANTHROPIC_API_KEY environment variable not set")
         return
     
-    # 读取原始训练数据
-    if not INPUT_PATH.exists():
+    # 读取原始训练数据（上游可能只输出了 JSONL 日志）
+    if not INPUT_PATH.exists() and not journal_path(INPUT_PATH).exists():
         print(f"Error: Input file not found: {INPUT_PATH}")
         print("Please run generate_training_data.py first")
         return
     
-    with open(INPUT_PATH, 'r', encoding='utf-8') as f:
-        raw_data = json.load(f)
+    raw_data = load_records(INPUT_PATH)
     
     print(f"Loaded {len(raw_data)} training samples")
     
-    # 检查已有增强数据
-    existing_data = []
-    processed_indices = set()
-    if OUTPUT_PATH.exists():
-        with open(OUTPUT_PATH, 'r', encoding='utf-8') as f:
-            existing_data = json.load(f)
-            processed_indices = {item.get('original_index') for item in existing_data if 'original_index' in item}
-        print(f"Found {len(existing_data)} already augmented items")
+    # 资源在创建时登记，提前返回或出错时都会关闭
+    async with AsyncExitStack() as stack:
+        # 检查已有增强数据（一次流式扫描断点日志）
+        checkpoint = JsonlCheckpoint(journal_path(output_path))
+        stack.callback(checkpoint.close)
+        processed_indices = checkpoint.resume(legacy_json=output_path)
+        if checkpoint.count:
+            print(f"Found {checkpoint.count} already augmented items")
     
-    # 初始化客户端
-    client = anthropic.AsyncAnthropic(api_key=api_key)
-    semaphore = asyncio.Semaphore(5)
+        # 初始化客户端（含响应缓存、限速和自适应并发控制）
+        client = open_client(args, "anthropic", MODEL)
+        stack.push_async_callback(client.close)
     
-    # 处理数据
-    all_results = existing_data.copy()
+        # 只保留本分片负责的数据
+        if args.shard:
+            raw_data = [item for item in raw_data if args.shard.owns(item['original_index'])]
+            print(f"Shard {args.shard}: {len(raw_data)} items")
+            write_manifest(output_path, args.shard, (item['original_index'] for item in raw_data))
     
-    for item in tqdm_asyncio(raw_data, desc="Augmenting"):
-        orig_idx = item.get('original_index')
-        
-        # 跳过已处理的
-        if orig_idx in processed_indices:
-            continue
-        
-        # 原始数据
-        all_results.append({
-            "simple_description": item['simple_description'],
-            "prompt": item['prompt'],
-            "prompt_type": item['prompt_type'],
-            "original_index": orig_idx,
-            "is_augmented": False
-        })
-        
-        # 生成变体
-        variants = await generate_variants(
-            client,
-            item['simple_description'],
-            semaphore
+        # 跳过已处理的（生成失败的数据原始记录已写入，变体在死信队列中等待重试）
+        dead_letters = DeadLetterQueue(dead_letter_path(output_path), "augment")
+        stack.callback(dead_letters.close)
+        if len(dead_letters):
+            print(f"Found {len(dead_letters)} dead-lettered items")
+        pending_items = [item for item in raw_data if item.get('original_index') not in processed_indices]
+        if args.retry_only:
+            pending_items = []
+        print(f"Remaining to augment: {len(pending_items)} items")
+    
+        # 规则增强：先在本地生成，hybrid 模式下变体不足的条目继续交给 LLM
+        rule_items = []
+        if args.engine != "llm" and pending_items:
+            results = rule_variants(
+                [item['simple_description'] for item in pending_items], 2, args.rule_seed, args.synonym_rate
+            )
+            for item, variants in zip(pending_items, results):
+                if not args.no_dedup:
+                    # 只改了一两个字的变体写入时会被去重丢掉，这里提前按与原文的相似度过滤
+                    grams = shingles(item['simple_description'], args.dedup_ngram)
+                    variants = [
+                        v for v in variants
+                        if len(grams & (g := shingles(v, args.dedup_ngram))) / len(grams | g) < args.dedup_threshold
+                    ]
+                if args.engine == "rules" or len(variants) >= 2:
+                    rule_items.append((item, variants))
+            ruled = {item['original_index'] for item, _ in rule_items}
+            pending_items = [item for item in pending_items if item['original_index'] not in ruled]
+            print(f"Rule engine: {len(rule_items)} items augmented locally, "
+                  f"{len(pending_items)} left for the LLM")
+            if args.engine == "rules":
+                # rules 模式不回退 LLM，变体不足的条目只能少写变体
+                none = sum(1 for _, variants in rule_items if not variants)
+                one = sum(1 for _, variants in rule_items if len(variants) == 1)
+                if none or one:
+                    print(f"Warning: {none} items got no rule variants and {one} got only one "
+                          f"({2 * none + one} variants short; --engine hybrid fills them with the LLM)")
+    
+        if args.pack and args.batch:
+            print("Error: --pack cannot be combined with --batch")
+            return
+        packer = Packer(
+            client, SYSTEM_PROMPT, PACKED_HEADER, "包含 2 个变体字符串的数组", PACKED_EXAMPLE,
+            MAX_TOKENS, valid_variants, token_budget=args.pack_tokens, max_items=args.pack_max
         )
-        
-        for variant in variants:
-            all_results.append({
-                "simple_description": variant,
+        items_by_index = {item['original_index']: item for item in pending_items}
+        pack_slots = [(item['original_index'], item['simple_description']) for item in pending_items]
+    
+        if args.dry_run:
+            if args.pack:
+                requests = packer.requests_for(packer.plan(pack_slots))
+            else:
+                requests = (
+                    (SYSTEM_PROMPT, USER_PROMPT_TEMPLATE.format(description=item['simple_description']),
+                     MAX_TOKENS, None)
+                    for item in pending_items
+                )
+            print(dry_run(client, requests, args.rpm, args.tpm, batch=args.batch))
+            return
+    
+        # 近似重复索引：先放入全部原始描述和已写入的变体，新变体与其中任何一条重复即丢弃
+        index = NearDuplicateIndex(args.dedup_threshold, args.dedup_ngram)
+        report = DedupReport("variants", args.dedup_threshold, args.dedup_ngram)
+        if not args.no_dedup:
+            for item in raw_data:
+                index.add(str(item.get('original_index')), item['simple_description'])
+            for n, record in enumerate(iter_jsonl(checkpoint.path)):
+                if record.get('is_augmented'):
+                    index.add(f"{record.get('original_index')}/{n}", record['simple_description'])
+    
+        def unique_variants(orig_idx, variants: list[str]) -> list[str]:
+            if args.no_dedup:
+                return variants
+            kept = []
+            for n, variant in enumerate(variants):
+                key = f"{orig_idx}/v{n}"
+                report.checked += 1
+                match = index.add_if_new(key, variant)
+                if match is None:
+                    kept.append(variant)
+                else:
+                    report.record(key, match[0], match[1], variant)
+            return kept
+    
+        def variant_records(item: dict, variants: list[str] | None) -> list[dict]:
+            orig_idx = item.get('original_index')
+            return [
+                {
+                    "simple_description": variant,
+                    "prompt": item['prompt'],
+                    "prompt_type": item['prompt_type'],
+                    "original_index": orig_idx,
+                    "is_augmented": True
+                }
+                for variant in unique_variants(orig_idx, variants or [])
+            ]
+    
+        def sink(item: dict, variants: list[str] | None):
+            # 原始数据
+            records = [{
+                "simple_description": item['simple_description'],
                 "prompt": item['prompt'],
                 "prompt_type": item['prompt_type'],
-                "original_index": orig_idx,
-                "is_augmented": True
-            })
+                "original_index": item.get('original_index'),
+                "is_augmented": False
+            }]
+            records.extend(variant_records(item, variants))
         
-        processed_indices.add(orig_idx)
+            # 原始记录和变体一次写入，保证同一条数据不被拆开
+            checkpoint.append_many(records)
+            processed_indices.add(item.get('original_index'))
+    
+        def retry_sink(item: dict, variants: list[str] | None):
+            # 原始记录在主流程中已写入，这里只补写变体
+            checkpoint.append_many(variant_records(item, variants))
+    
+        # 生成失败的数据仍保留原始记录，同时进入死信队列，之后单独重试
+        reason = "no variants after retries"
+    
+        def key_of(item: dict) -> int:
+            return item.get('original_index')
+    
+        track_sink = dead_letters.wrap(sink, reason, key_of)
+    
+        for item, variants in rule_items:
+            sink(item, variants)
+    
+        async def work(item: dict) -> list[str]:
+            return await generate_variants(
+                client,
+                item['simple_description']
+            )
+    
+        if args.batch and pending_items:
+            # 批处理模式：打包提交，轮询结束后合并结果
+            runner = BatchRunner(
+                client, batch_state_path(output_path), args.batch_size, args.poll_interval
+            )
+            items_by_id = {f"row-{item['original_index']}": item for item in pending_items}
+            requests = {
+                custom_id: (
+                    SYSTEM_PROMPT,
+                    USER_PROMPT_TEMPLATE.format(description=item['simple_description']),
+                    MAX_TOKENS
+                )
+                for custom_id, item in items_by_id.items()
+            }
+            async for custom_id, text in runner.run(requests):
+                track_sink(items_by_id[custom_id], parse_variants(text))
+            print(runner.summary())
+        else:
+            if args.pack and pending_items:
+                # 打包模式：校验失败的槽位拆出来按单条请求重新排队
+                requeue = await run_packed(
+                    packer, pack_slots, lambda idx, variants: sink(items_by_index[idx], variants),
+                    client.limiter.max_limit, desc="Augmenting (packed)"
+                )
+                pending_items = [items_by_index[idx] for idx in requeue]
         
-        # 每 50 条保存一次
-        if len(processed_indices) % 50 == 0:
-            with open(OUTPUT_PATH, 'w', encoding='utf-8') as f:
-                json.dump(all_results, f, ensure_ascii=False, indent=2)
+            if pending_items:
+                # 并发生成变体，结果按输入顺序写入
+                stats = await run_pipeline(
+                    pending_items, work, track_sink, client.limiter.max_limit, desc="Augmenting"
+                )
+                print(f"Throughput: {stats['items_per_sec']:.2f} items/s "
+                      f"({stats['succeeded']} with variants, {stats['failed']} without)")
     
-    # 最终保存
-    with open(OUTPUT_PATH, 'w', encoding='utf-8') as f:
-        json.dump(all_results, f, ensure_ascii=False, indent=2)
+        # 主流程结束后低并发重试死信队列
+        if len(dead_letters) and not args.no_retry_pass and args.engine != "rules":
+            retry_items = [item for item in raw_data if key_of(item) in dead_letters]
+            await retry_pass(
+                dead_letters, retry_items, work, retry_sink, client,
+                args.retry_concurrency, args.retry_attempts, reason, key_of
+            )
     
-    print(f"\nDone! Total {len(all_results)} training samples (including augmented)")
-    print(f"Output saved to: {OUTPUT_PATH}")
+        print(dead_letters.summary())
+        if not args.no_dedup:
+            report.save()
+            print(report.summary())
+        print(f"\nDone! Total {checkpoint.count} training samples (including augmented)")
+        if args.no_compact:
+            print(f"Output saved to: {checkpoint.path}")
+        else:
+            checkpoint.compact(output_path)
+            print(f"Output saved to: {output_path}")
+        print(client.summary())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Anthropic Message Batches 批处理模式
+
+把所有待处理的 messages.create 请求打包成批任务提交，轮询完成后下载结果，
+结果同时写入响应缓存，交由调用方合并进断点日志。
+已提交的批任务记录在状态文件中，中断后重新运行会继续轮询而不是重复提交；
+失败/过期的条目产出 None，调用方没有写入日志的条目下次运行会重新提交。
+每条结果记入遥测（mode=batch），延迟为从提交到下载结果的周转时间。
+"""
+
+import asyncio
+import json
+import time
+from pathlib import Path
+from typing import AsyncIterator, Optional
+
+from checkpoint import atomic_write_json
+from llm_client import AnthropicClient
+
+# 单个批任务的请求数上限（API 上限为 100,000 条 / 256 MB）
+DEFAULT_BATCH_SIZE = 10000
+DEFAULT_POLL_INTERVAL = 30.0
+
+
+def batch_state_path(output_path: Path) -> Path:
+    """批任务状态文件路径"""
+    return Path(output_path).with_suffix(".batches.json")
+
+
+class BatchRunner:
+    """提交、轮询、下载 Message Batches，并支持断点续传"""
+
+    def __init__(
+        self,
+        client: AnthropicClient,
+        state_path: Path,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        poll_interval: float = DEFAULT_POLL_INTERVAL
+    ):
+        self.client = client
+        self.state_path = Path(state_path)
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.submitted = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.cached = 0
+        self.state = {"batches": []}
+        if self.state_path.exists():
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                self.state = json.load(f)
+
+    def _save_state(self):
+        atomic_write_json(self.state_path, self.state)
+
+    async def _submit(self, pending: dict[str, tuple[str, str, int]]):
+        """把未在途的请求按 batch_size 分块提交"""
+        in_flight = {
+            custom_id
+            for batch in self.state["batches"] if not batch["merged"]
+            for custom_id in batch["custom_ids"]
+        }
+        to_submit = [custom_id for custom_id in pending if custom_id not in in_flight]
+        for start in range(0, len(to_submit), self.batch_size):
+            chunk = to_submit[start:start + self.batch_size]
+            requests = []
+            for custom_id in chunk:
+                system, prompt, max_tokens = pending[custom_id]
+                requests.append({
+                    "custom_id": custom_id,
+                    "params": {
+                        "model": self.client.model,
+                        "max_tokens": max_tokens,
+                        "system": self.client.system_param(system),
+                        "messages": [{"role": "user", "content": prompt}],
+                    },
+                })
+            batch = await self.client.sdk.messages.batches.create(requests=requests)
+            self.state["batches"].append({
+                "id": batch.id,
+                "custom_ids": chunk,
+                "submitted_at": time.time(),
+                "merged": False,
+            })
+            self._save_state()
+            self.submitted += len(chunk)
+            print(f"Submitted batch {batch.id} with {len(chunk)} requests")
+
+    async def _wait(self, batch_id: str):
+        """轮询直到批任务结束"""
+        while True:
+            batch = await self.client.sdk.messages.batches.retrieve(batch_id)
+            counts = batch.request_counts
+            print(
+                f"Batch {batch_id}: {batch.processing_status} "
+                f"(processing={counts.processing}, succeeded={counts.succeeded}, "
+                f"errored={counts.errored}, expired={counts.expired}, canceled={counts.canceled})"
+            )
+            if batch.processing_status == "ended":
+                return
+            await asyncio.sleep(self.poll_interval)
+
+    async def run(
+        self,
+        requests: dict[str, tuple[str, str, int]]
+    ) -> AsyncIterator[tuple[str, Optional[str]]]:
+        """执行一组请求，逐条产出 (custom_id, text)，失败的条目 text 为 None
+
+        requests: custom_id -> (system, prompt, max_tokens)
+        """
+        cache = self.client.cache
+        pending = {}
+        for custom_id, (system, prompt, max_tokens) in requests.items():
+            text = cache.get(self.client.cache_key(system, prompt, max_tokens))
+            if text is not None:
+                self.cached += 1
+                yield custom_id, text
+            else:
+                pending[custom_id] = (system, prompt, max_tokens)
+
+        if cache.mode == "replay":
+            for custom_id in pending:
+                yield custom_id, None
+            return
+
+        await self._submit(pending)
+
+        for batch in self.state["batches"]:
+            if batch["merged"]:
+                continue
+            await self._wait(batch["id"])
+            results = await self.client.sdk.messages.batches.results(batch["id"])
+            submitted_at = batch.get("submitted_at", time.time())
+            async for entry in results:
+                custom_id = entry.custom_id
+                # 不在本次请求中的条目已在之前的运行里合并过
+                if custom_id not in pending:
+                    continue
+                if entry.result.type == "succeeded":
+                    message = entry.result.message
+                    text = message.content[0].text.strip()
+                    system, prompt, max_tokens = pending[custom_id]
+                    cache.put(self.client.cache_key(system, prompt, max_tokens), "anthropic", self.client.model, text)
+                    self.client.input_tokens += message.usage.input_tokens
+                    self.client.output_tokens += message.usage.output_tokens
+                    cache_read = message.usage.cache_read_input_tokens or 0
+                    cache_write = message.usage.cache_creation_input_tokens or 0
+                    self.client.cache_read_tokens += cache_read
+                    self.client.cache_write_tokens += cache_write
+                    self.client.telemetry.record(
+                        "anthropic", self.client.model, "ok", submitted_at,
+                        latency=time.time() - submitted_at,
+                        input_tokens=message.usage.input_tokens,
+                        output_tokens=message.usage.output_tokens,
+                        cache_read_tokens=cache_read,
+                        cache_write_tokens=cache_write,
+                        mode="batch"
+                    )
+                    self.succeeded += 1
+                    yield custom_id, text
+                else:
+                    self.client.telemetry.record(
+                        "anthropic", self.client.model, "failed", submitted_at,
+                        latency=time.time() - submitted_at,
+                        mode="batch",
+                        error=entry.result.type
+                    )
+                    self.failed += 1
+                    yield custom_id, None
+            batch["merged"] = True
+            self._save_state()
+
+        # 全部合并完成后清理状态文件
+        if all(batch["merged"] for batch in self.state["batches"]):
+            self.state_path.unlink(missing_ok=True)
+
+    def summary(self) -> str:
+        return (
+            f"Batches: {self.submitted} submitted, {self.succeeded} succeeded, "
+            f"{self.failed} failed, {self.cached} from cache"
+        )
+
+
+def add_batch_args(parser):
+    """为脚本添加批处理模式参数"""
+    parser.add_argument("--batch", action="store_true",
+                        help="使用 Message Batches 批处理模式（延迟高、成本低、吞吐高）")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="单个批任务的请求数")
+    parser.add_argument("--poll-interval", type=float, default=DEFAULT_POLL_INTERVAL,
+                        help="批任务轮询间隔（秒）")
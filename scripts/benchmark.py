@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+数据生成管线吞吐基准
+
+启动本地模拟服务（mock_llm_server.py），用三个生成脚本各自的调用函数
+（经过同一套客户端、限速、自适应并发和流水线）在多个并发级别下跑一遍，
+报告吞吐 (items/s)、p50/p95 单次请求延迟和重试放大倍数（实际请求数 / 条目数）。
+不读写缓存和断点日志，不影响 data/ 下的任何文件。
+
+用法：
+    python benchmark.py                                         # 三个脚本 × 并发 1/4/16/32
+    python benchmark.py --scripts generate augment --levels 8 32 --items 100
+    python benchmark.py --latency 1.0 --capacity 12 --error-rate 0.05 --output bench.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+from pathlib import Path
+
+import aiohttp
+
+import augment_data
+import generate_training_data
+import generate_training_data_ollama
+from corpus import load_corpus
+from llm_client import add_client_args, open_client
+from mock_llm_server import add_server_args, fake_description, server_argv
+from pipeline import run_pipeline
+
+SCRIPT_DIR = Path(__file__).parent
+
+# 基准场景：后端、模型
+SCENARIOS = {
+    "generate": ("anthropic", generate_training_data.MODEL),
+    "generate_ollama": ("ollama", generate_training_data_ollama.MODEL),
+    "augment": ("anthropic", augment_data.MODEL),
+}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_ready(url: str, timeout: float = 10.0):
+    """等待模拟服务可用"""
+    deadline = asyncio.get_running_loop().time() + timeout
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.get(f"{url}/api/tags") as resp:
+                    if resp.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            if asyncio.get_running_loop().time() > deadline:
+                raise RuntimeError(f"Mock server at {url} did not start")
+            await asyncio.sleep(0.1)
+
+
+async def server_stats(url: str) -> dict:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{url}/_stats") as resp:
+            return await resp.json()
+
+
+def make_work(scenario: str, client, stream: bool):
+    """各脚本对单条数据的处理函数"""
+    if scenario == "generate":
+        return lambda item: generate_training_data.generate_description(client, *item)
+    if scenario == "generate_ollama":
+        return lambda item: generate_training_data_ollama.generate_description(
+            client, *item, stream=stream
+        )
+    return lambda item: augment_data.generate_variants(client, fake_description(item[0]))
+
+
+async def run_level(scenario: str, level: int, items: list, url: str, args) -> dict:
+    """在一个并发级别下跑一个场景"""
+    backend, model = SCENARIOS[scenario]
+    parser = argparse.ArgumentParser()
+    add_client_args(parser, backend)
+    argv = [
+        "--concurrency", str(level), "--max-concurrency", str(level),
+        "--cache-mode", "off", "--no-telemetry", "--timeout", str(args.timeout),
+        "--max-retries", str(args.max_retries),
+    ]
+    if backend == "ollama":
+        argv += ["--ollama-host", url]
+    client = open_client(parser.parse_args(argv), backend, model)
+    if backend == "ollama":
+        await client.health_check()
+
+    before = await server_stats(url)
+    stats = await run_pipeline(
+        items, make_work(scenario, client, not args.no_stream), lambda item, result: None,
+        level, desc=f"{scenario} c={level}"
+    )
+    after = await server_stats(url)
+    limiter = client.limiter.stats()
+    await client.close()
+    return {
+        "scenario": scenario,
+        "concurrency": level,
+        "items": stats["completed"],
+        "failed": stats["failed"],
+        "items_per_sec": stats["items_per_sec"],
+        "p50": limiter["p50"],
+        "p95": limiter["p95"],
+        "requests": client.requests,
+        "retry_amplification": client.requests / max(1, stats["completed"]),
+        "final_window": limiter["window"],
+        "server_rejected": after["rejected"] - before["rejected"],
+    }
+
+
+def format_table(results: list[dict]) -> str:
+    lines = [
+        f"{'scenario':<16} {'conc':>5} {'items/s':>9} {'p50(s)':>8} {'p95(s)':>8} "
+        f"{'retry x':>8} {'failed':>7} {'window':>7} {'rejected':>9}",
+        "-" * 86,
+    ]
+    for r in results:
+        lines.append(
+            f"{r['scenario']:<16} {r['concurrency']:>5} {r['items_per_sec']:>9.2f} "
+            f"{r['p50']:>8.2f} {r['p95']:>8.2f} {r['retry_amplification']:>8.2f} "
+            f"{r['failed']:>7} {r['final_window']:>7} {r['server_rejected']:>9}"
+        )
+    return "\n".join(lines)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="数据生成管线吞吐基准（本地模拟服务）")
+    parser.add_argument("--scripts", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS),
+                        help="要测试的脚本")
+    parser.add_argument("--levels", nargs="+", type=int, default=[1, 4, 16, 32],
+                        help="并发级别")
+    parser.add_argument("--items", type=int, default=64, help="每个级别处理的条目数")
+    parser.add_argument("--timeout", type=float, default=10.0, help="单次请求超时（秒）")
+    parser.add_argument("--max-retries", type=int, default=3, help="每条数据最多尝试次数")
+    parser.add_argument("--no-stream", action="store_true", help="Ollama 场景关闭流式提前中止")
+    parser.add_argument("--url", default=None, help="使用已启动的模拟服务，不自动启动")
+    parser.add_argument("--output", type=Path, default=None, help="结果另存为 JSON")
+    add_server_args(parser)
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    items = [
+        (corpus.prompt(i % len(corpus)), corpus.prompt_type(i % len(corpus)))
+        for i in range(args.items)
+    ]
+
+    server = None
+    url = args.url
+    if url is None:
+        port = free_port()
+        url = f"http://127.0.0.1:{port}"
+        server = subprocess.Popen(
+            [sys.executable, str(SCRIPT_DIR / "mock_llm_server.py"), "--port", str(port)]
+            + server_argv(args)
+        )
+    os.environ["ANTHROPIC_API_KEY"] = "mock"
+    os.environ["ANTHROPIC_BASE_URL"] = url
+
+    results = []
+    try:
+        await wait_ready(url)
+        for scenario in args.scripts:
+            for level in args.levels:
+                results.append(await run_level(scenario, level, items, url, args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        corpus.close()
+
+    print()
+    print(format_table(results))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\nResults saved to: {args.output}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
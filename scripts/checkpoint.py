@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+追加式 JSONL 断点存储
+
+每完成一条数据追加一行 JSON 到日志文件（xxx.jsonl），按条数/时间批量 fsync；
+续跑时一次流式扫描重建已处理的 original_index，并截掉崩溃时写了一半的尾行。
+最终输出只在结束时压缩成 JSON 数组（临时文件 + rename 原子替换）。
+"""
+
+import json
+import os
+import time
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+
+def journal_path(json_path: Path) -> Path:
+    """JSON 输出文件对应的 JSONL 日志路径"""
+    return Path(json_path).with_suffix(".jsonl")
+
+
+def _fsync_dir(path: Path):
+    """rename 之后同步目录项（Windows 不支持，忽略）"""
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def atomic_write_json(path: Path, data, indent: int = 2):
+    """原子写 JSON：先写临时文件并 fsync，再 rename 覆盖"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=indent)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    _fsync_dir(path.parent)
+
+
+def iter_jsonl(path: Path) -> Iterator[dict]:
+    """流式读取 JSONL，跳过写了一半的尾行"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.endswith("\n"):
+                break
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                break
+
+
+def load_records(json_path: Path) -> list:
+    """读取某个阶段的输出：日志比 JSON 新（或 JSON 不存在）时读日志"""
+    json_path = Path(json_path)
+    jsonl = journal_path(json_path)
+    if jsonl.exists() and (
+        not json_path.exists() or jsonl.stat().st_mtime > json_path.stat().st_mtime
+    ):
+        return list(iter_jsonl(jsonl))
+    with open(json_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class JsonlCheckpoint:
+    """追加式断点日志"""
+
+    def __init__(
+        self,
+        path: Path,
+        key: str = "original_index",
+        fsync_every: int = 20,
+        fsync_interval: float = 5.0
+    ):
+        self.path = Path(path)
+        self.key = key
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.count = 0
+        self._file = None
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def resume(self, legacy_json: Optional[Path] = None) -> set:
+        """扫描日志，返回已处理的 key 集合
+
+        日志不存在但旧版 JSON 输出存在时，先把 JSON 迁移成日志。
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if not self.path.exists() and legacy_json is not None and Path(legacy_json).exists():
+            with open(legacy_json, "r", encoding="utf-8") as f:
+                legacy = json.load(f)
+            tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for record in legacy:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            print(f"Migrated {len(legacy)} records from {legacy_json} to {self.path}")
+
+        processed = set()
+        self.count = 0
+        good_offset = 0
+        if self.path.exists():
+            with open(self.path, "rb") as f:
+                for raw in f:
+                    if not raw.endswith(b"\n"):
+                        break
+                    try:
+                        record = json.loads(raw)
+                    except json.JSONDecodeError:
+                        break
+                    good_offset += len(raw)
+                    self.count += 1
+                    if self.key in record:
+                        processed.add(record[self.key])
+            # 截掉崩溃时写了一半的尾部
+            if good_offset != self.path.stat().st_size:
+                print(f"Warning: truncating torn tail of {self.path}")
+                with open(self.path, "r+b") as f:
+                    f.truncate(good_offset)
+
+        self._file = open(self.path, "a", encoding="utf-8")
+        return processed
+
+    def append(self, record: dict):
+        """追加一条记录"""
+        self.append_many([record])
+
+    def append_many(self, records: Iterable[dict]):
+        """一次写入同一条数据的多条记录（如原始描述 + 变体）"""
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        lines = [json.dumps(record, ensure_ascii=False) + "\n" for record in records]
+        self._file.write("".join(lines))
+        self.count += len(lines)
+        self._pending += 1
+        if (
+            self._pending >= self.fsync_every
+            or time.monotonic() - self._last_sync >= self.fsync_interval
+        ):
+            self.sync()
+
+    def sync(self):
+        """刷新缓冲并 fsync"""
+        if self._file is None or self._pending == 0:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def compact(self, output_path: Path):
+        """把日志流式压缩成 JSON 数组，原子替换 output_path"""
+        self.close()
+        output_path = Path(output_path)
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = output_path.with_name(f".{output_path.name}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("[")
+            first = True
+            if self.path.exists():
+                for record in iter_jsonl(self.path):
+                    body = json.dumps(record, ensure_ascii=False, indent=2)
+                    f.write(("\n  " if first else ",\n  ") + body.replace("\n", "\n  "))
+                    first = False
+            f.write("]" if first else "\n]")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, output_path)
+        _fsync_dir(output_path.parent)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+原始语料的列式缓存
+
+把 data/raw/NanoBananaProPrompts.xlsx 一次性转换成 Arrow IPC 文件，
+文件名取 XLSX 内容哈希，工作簿变化时自动重新转换。
+下游脚本通过内存映射读取，不再每次解析 Excel。
+
+列：
+- row_id:      过滤空提示词后的位置序号（即输出数据中的 original_index）
+- source_row:  在工作簿数据区中的原始行号
+- tweet_id:    原始推文 ID
+- prompt:      提示词原文
+- prompt_type: 提示词类型（缺失时为空字符串）
+
+用法：
+    python corpus.py            # 转换（已是最新时跳过）并显示信息
+"""
+
+import hashlib
+from pathlib import Path
+
+import pyarrow as pa
+
+# 配置
+BASE_DIR = Path(__file__).parent.parent
+RAW_DATA_PATH = BASE_DIR / "data/raw/NanoBananaProPrompts.xlsx"
+CORPUS_DIR = BASE_DIR / "data/cache/corpus"
+HEADER_ROW = 2  # 工作簿前两行是标题说明
+
+SCHEMA = pa.schema([
+    ("row_id", pa.int32()),
+    ("source_row", pa.int32()),
+    ("tweet_id", pa.int64()),
+    ("prompt", pa.large_string()),
+    ("prompt_type", pa.string()),
+])
+
+
+def file_hash(path: Path) -> str:
+    """文件内容的 sha256"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def corpus_path(xlsx_path: Path = RAW_DATA_PATH) -> Path:
+    """工作簿对应的 Arrow 文件路径（按内容哈希命名）"""
+    return CORPUS_DIR / f"{Path(xlsx_path).stem}-{file_hash(xlsx_path)[:16]}.arrow"
+
+
+def build_corpus(xlsx_path: Path, output_path: Path):
+    """解析工作簿并写入 Arrow 文件（先写临时文件再改名）"""
+    import pandas as pd
+
+    df = pd.read_excel(xlsx_path, header=HEADER_ROW)
+    df = df.dropna(subset=['prompt'])
+    table = pa.table(
+        {
+            "row_id": range(len(df)),
+            "source_row": df.index.astype("int32"),
+            "tweet_id": pd.to_numeric(df['tweetId'], errors="coerce").astype("Int64"),
+            "prompt": df['prompt'].astype(str),
+            "prompt_type": df['prompt_type'].fillna("").astype(str),
+        },
+        schema=SCHEMA,
+    )
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = output_path.with_suffix(".tmp")
+    with pa.OSFile(str(tmp_path), "wb") as sink:
+        with pa.ipc.new_file(sink, SCHEMA) as writer:
+            writer.write_table(table)
+    tmp_path.replace(output_path)
+    # 清理同一工作簿的旧版本
+    for stale in output_path.parent.glob(f"{Path(xlsx_path).stem}-*.arrow"):
+        if stale != output_path:
+            stale.unlink()
+
+
+class Corpus:
+    """内存映射的原始语料，按 row_id 访问"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self._source = pa.memory_map(str(self.path), "r")
+        self.table = pa.ipc.open_file(self._source).read_all()
+        self._prompts = self.table.column("prompt")
+        self._types = self.table.column("prompt_type")
+
+    def __len__(self) -> int:
+        return self.table.num_rows
+
+    def prompt(self, row_id: int) -> str:
+        return self._prompts[row_id].as_py()
+
+    def prompt_type(self, row_id: int) -> str:
+        return self._types[row_id].as_py()
+
+    def row(self, row_id: int) -> dict:
+        return {"prompt": self.prompt(row_id), "prompt_type": self.prompt_type(row_id)}
+
+    def close(self):
+        self._source.close()
+
+
+def load_corpus(xlsx_path: Path = RAW_DATA_PATH) -> Corpus:
+    """加载语料；工作簿有变化（或首次运行）时先转换"""
+    path = corpus_path(xlsx_path)
+    if not path.exists():
+        print(f"Converting {xlsx_path} -> {path}")
+        build_corpus(xlsx_path, path)
+    return Corpus(path)
+
+
+def main():
+    corpus = load_corpus()
+    print(f"Corpus: {corpus.path}")
+    print(f"Rows: {len(corpus)}")
+    types = corpus.table.column("prompt_type").value_counts().to_pylist()
+    for entry in sorted(types, key=lambda e: -e["counts"]):
+        print(f"  {entry['values'] or '(none)'}: {entry['counts']}")
+    corpus.close()
+
+
+if __name__ == "__main__":
+    main()
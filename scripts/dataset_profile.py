@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""
+训练数据的 token 长度分析与超长样本处理
+
+按训练时的聊天模板计算每条样本的 token 数，报告：
+- 按 prompt_type（json/text）分组的长度分布（提示词部分和完整样本）
+- 候选最大长度下的截断率和丢失的 token 比例
+- 各 batch size 下的填充浪费：固定填充到最大长度 / 随机组批动态填充 / 按长度分组动态填充
+- 推荐的最大长度：截断率不超过阈值的候选中，有效 token 占比最高的一个
+prepare_dataset.py 的 --length-policy 按同一口径处理超长样本（丢弃、单独成文件或标注长度分桶）。
+
+分词器：安装了 tokenizers 时使用训练模型的 Hugging Face 分词器，否则退回字符估算。
+聊天模板和数据读取来自 training/chat_format.py（与训练脚本共用），首次使用时按文件路径加载。
+
+用法：
+    python dataset_profile.py
+    python dataset_profile.py --max-lengths 512 1024 2048 --batch-sizes 2 8 --tokenizer Qwen/Qwen2.5-7B-Instruct
+"""
+
+import importlib.util
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterable, Optional
+
+import numpy as np
+
+from token_budget import HeuristicTokenizer, HFTokenizer
+
+# 配置
+BASE_DIR = Path(__file__).parent.parent
+CHAT_FORMAT_PATH = BASE_DIR / "training/chat_format.py"
+SPLIT_PATHS = {
+    "train": BASE_DIR / "data/processed/training_data.json",
+    "val": BASE_DIR / "data/processed/validation_data.json",
+}
+
+DEFAULT_TOKENIZER = "Qwen/Qwen2.5-1.5B-Instruct"
+DEFAULT_MAX_LENGTHS = [256, 512, 1024, 2048, 4096]
+DEFAULT_BATCH_SIZES = [1, 2, 4, 8, 16]
+DEFAULT_MAX_TRUNCATION = 0.01  # 推荐最大长度时允许的截断样本比例
+SHUFFLES = 5                   # 随机组批的模拟次数
+
+LENGTH_POLICIES = ["truncate", "drop", "split", "bucket"]
+
+
+@lru_cache(maxsize=None)
+def chat_format():
+    """训练侧的聊天模板模块；按文件路径显式加载，不修改 sys.path"""
+    spec = importlib.util.spec_from_file_location("chat_format", CHAT_FORMAT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def read_dataset(path: Path) -> list:
+    return chat_format().read_dataset(path)
+
+
+def load_tokenizer(name: str):
+    """训练模型的分词器；缺少 tokenizers 或下载失败时退回字符估算"""
+    try:
+        return HFTokenizer(name)
+    except ImportError:
+        print("Warning: tokenizers not installed, falling back to estimated token counts "
+              "(pip install tokenizers)")
+    except Exception as e:
+        print(f"Warning: cannot load tokenizer {name} ({e}), falling back to estimated token counts")
+    return HeuristicTokenizer()
+
+
+def prompt_type_of(sample: dict) -> str:
+    """训练样本的 output 就是原始提示词"""
+    output = sample['output'].strip()
+    return 'json' if output.startswith(('{', '[')) else 'text'
+
+
+def sample_length(sample: dict, tokenizer) -> tuple[int, int]:
+    """(完整样本 token 数, 提示词部分 token 数)"""
+    prompt, response = chat_format().render(sample)
+    return tokenizer.count(prompt + response), tokenizer.count(prompt)
+
+
+def describe(lengths: np.ndarray) -> str:
+    if not len(lengths):
+        return "n=0"
+    p50, p90, p95, p99 = np.percentile(lengths, [50, 90, 95, 99])
+    return (f"n={len(lengths)} mean={lengths.mean():.0f} p50={p50:.0f} p90={p90:.0f} "
+            f"p95={p95:.0f} p99={p99:.0f} max={lengths.max()}")
+
+
+def truncation(lengths: np.ndarray, max_length: int) -> tuple[float, float]:
+    """(被截断的样本比例, 丢失的 token 比例)"""
+    over = lengths > max_length
+    lost = np.maximum(lengths - max_length, 0).sum()
+    return over.mean(), lost / max(1, lengths.sum())
+
+
+def padding_efficiency(lengths: np.ndarray, batch_size: int, max_length: int, mode: str, seed: int = 42) -> float:
+    """有效 token / 实际计算的 token。
+    fixed：每条都填充到 max_length；random：随机组批，填充到批内最长；grouped：按长度排序后组批"""
+    kept = np.minimum(lengths, max_length)
+    if not len(kept):
+        return 0.0
+    if mode == "fixed":
+        return kept.sum() / (len(kept) * max_length)
+
+    def padded(order: np.ndarray) -> int:
+        total = 0
+        for start in range(0, len(order), batch_size):
+            batch = kept[order[start:start + batch_size]]
+            total += batch.max() * len(batch)
+        return total
+
+    if mode == "grouped":
+        return kept.sum() / padded(np.argsort(kept, kind="stable"))
+    rng = np.random.default_rng(seed)
+    return float(np.mean([kept.sum() / padded(rng.permutation(len(kept))) for _ in range(SHUFFLES)]))
+
+
+def profile_report(
+    samples: Iterable[dict],
+    tokenizer,
+    max_lengths: list[int] = DEFAULT_MAX_LENGTHS,
+    batch_sizes: list[int] = DEFAULT_BATCH_SIZES,
+    max_truncation: float = DEFAULT_MAX_TRUNCATION
+) -> str:
+    """长度分布、截断率、填充浪费和推荐的最大长度"""
+    by_type: dict[str, list] = {}
+    for sample in samples:
+        total, prompt = sample_length(sample, tokenizer)
+        by_type.setdefault(prompt_type_of(sample), []).append((total, prompt))
+    if not by_type:
+        return "No samples to profile"
+    groups = {name: np.asarray(rows) for name, rows in sorted(by_type.items())}
+    groups["all"] = np.concatenate(list(groups.values()))
+    lengths = groups["all"][:, 0]
+
+    lines = [f"Token lengths (tokenizer: {tokenizer.name})"]
+    for name, rows in groups.items():
+        lines.append(f"  [{name}] sample: {describe(rows[:, 0])}")
+        lines.append(f"  [{name}] prompt part: {describe(rows[:, 1])}")
+
+    lines.append("\nTruncation at candidate max lengths (samples truncated / tokens lost)")
+    for max_length in max_lengths:
+        cells = []
+        for name, rows in groups.items():
+            over, lost = truncation(rows[:, 0], max_length)
+            cells.append(f"{name} {over:.1%}/{lost:.1%}")
+        lines.append(f"  {max_length:>5}: " + "  ".join(cells))
+
+    lines.append("\nPadding efficiency (useful / computed tokens): fixed | random | grouped")
+    for max_length in max_lengths:
+        cells = []
+        for batch_size in batch_sizes:
+            cells.append(
+                f"bs{batch_size} " + "|".join(
+                    f"{padding_efficiency(lengths, batch_size, max_length, mode):.0%}"
+                    for mode in ("fixed", "random", "grouped")
+                )
+            )
+        lines.append(f"  {max_length:>5}: " + "  ".join(cells))
+
+    # 推荐：截断率在阈值内的候选中，随机组批动态填充下有效 token 占比最高的
+    batch_size = max(batch_sizes)
+    candidates = [m for m in max_lengths if truncation(lengths, m)[0] <= max_truncation]
+    if candidates:
+        best = max(candidates, key=lambda m: padding_efficiency(lengths, batch_size, m, "random"))
+        lines.append(f"\nRecommended max length: {best} (<= {max_truncation:.0%} truncated, "
+                     f"{padding_efficiency(lengths, batch_size, best, 'random'):.0%} useful at "
+                     f"batch size {batch_size} with dynamic padding)")
+    else:
+        lines.append(f"\nNo candidate keeps truncation under {max_truncation:.0%}; "
+                     f"consider --length-policy drop or split")
+    return "\n".join(lines)
+
+
+class LengthPolicy:
+    """按 token 数处理超出 max_tokens 的样本。
+    truncate：原样保留（训练时截断）；drop：丢弃；split：写入单独的 xxx.long 文件，
+    用更大的序列长度另行训练；bucket：全部保留，标注 length 和所属分桶（不小于长度的最小候选值）"""
+
+    def __init__(self, policy: str, max_tokens: int, tokenizer, buckets: list[int] = DEFAULT_MAX_LENGTHS):
+        self.policy = policy
+        self.max_tokens = max_tokens
+        self.tokenizer = tokenizer
+        self.buckets = sorted(buckets)
+        self.kept = 0
+        self.over = 0
+
+    def apply(self, sample: dict) -> Optional[str]:
+        """返回样本去向："main"、"long" 或 None（丢弃）；bucket 策略会在样本上添加字段"""
+        if self.policy == "truncate":
+            self.kept += 1
+            return "main"
+        length, _ = sample_length(sample, self.tokenizer)
+        over = length > self.max_tokens
+        self.over += over
+        if self.policy == "bucket":
+            sample["length"] = length
+            sample["bucket"] = next((b for b in self.buckets if b >= length), self.buckets[-1])
+        elif over:
+            return "long" if self.policy == "split" else None
+        self.kept += 1
+        return "main"
+
+    def summary(self) -> str:
+        action = {"truncate": "truncated in training", "drop": "dropped",
+                  "split": "moved to .long files", "bucket": "tagged"}[self.policy]
+        return (f"Length policy [{self.policy}, max {self.max_tokens} tokens, {self.tokenizer.name}]: "
+                f"{self.over} over the limit {action}, {self.kept} samples in the main split")
+
+
+def long_output_path(path: Path) -> Path:
+    """split 策略的超长样本文件：training_data.json -> training_data.long.json"""
+    return path.with_name(f"{path.stem}.long{path.suffix}")
+
+
+def add_length_args(parser):
+    """为 prepare_dataset.py 添加超长样本处理参数"""
+    parser.add_argument("--length-policy", choices=LENGTH_POLICIES, default="truncate",
+                        help="超长样本处理：truncate 保留（训练时截断）；drop 丢弃；"
+                             "split 写入单独的 .long 文件；bucket 标注 length/bucket 字段")
+    parser.add_argument("--max-tokens", type=int, default=512,
+                        help="超长判定阈值（按训练模板计的 token 数，与训练脚本的 MAX_SEQ_LENGTH 对应）")
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="分析训练数据的 token 长度、截断率和填充浪费")
+    parser.add_argument("--split", choices=["train", "val", "all"], default="all", help="分析的数据集")
+    parser.add_argument("--tokenizer", default=DEFAULT_TOKENIZER, help="训练模型的分词器")
+    parser.add_argument("--max-lengths", type=int, nargs="+", default=DEFAULT_MAX_LENGTHS,
+                        help="候选最大序列长度")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=DEFAULT_BATCH_SIZES,
+                        help="计算填充浪费的 batch size")
+    parser.add_argument("--max-truncation", type=float, default=DEFAULT_MAX_TRUNCATION,
+                        help="推荐最大长度时允许的截断样本比例")
+    args = parser.parse_args()
+
+    splits = SPLIT_PATHS if args.split == "all" else {args.split: SPLIT_PATHS[args.split]}
+    samples = []
+    for split, path in splits.items():
+        if not path.exists() and not path.with_suffix(".jsonl").exists():
+            print(f"Error: {split} data not found: {path}")
+            print("Please run prepare_dataset.py first")
+            return
+        samples.extend(read_dataset(path))
+
+    tokenizer = load_tokenizer(args.tokenizer)
+    print(profile_report(samples, tokenizer, args.max_lengths, args.batch_sizes, args.max_truncation))
+
+
+if __name__ == "__main__":
+    main()
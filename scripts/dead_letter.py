@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+死信队列
+
+重试耗尽仍失败的条目写入持久化的死信文件（xxx.deadletter.jsonl，追加式，
+恢复成功时追加一条 resolved 记录），主流程不在它们身上耗时，继续全速处理后面的数据。
+主流程结束后用低并发、更多重试次数单独跑一遍死信队列；之后的运行也会先跳过死信条目，
+最后统一重试。队列清空时删除死信文件。
+"""
+
+import json
+import os
+import time
+from pathlib import Path
+from typing import Callable
+
+from checkpoint import iter_jsonl
+from pipeline import run_pipeline
+
+DEFAULT_RETRY_CONCURRENCY = 2
+DEFAULT_RETRY_ATTEMPTS = 5
+
+
+def dead_letter_path(output_path: Path) -> Path:
+    """输出文件对应的死信文件路径"""
+    return Path(output_path).with_suffix(".deadletter.jsonl")
+
+
+class DeadLetterQueue:
+    """持久化的失败条目队列，按 key（original_index）去重"""
+
+    def __init__(self, path: Path, stage: str):
+        self.path = Path(path)
+        self.stage = stage
+        self.entries = {}
+        self.added = 0
+        self.recovered = 0
+        if self.path.exists():
+            for record in iter_jsonl(self.path):
+                if record.get("resolved"):
+                    self.entries.pop(record["key"], None)
+                else:
+                    self.entries[record["key"]] = record
+        self._file = None
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key) -> bool:
+        return key in self.entries
+
+    def keys(self) -> list:
+        return sorted(self.entries)
+
+    def _write(self, record: dict):
+        if self._file is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def add(self, key, reason: str):
+        """记录一次失败（同一条数据再次失败时累加次数）"""
+        previous = self.entries.get(key)
+        record = {
+            "key": key,
+            "stage": self.stage,
+            "reason": reason,
+            "failures": (previous["failures"] if previous else 0) + 1,
+            "failed_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        if previous is None:
+            self.added += 1
+        self.entries[key] = record
+        self._write(record)
+
+    def resolve(self, key):
+        """重试成功，移出队列"""
+        if self.entries.pop(key, None) is not None:
+            self.recovered += 1
+            self._write({"key": key, "resolved": True})
+
+    def wrap(self, sink: Callable, reason: str, key_of: Callable = lambda item: item) -> Callable:
+        """包装流水线的 sink：结果为空时入队，非空时出队"""
+        def tracked(item, result):
+            sink(item, result)
+            if result:
+                self.resolve(key_of(item))
+            else:
+                self.add(key_of(item), reason)
+        return tracked
+
+    def close(self):
+        """压缩死信文件；队列为空时删除"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if not self.entries:
+            self.path.unlink(missing_ok=True)
+            return
+        tmp_path = self.path.with_name(f".{self.path.name}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for key in self.keys():
+                f.write(json.dumps(self.entries[key], ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def summary(self) -> str:
+        location = f" -> {self.path}" if self.entries else ""
+        return (
+            f"Dead letters [{self.stage}]: {self.added} added, {self.recovered} recovered, "
+            f"{len(self.entries)} remaining{location}"
+        )
+
+
+async def retry_pass(
+    dead_letters: DeadLetterQueue,
+    items: list,
+    work: Callable,
+    sink: Callable,
+    client,
+    concurrency: int,
+    attempts: int,
+    reason: str,
+    key_of: Callable = lambda item: item
+) -> dict:
+    """低并发、更多重试次数地处理死信条目"""
+    print(f"\nRetrying {len(items)} dead-lettered items "
+          f"(concurrency={concurrency}, attempts={attempts})...")
+    saved = client.max_retries
+    client.max_retries = attempts
+    try:
+        stats = await run_pipeline(
+            items, work, dead_letters.wrap(sink, reason, key_of), concurrency, desc="Retrying"
+        )
+    finally:
+        client.max_retries = saved
+    print(f"Retry pass: {stats['succeeded']} recovered, {stats['failed']} still failing")
+    return stats
+
+
+def add_dead_letter_args(parser):
+    """为脚本添加死信队列参数"""
+    parser.add_argument("--retry-concurrency", type=int, default=DEFAULT_RETRY_CONCURRENCY,
+                        help="死信重试的并发数")
+    parser.add_argument("--retry-attempts", type=int, default=DEFAULT_RETRY_ATTEMPTS,
+                        help="死信重试时每条数据最多尝试次数")
+    parser.add_argument("--no-retry-pass", action="store_true",
+                        help="主流程结束后不重试死信队列（留给下次运行）")
+    parser.add_argument("--retry-only", action="store_true",
+                        help="只重试死信队列，不处理新数据")
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""
+近似重复检测 (MinHash + LSH)
+
+文本规范化后取字符 n-gram，计算 MinHash 签名；签名按 LSH 分桶，
+只比较落在同一个桶里的候选对，复杂度随数据量近似线性增长。
+两处使用：
+- 生成前：原始提示词中近似重复的只生成一次
+- 增强后：与已有描述近似重复的变体直接丢弃
+丢弃的条目写入报告 data/processed/dedup_report_<stage>.json。
+
+用法：
+    python dedup.py --threshold 0.9     # 只检查原始提示词，输出报告
+"""
+
+import json
+import re
+import unicodedata
+import zlib
+from pathlib import Path
+from typing import Iterable, Optional
+
+import numpy as np
+
+# 配置
+BASE_DIR = Path(__file__).parent.parent
+REPORT_DIR = BASE_DIR / "data/processed"
+
+DEFAULT_NUM_PERM = 128
+PRIME = 4294967291  # 小于 2^32 的最大素数
+
+
+def normalize(text: str) -> str:
+    """全角转半角、小写、合并空白"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def shingles(text: str, ngram: int) -> set[str]:
+    """字符 n-gram 集合（文本短于 n 时取整段）"""
+    text = normalize(text)
+    if len(text) <= ngram:
+        return {text}
+    return {text[i:i + ngram] for i in range(len(text) - ngram + 1)}
+
+
+def lsh_params(threshold: float, num_perm: int) -> tuple[int, int]:
+    """选择分桶参数 (bands, rows)，使 S 曲线的拐点 (1/b)^(1/r) 略低于阈值（偏向召回）"""
+    best = None
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        knee = (1 / bands) ** (1 / rows)
+        if knee <= threshold and (best is None or knee > best[0]):
+            best = (knee, bands, rows)
+    return (best[1], best[2]) if best else (num_perm, 1)
+
+
+class MinHasher:
+    """MinHash 签名：h(x) = (a * x + b) mod p，取每个排列下的最小值"""
+
+    def __init__(self, num_perm: int = DEFAULT_NUM_PERM, seed: int = 42):
+        rng = np.random.default_rng(seed)
+        # a, b, x 都小于 p，乘加不会超出 uint64
+        self.a = rng.integers(1, PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, PRIME, size=num_perm, dtype=np.uint64)
+        self.num_perm = num_perm
+
+    def signature(self, grams: set[str]) -> np.ndarray:
+        values = np.fromiter(
+            (zlib.crc32(g.encode("utf-8")) % PRIME for g in grams),
+            dtype=np.uint64, count=len(grams)
+        )
+        hashed = (np.outer(values, self.a) + self.b) % np.uint64(PRIME)
+        return hashed.min(axis=0)
+
+
+class NearDuplicateIndex:
+    """增量式 LSH 索引：逐条加入，查询与已加入文本的近似重复"""
+
+    def __init__(
+        self,
+        threshold: float,
+        ngram: int,
+        num_perm: int = DEFAULT_NUM_PERM
+    ):
+        self.threshold = threshold
+        self.ngram = ngram
+        self.hasher = MinHasher(num_perm)
+        self.bands, self.rows = lsh_params(threshold, num_perm)
+        self._buckets = [dict() for _ in range(self.bands)]
+        self._signatures = {}
+
+    def __len__(self) -> int:
+        return len(self._signatures)
+
+    def _band_keys(self, signature: np.ndarray) -> list[bytes]:
+        return [
+            signature[i * self.rows:(i + 1) * self.rows].tobytes()
+            for i in range(self.bands)
+        ]
+
+    def _query(self, signature: np.ndarray, band_keys: list[bytes]) -> Optional[tuple]:
+        """返回相似度最高且不低于阈值的 (key, similarity)"""
+        candidates = set()
+        for bucket, band_key in zip(self._buckets, band_keys):
+            candidates.update(bucket.get(band_key, ()))
+        best = None
+        for key in candidates:
+            similarity = float(np.mean(self._signatures[key] == signature))
+            if similarity >= self.threshold and (best is None or similarity > best[1]):
+                best = (key, similarity)
+        return best
+
+    def _insert(self, key, signature: np.ndarray, band_keys: list[bytes]):
+        self._signatures[key] = signature
+        for bucket, band_key in zip(self._buckets, band_keys):
+            bucket.setdefault(band_key, []).append(key)
+
+    def add(self, key, text: str):
+        """无条件加入索引"""
+        signature = self.hasher.signature(shingles(text, self.ngram))
+        self._insert(key, signature, self._band_keys(signature))
+
+    def add_if_new(self, key, text: str) -> Optional[tuple]:
+        """不重复时加入索引并返回 None；重复时返回 (重复对象的 key, 估计相似度)"""
+        signature = self.hasher.signature(shingles(text, self.ngram))
+        band_keys = self._band_keys(signature)
+        match = self._query(signature, band_keys)
+        if match is None:
+            self._insert(key, signature, band_keys)
+        return match
+
+
+class DedupReport:
+    """记录被丢弃的条目"""
+
+    def __init__(self, stage: str, threshold: float, ngram: int):
+        self.stage = stage
+        self.threshold = threshold
+        self.ngram = ngram
+        self.checked = 0
+        self.dropped = []
+
+    @property
+    def dropped_keys(self) -> set:
+        return {entry["key"] for entry in self.dropped}
+
+    def record(self, key, duplicate_of, similarity: float, text: str):
+        self.dropped.append({
+            "key": key,
+            "duplicate_of": duplicate_of,
+            "similarity": round(similarity, 3),
+            "text": text[:200],
+        })
+
+    def path(self) -> Path:
+        return REPORT_DIR / f"dedup_report_{self.stage}.json"
+
+    def save(self):
+        path = self.path()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({
+                "stage": self.stage,
+                "threshold": self.threshold,
+                "ngram": self.ngram,
+                "checked": self.checked,
+                "dropped": self.dropped,
+            }, f, ensure_ascii=False, indent=2)
+
+    def summary(self) -> str:
+        return (
+            f"Dedup [{self.stage}]: {len(self.dropped)}/{self.checked} near-duplicates dropped "
+            f"(threshold={self.threshold}, {self.ngram}-grams) -> {self.path()}"
+        )
+
+
+def deduplicate(
+    items: Iterable[tuple],
+    stage: str,
+    threshold: float,
+    ngram: int
+) -> DedupReport:
+    """按顺序检查 (key, text)，保留每组近似重复中的第一条"""
+    index = NearDuplicateIndex(threshold, ngram)
+    report = DedupReport(stage, threshold, ngram)
+    for key, text in items:
+        report.checked += 1
+        match = index.add_if_new(key, text)
+        if match is not None:
+            report.record(key, match[0], match[1], text)
+    return report
+
+
+def dedup_corpus(corpus, threshold: float, ngram: int) -> set[int]:
+    """生成前去重：返回应跳过的 row_id，并保存报告"""
+    report = deduplicate(
+        ((row_id, corpus.prompt(row_id)) for row_id in range(len(corpus))),
+        "prompts", threshold, ngram
+    )
+    report.save()
+    print(report.summary())
+    return report.dropped_keys
+
+
+def add_dedup_args(parser, threshold: float, ngram: int):
+    """为脚本添加去重参数"""
+    parser.add_argument("--dedup-threshold", type=float, default=threshold,
+                        help="近似重复阈值（估计的 n-gram Jaccard 相似度）")
+    parser.add_argument("--dedup-ngram", type=int, default=ngram,
+                        help="字符 n-gram 长度")
+    parser.add_argument("--no-dedup", action="store_true",
+                        help="关闭近似重复检测")
+
+
+def main():
+    import argparse
+    from corpus import load_corpus
+    parser = argparse.ArgumentParser(description="检查原始提示词中的近似重复")
+    parser.add_argument("--threshold", type=float, default=0.9, help="近似重复阈值")
+    parser.add_argument("--ngram", type=int, default=5, help="字符 n-gram 长度")
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    dedup_corpus(corpus, args.threshold, args.ngram)
+    corpus.close()
+
+
+if __name__ == "__main__":
+    main()
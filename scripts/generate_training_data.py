@@ -6,20 +6,30 @@
 最终输出训练数据格式：{instruction, input, output}
 """
 
-import json
 import os
 import asyncio
-import pandas as pd
+from contextlib import AsyncExitStack
 from pathlib import Path
 from typing import Optional
-import anthropic
-from tqdm.asyncio import tqdm_asyncio
+
+from batch_jobs import BatchRunner, add_batch_args, batch_state_path
+from checkpoint import JsonlCheckpoint, journal_path
+from corpus import load_corpus
+from dead_letter import DeadLetterQueue, add_dead_letter_args, dead_letter_path, retry_pass
+from dedup import add_dedup_args, dedup_corpus
+from llm_client import LLMClient, add_client_args, open_client
+from packing import Packer, add_pack_args, run_packed
+from pipeline import run_pipeline
+from shards import add_shard_args, shard_output_path, write_manifest
+from token_budget import add_budget_args, dry_run, truncate_tokens
 
 # 配置
 BASE_DIR = Path(__file__).parent.parent
 RAW_DATA_PATH = BASE_DIR / "data/raw/NanoBananaProPrompts.xlsx"
 OUTPUT_PATH = BASE_DIR / "data/processed/raw_training_data.json"
 
+MODEL = "claude-sonnet-4-20250514"
+
 # 系统提示词
 SYSTEM_PROMPT = """你是一个专业的提示词分析专家。你的任务是分析给定的图像生成提示词，并生成一个简洁的中文描述。
 
@@ -48,155 +58,215 @@ USER_PROMPT_TEMPLATE = """请为以下图像生成提示词生成一个简洁的
 
 请直接输出中文描述，不要有任何解释或前缀。"""
 
+# 打包模式的用户消息开头，后接编号的提示词
+PACKED_HEADER = "请为以下 {count} 条图像生成提示词分别生成简洁的中文描述（10-30字）："
+PACKED_EXAMPLE = '{"1": "霓虹街头的赛博朋克女孩，夜景氛围", "2": "咖啡馆里看书的文艺女生"}'
+
+
+MAX_TOKENS = 100
+MAX_PROMPT_TOKENS = 1500  # 输入提示词的 token 上限
+
+
+def build_user_prompt(prompt: str, prompt_type: str) -> str:
+    """构造用户消息"""
+    return USER_PROMPT_TEMPLATE.format(
+        prompt_type=prompt_type,
+        prompt=truncate_tokens(prompt, MAX_PROMPT_TOKENS, "anthropic", MODEL)  # 截断过长的提示词
+    )
+
+
+def build_slot(prompt: str, prompt_type: str) -> str:
+    """打包模式中单条提示词的槽位内容"""
+    return f"提示词类型：{prompt_type}\n{truncate_tokens(prompt, MAX_PROMPT_TOKENS, 'anthropic', MODEL)}"
+
+
+def valid_description(value) -> Optional[str]:
+    """校验打包结果中的一个槽位：单行、长度合理的字符串"""
+    if not isinstance(value, str):
+        return None
+    value = value.strip().strip('"\'“”')
+    if "\n" in value or not 2 <= len(value) <= 60:
+        return None
+    return value
+
 
 async def generate_description(
-    client: anthropic.AsyncAnthropic,
+    client: LLMClient,
     prompt: str,
-    prompt_type: str,
-    semaphore: asyncio.Semaphore,
-    max_retries: int = 3
+    prompt_type: str
 ) -> Optional[str]:
     """调用 Claude API 生成简单描述"""
-    async with semaphore:
-        for attempt in range(max_retries):
-            try:
-                message = await client.messages.create(
-                    model="claude-sonnet-4-20250514",
-                    max_tokens=100,
-                    system=SYSTEM_PROMPT,
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": USER_PROMPT_TEMPLATE.format(
-                                prompt_type=prompt_type,
-                                prompt=prompt[:3000]  # 截断过长的提示词
-                            )
-                        }
-                    ]
-                )
-                return message.content[0].text.strip()
-            except Exception as e:
-                if attempt == max_retries - 1:
-                    print(f"Error after {max_retries} attempts: {e}")
-                    return None
-                await asyncio.sleep(2 ** attempt)  # 指数退避
-    return None
-
-
-async def process_batch(
-    client: anthropic.AsyncAnthropic,
-    df: pd.DataFrame,
-    start_idx: int,
-    batch_size: int,
-    semaphore: asyncio.Semaphore
-) -> list:
-    """处理一批数据"""
-    end_idx = min(start_idx + batch_size, len(df))
-    batch = df.iloc[start_idx:end_idx]
-    
-    tasks = []
-    for _, row in batch.iterrows():
-        task = generate_description(
-            client,
-            row['prompt'],
-            row['prompt_type'],
-            semaphore
-        )
-        tasks.append(task)
-    
-    results = await asyncio.gather(*tasks)
-    
-    training_data = []
-    for i, (_, row) in enumerate(batch.iterrows()):
-        if results[i]:
-            training_data.append({
-                "simple_description": results[i],
-                "prompt": row['prompt'],
-                "prompt_type": row['prompt_type'],
-                "original_index": start_idx + i
-            })
-    
-    return training_data
+    user_prompt = build_user_prompt(prompt, prompt_type)
+    return await client.complete(SYSTEM_PROMPT, user_prompt, max_tokens=MAX_TOKENS)
 
 
 async def main():
-    # 检查 API Key
+    import argparse
+    parser = argparse.ArgumentParser(description="调用 Claude 为原始提示词生成简单描述")
+    add_client_args(parser, "anthropic")
+    parser.add_argument("--no-compact", action="store_true",
+                        help="结束时不把 JSONL 日志压缩成 JSON（下游直接读日志）")
+    add_batch_args(parser)
+    add_budget_args(parser)
+    add_dedup_args(parser, threshold=0.9, ngram=5)
+    add_shard_args(parser)
+    add_dead_letter_args(parser)
+    add_pack_args(parser)
+    args = parser.parse_args()
+    # 分片运行时使用独立的输出、日志和批任务状态文件
+    output_path = shard_output_path(OUTPUT_PATH, args.shard)
+
+    # 检查 API Key（只读回放和 dry-run 不发请求，无需 Key）
     api_key = os.environ.get("ANTHROPIC_API_KEY")
-    if not api_key:
+    if not api_key and args.cache_mode != "replay" and not args.dry_run:
         print("Error: ANTHROPIC_API_KEY environment variable not set")
         print("Please set it: export ANTHROPIC_API_KEY='your-api-key'")
         return
     
-    # 读取原始数据
+    # 读取原始数据（内存映射的列式缓存，工作簿变化时自动重新转换）
     print(f"Reading data from {RAW_DATA_PATH}")
-    df = pd.read_excel(RAW_DATA_PATH, header=2)
-    print(f"Loaded {len(df)} prompts")
-    
-    # 过滤掉空数据
-    df = df.dropna(subset=['prompt'])
-    print(f"After filtering: {len(df)} valid prompts")
-    
-    # 检查是否已有部分处理结果
-    existing_data = []
-    processed_indices = set()
-    if OUTPUT_PATH.exists():
-        with open(OUTPUT_PATH, 'r', encoding='utf-8') as f:
-            existing_data = json.load(f)
-            processed_indices = {item['original_index'] for item in existing_data}
-        print(f"Found {len(existing_data)} already processed items")
-    
-    # 过滤已处理的数据
-    remaining_indices = [i for i in range(len(df)) if i not in processed_indices]
-    print(f"Remaining to process: {len(remaining_indices)} items")
-    
-    if not remaining_indices:
-        print("All items already processed!")
-        return
+    corpus = load_corpus(RAW_DATA_PATH)
+    print(f"Loaded {len(corpus)} valid prompts")
     
-    # 初始化客户端
-    client = anthropic.AsyncAnthropic(api_key=api_key)
+    # 提前返回或出错时也会关闭断点日志、死信队列和客户端
+    async with AsyncExitStack() as stack:
+        # 检查是否已有部分处理结果（一次流式扫描断点日志）
+        checkpoint = JsonlCheckpoint(journal_path(output_path))
+        stack.callback(checkpoint.close)
+        processed_indices = checkpoint.resume(legacy_json=output_path)
+        if checkpoint.count:
+            print(f"Found {checkpoint.count} already processed items")
     
-    # 并发控制
-    semaphore = asyncio.Semaphore(5)  # 最多 5 个并发请求
-    batch_size = 20
+        # 近似重复的提示词只生成一次
+        duplicates = set()
+        if not args.no_dedup:
+            duplicates = dedup_corpus(corpus, args.dedup_threshold, args.dedup_ngram)
     
-    # 处理数据
-    all_results = existing_data.copy()
+        # 本分片负责的数据（不分片时为全部）
+        assigned = [
+            i for i in range(len(corpus))
+            if i not in duplicates and (args.shard is None or args.shard.owns(i))
+        ]
+        if args.shard:
+            print(f"Shard {args.shard}: {len(assigned)} items")
+            write_manifest(output_path, args.shard, assigned)
     
-    print(f"\nProcessing {len(remaining_indices)} prompts...")
+        # 过滤已处理的数据；之前失败的数据在死信队列中，留到最后统一重试
+        dead_letters = DeadLetterQueue(dead_letter_path(output_path), "generate")
+        stack.callback(dead_letters.close)
+        if len(dead_letters):
+            print(f"Found {len(dead_letters)} dead-lettered items")
+        remaining_indices = [
+            i for i in assigned if i not in processed_indices and i not in dead_letters
+        ]
+        if args.retry_only:
+            remaining_indices = []
+        print(f"Remaining to process: {len(remaining_indices)} items")
     
-    for i in tqdm_asyncio(range(0, len(remaining_indices), batch_size), desc="Batches"):
-        batch_indices = remaining_indices[i:i + batch_size]
-        batch_df = df.iloc[batch_indices].copy()
-        batch_df['_original_idx'] = batch_indices
-        
-        tasks = []
-        for idx, row in batch_df.iterrows():
-            task = generate_description(
-                client,
-                row['prompt'],
-                row['prompt_type'],
-                semaphore
-            )
-            tasks.append((row['_original_idx'], row, task))
-        
-        for orig_idx, row, task in tasks:
-            result = await task
+        if not remaining_indices and (not len(dead_letters) or args.no_retry_pass):
+            print("All items already processed!")
+            if not args.no_compact:
+                checkpoint.compact(output_path)
+            return
+    
+        # 初始化客户端（含响应缓存、限速和自适应并发控制）
+        client = open_client(args, "anthropic", MODEL)
+        stack.push_async_callback(client.close)
+    
+        if args.pack and args.batch:
+            print("Error: --pack cannot be combined with --batch")
+            return
+        packer = Packer(
+            client, SYSTEM_PROMPT, PACKED_HEADER, "对应的中文描述字符串", PACKED_EXAMPLE,
+            MAX_TOKENS, valid_description, token_budget=args.pack_tokens, max_items=args.pack_max
+        )
+    
+        def slots(indices: list[int]) -> list[tuple[int, str]]:
+            return [(idx, build_slot(corpus.prompt(idx), corpus.prompt_type(idx))) for idx in indices]
+    
+        if args.dry_run:
+            if args.pack:
+                requests = packer.requests_for(packer.plan(slots(remaining_indices)))
+            else:
+                requests = (
+                    (SYSTEM_PROMPT, build_user_prompt(corpus.prompt(idx), corpus.prompt_type(idx)),
+                     MAX_TOKENS, None)
+                    for idx in remaining_indices
+                )
+            print(dry_run(client, requests, args.rpm, args.tpm, batch=args.batch))
+            return
+    
+        def append_result(idx: int, result: Optional[str]):
             if result:
-                all_results.append({
+                # 每完成一条追加一行（断点续传）
+                row = corpus.row(idx)
+                checkpoint.append({
                     "simple_description": result,
                     "prompt": row['prompt'],
                     "prompt_type": row['prompt_type'],
-                    "original_index": orig_idx
+                    "original_index": idx
                 })
+    
+        # 重试耗尽的数据进入死信队列，成功后移出
+        track_result = dead_letters.wrap(append_result, "no description after retries")
+    
+        async def work(idx: int) -> Optional[str]:
+            row = corpus.row(idx)
+            return await generate_description(
+                client,
+                row['prompt'],
+                row['prompt_type']
+            )
+    
+        if args.batch and remaining_indices:
+            # 批处理模式：打包提交，轮询结束后合并结果
+            print(f"\nSubmitting {len(remaining_indices)} prompts as message batches...")
+            runner = BatchRunner(
+                client, batch_state_path(output_path), args.batch_size, args.poll_interval
+            )
+            requests = {}
+            for idx in remaining_indices:
+                row = corpus.row(idx)
+                requests[f"row-{idx}"] = (
+                    SYSTEM_PROMPT, build_user_prompt(row['prompt'], row['prompt_type']), MAX_TOKENS
+                )
+            async for custom_id, result in runner.run(requests):
+                track_result(int(custom_id.removeprefix("row-")), result)
+            print(runner.summary())
+        else:
+            if args.pack and remaining_indices:
+                # 打包模式：校验失败的槽位拆出来按单条请求重新排队
+                print(f"\nProcessing {len(remaining_indices)} prompts in packed requests...")
+                remaining_indices = await run_packed(
+                    packer, slots(remaining_indices), append_result,
+                    client.limiter.max_limit, desc="Generating (packed)"
+                )
         
-        # 每批次保存一次（断点续传）
-        OUTPUT_PATH.parent.mkdir(parents=True, exist_ok=True)
-        with open(OUTPUT_PATH, 'w', encoding='utf-8') as f:
-            json.dump(all_results, f, ensure_ascii=False, indent=2)
+            if remaining_indices:
+                print(f"\nProcessing {len(remaining_indices)} prompts...")
+            
+                # worker 数取窗口上限，实际在途请求数由限制器决定；结果按输入顺序写入
+                stats = await run_pipeline(
+                    remaining_indices, work, track_result, client.limiter.max_limit, desc="Generating"
+                )
+                print(f"Throughput: {stats['items_per_sec']:.2f} items/s "
+                      f"({stats['succeeded']} ok, {stats['failed']} failed in {stats['elapsed']:.1f}s)")
+    
+        # 主流程结束后低并发重试死信队列
+        if len(dead_letters) and not args.no_retry_pass:
+            await retry_pass(
+                dead_letters, dead_letters.keys(), work, append_result, client,
+                args.retry_concurrency, args.retry_attempts, "no description after retries"
+            )
     
-    print(f"\nDone! Generated {len(all_results)} training samples")
-    print(f"Output saved to: {OUTPUT_PATH}")
+        print(dead_letters.summary())
+        print(f"\nDone! Generated {checkpoint.count} training samples")
+        if args.no_compact:
+            print(f"Output saved to: {checkpoint.path}")
+        else:
+            checkpoint.compact(output_path)
+            print(f"Output saved to: {output_path}")
+        print(client.summary())
 
 
 if __name__ == "__main__":
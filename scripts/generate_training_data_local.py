@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""
+生成训练数据脚本 (本地 transformers 版本)
+
+不依赖任何外部服务，直接在本机加载 Hugging Face 模型（默认 Qwen2.5-1.5B-Instruct，
+与 train_lora_mac.py 相同）为每条提示词生成简单的中文描述。
+全部待处理提示词按 token 长度排序后分批，左填充后一次 generate 整批，
+同一批内长度相近，填充浪费最少；没有逐条 HTTP 请求的开销，多核 CPU 上吞吐更高。
+贪心解码得不到可用描述的条目进入死信队列，主流程结束后改用采样重新生成
+（--retry-attempts 轮，每轮一个采样结果；本地没有并发请求，--retry-concurrency 不起作用）。
+
+需要额外安装：pip install torch transformers
+"""
+
+import os
+import time
+from pathlib import Path
+from typing import Optional
+
+from checkpoint import JsonlCheckpoint, journal_path
+from corpus import load_corpus
+from dead_letter import DeadLetterQueue, add_dead_letter_args, dead_letter_path
+from dedup import add_dedup_args, dedup_corpus
+from generate_training_data_ollama import SYSTEM_PROMPT, clean_response
+from llm_cache import add_cache_args, make_cache_key, open_cache
+from shards import add_shard_args, shard_output_path, write_manifest
+from telemetry import add_telemetry_args, open_telemetry
+
+# 配置
+BASE_DIR = Path(__file__).parent.parent
+RAW_DATA_PATH = BASE_DIR / "data/raw/NanoBananaProPrompts.xlsx"
+OUTPUT_PATH = BASE_DIR / "data/processed/raw_training_data.json"
+
+MODEL = "Qwen/Qwen2.5-1.5B-Instruct"
+
+MAX_NEW_TOKENS = 64       # 描述只有 10-30 字
+MAX_PROMPT_TOKENS = 1000  # 输入提示词的 token 上限
+BATCH_SIZE = 16
+MAX_BATCH_TOKENS = 16384  # 单批 (条数 × 最长输入) 上限，控制长提示词批次的内存
+RETRY_TEMPERATURE = 0.7   # 死信重试改用采样（贪心解码重跑结果不变）
+
+
+def build_user_prompt(prompt: str, tokenizer) -> str:
+    """构造用户消息（按模型分词器截断过长的提示词）"""
+    encoding = tokenizer(prompt, add_special_tokens=False, return_offsets_mapping=True)
+    if len(encoding["input_ids"]) > MAX_PROMPT_TOKENS:
+        prompt = prompt[:encoding["offset_mapping"][MAX_PROMPT_TOKENS - 1][1]]
+    return f"""为以下图像提示词生成简洁中文描述（10-30字）：
+
+{prompt}
+
+直接输出描述："""
+
+
+def plan_batches(lengths: dict, batch_size: int, max_batch_tokens: int) -> list[list]:
+    """按输入长度排序后切分批次；批内最长输入 × 条数不超过 max_batch_tokens"""
+    batches, batch = [], []
+    for key in sorted(lengths, key=lengths.get):
+        # 排过序，当前条目就是批内最长的
+        if batch and (len(batch) >= batch_size or (len(batch) + 1) * lengths[key] > max_batch_tokens):
+            batches.append(batch)
+            batch = []
+        batch.append(key)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class LocalGenerator:
+    """本地批量生成：左填充 + 贪心解码"""
+
+    def __init__(self, model_name: str, device: str, threads: Optional[int] = None):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        self.torch = torch
+        if threads:
+            torch.set_num_threads(threads)
+        self.device = device
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        # decoder-only 模型批量生成必须左填充，新 token 才能接在每条输入的真实末尾
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            torch_dtype=torch.float32 if device == "cpu" else torch.float16,
+        ).to(device)
+        self.model.eval()
+
+    def chat_text(self, user_prompt: str) -> str:
+        """套用模型自带的聊天模板"""
+        return self.tokenizer.apply_chat_template(
+            [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": user_prompt},
+            ],
+            tokenize=False,
+            add_generation_prompt=True,
+        )
+
+    def count(self, text: str) -> int:
+        return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
+
+    def generate(self, texts: list[str], sample: bool = False) -> tuple[list[str], int, int]:
+        """整批生成，返回 (输出文本, 输入 token 数, 输出 token 数)；sample=True 时按 RETRY_TEMPERATURE 采样"""
+        sampling = {"do_sample": True, "temperature": RETRY_TEMPERATURE} if sample else {"do_sample": False}
+        inputs = self.tokenizer(
+            texts, return_tensors="pt", padding=True, add_special_tokens=False
+        ).to(self.device)
+        with self.torch.inference_mode():
+            outputs = self.model.generate(
+                **inputs,
+                max_new_tokens=MAX_NEW_TOKENS,
+                **sampling,
+                pad_token_id=self.tokenizer.pad_token_id,
+            )
+        new_tokens = outputs[:, inputs["input_ids"].shape[1]:]
+        responses = self.tokenizer.batch_decode(new_tokens, skip_special_tokens=True)
+        input_tokens = int(inputs["attention_mask"].sum())
+        output_tokens = int((new_tokens != self.tokenizer.pad_token_id).sum())
+        return [r.strip() for r in responses], input_tokens, output_tokens
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="用本地 transformers 模型为原始提示词生成简单描述")
+    parser.add_argument("--model", default=MODEL, help="Hugging Face 模型名或本地路径")
+    parser.add_argument("--device", choices=["cpu", "mps", "cuda"], default="cpu", help="运行设备")
+    parser.add_argument("--threads", type=int, default=os.cpu_count(), help="CPU 线程数")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="每批最多条数")
+    parser.add_argument("--max-batch-tokens", type=int, default=MAX_BATCH_TOKENS,
+                        help="每批 (条数 × 最长输入 token 数) 上限")
+    parser.add_argument("--no-compact", action="store_true",
+                        help="结束时不把 JSONL 日志压缩成 JSON（下游直接读日志）")
+    add_cache_args(parser)
+    add_telemetry_args(parser)
+    add_dedup_args(parser, threshold=0.9, ngram=5)
+    add_dead_letter_args(parser)
+    add_shard_args(parser)
+    args = parser.parse_args()
+    # 分片运行时使用独立的输出和断点日志
+    output_path = shard_output_path(OUTPUT_PATH, args.shard)
+
+    # 读取原始数据（内存映射的列式缓存，工作簿变化时自动重新转换）
+    print(f"Reading data from {RAW_DATA_PATH}")
+    corpus = load_corpus(RAW_DATA_PATH)
+    print(f"Loaded {len(corpus)} valid prompts")
+
+    # 检查是否已有部分处理结果（一次流式扫描断点日志）
+    checkpoint = JsonlCheckpoint(journal_path(output_path))
+    processed_indices = checkpoint.resume(legacy_json=output_path)
+    if checkpoint.count:
+        print(f"Found {checkpoint.count} already processed items")
+    dead_letters = DeadLetterQueue(dead_letter_path(output_path), "generate")
+    cache = telemetry = None
+    # 任何一批出错（如内存不足）都要落盘断点日志、死信队列、缓存和遥测
+    try:
+        # 近似重复的提示词只生成一次
+        duplicates = set()
+        if not args.no_dedup:
+            duplicates = dedup_corpus(corpus, args.dedup_threshold, args.dedup_ngram)
+
+        # 本分片负责的数据（不分片时为全部）
+        assigned = [
+            i for i in range(len(corpus))
+            if i not in duplicates and (args.shard is None or args.shard.owns(i))
+        ]
+        if args.shard:
+            print(f"Shard {args.shard}: {len(assigned)} items")
+            write_manifest(output_path, args.shard, assigned)
+
+        # 过滤已处理的数据；之前没生成出描述的数据在死信队列中，留到最后统一重试
+        if len(dead_letters):
+            print(f"Found {len(dead_letters)} dead-lettered items")
+        remaining_indices = [
+            i for i in assigned if i not in processed_indices and i not in dead_letters
+        ]
+        if args.retry_only:
+            remaining_indices = []
+        print(f"Remaining to process: {len(remaining_indices)} items")
+
+        if not remaining_indices and (not len(dead_letters) or args.no_retry_pass):
+            print("All items already processed!")
+            if not args.no_compact:
+                checkpoint.compact(output_path)
+            return
+
+        try:
+            print(f"Loading {args.model} on {args.device} ({args.threads} threads)...")
+            generator = LocalGenerator(args.model, args.device, args.threads)
+        except ImportError:
+            print("Error: torch and transformers are required for the local backend")
+            print("Please install them: pip install torch transformers")
+            return
+
+        cache = open_cache(args)
+        telemetry = open_telemetry(args)
+        params = {"max_new_tokens": MAX_NEW_TOKENS, "do_sample": False}
+
+        def append_result(idx: int, result: Optional[str]):
+            if result:
+                # 每完成一条追加一行（断点续传）
+                row = corpus.row(idx)
+                checkpoint.append({
+                    "simple_description": result,
+                    "prompt": row['prompt'],
+                    "prompt_type": row['prompt_type'],
+                    "original_index": idx
+                })
+
+        # 没有可用描述的条目入队，重试成功时出队
+        sink = dead_letters.wrap(append_result, "no usable description")
+        user_prompts, cache_keys = {}, {}
+
+        def lookup(indices: list[int], params: dict) -> dict:
+            """先查缓存（与其他后端相同的缓存键口径），返回未命中条目的输入长度"""
+            lengths = {}
+            for idx in indices:
+                if idx not in user_prompts:
+                    user_prompts[idx] = build_user_prompt(corpus.prompt(idx), generator.tokenizer)
+                cache_keys[idx] = make_cache_key("transformers", args.model, SYSTEM_PROMPT, user_prompts[idx], params)
+                cached = cache.get(cache_keys[idx])
+                if cached is not None:
+                    sink(idx, clean_response(cached))
+                elif cache.mode != "replay":
+                    lengths[idx] = generator.count(generator.chat_text(user_prompts[idx]))
+            return lengths
+
+        def generate(lengths: dict, sample: bool, desc: str) -> int:
+            """按长度分批生成，返回没有可用描述的条数"""
+            from tqdm import tqdm
+            failed = 0
+            progress = tqdm(total=len(lengths), desc=desc)
+            for batch in plan_batches(lengths, args.batch_size, args.max_batch_tokens):
+                started = time.time()
+                batch_start = time.monotonic()
+                responses, input_tokens, output_tokens = generator.generate(
+                    [generator.chat_text(user_prompts[idx]) for idx in batch], sample=sample
+                )
+                telemetry.record(
+                    "transformers", args.model, "ok", started,
+                    latency=time.monotonic() - batch_start,
+                    input_tokens=input_tokens,
+                    output_tokens=output_tokens,
+                )
+                for idx, response in zip(batch, responses):
+                    cache.put(cache_keys[idx], "transformers", args.model, response)
+                    description = clean_response(response)
+                    if not description:
+                        failed += 1
+                    sink(idx, description)
+                progress.update(len(batch))
+            progress.close()
+            return failed
+
+        lengths = lookup(remaining_indices, params)
+        if lengths:
+            print(f"\nGenerating {len(lengths)} prompts in length-sorted batches "
+                  f"(batch size <= {args.batch_size})...")
+            start = time.monotonic()
+            failed = generate(lengths, False, "Generating")
+            elapsed = time.monotonic() - start
+            print(f"Throughput: {len(lengths) / elapsed:.2f} items/s "
+                  f"({len(lengths) - failed} ok, {failed} without a description in {elapsed:.1f}s)")
+
+        # 主流程结束后用采样重试死信队列，每轮一个新的采样结果（缓存键含轮次）
+        if len(dead_letters) and not args.no_retry_pass:
+            print(f"\nRetrying {len(dead_letters)} dead-lettered items with sampling "
+                  f"(attempts={args.retry_attempts}, temperature={RETRY_TEMPERATURE})...")
+            for attempt in range(1, args.retry_attempts + 1):
+                if not len(dead_letters):
+                    break
+                retry_params = {**params, "do_sample": True, "temperature": RETRY_TEMPERATURE, "attempt": attempt}
+                generate(lookup(dead_letters.keys(), retry_params), True, f"Retrying ({attempt})")
+            print(f"Retry pass: {dead_letters.recovered} recovered, {len(dead_letters)} still failing")
+
+        checkpoint.close()
+        print(f"\nDone! Generated {checkpoint.count} training samples")
+        if args.no_compact:
+            print(f"Output saved to: {checkpoint.path}")
+        else:
+            checkpoint.compact(output_path)
+            print(f"Output saved to: {output_path}")
+        print(dead_letters.summary())
+        print(cache.summary())
+        print(telemetry.summary())
+    finally:
+        checkpoint.close()
+        dead_letters.close()
+        if cache is not None:
+            cache.close()
+        if telemetry is not None:
+            telemetry.close()
+
+if __name__ == "__main__":
+    main()
@@ -5,21 +5,32 @@
 读取原始提示词，调用本地 Ollama 模型为每条生成简单的中文描述
 """
 
-import json
+import re
 import asyncio
-import aiohttp
-import pandas as pd
+from contextlib import AsyncExitStack
 from pathlib import Path
-from tqdm import tqdm
+
+from checkpoint import JsonlCheckpoint, journal_path
+from corpus import load_corpus
+from dead_letter import DeadLetterQueue, add_dead_letter_args, dead_letter_path, retry_pass
+from dedup import add_dedup_args, dedup_corpus
+from llm_client import LLMClient, add_client_args, open_client
+from packing import Packer, add_pack_args, run_packed
+from pipeline import run_pipeline
+from shards import add_shard_args, shard_output_path, write_manifest
+from token_budget import add_budget_args, dry_run, truncate_tokens
 
 # 配置
 BASE_DIR = Path(__file__).parent.parent
 RAW_DATA_PATH = BASE_DIR / "data/raw/NanoBananaProPrompts.xlsx"
 OUTPUT_PATH = BASE_DIR / "data/processed/raw_training_data.json"
 
-OLLAMA_URL = "http://localhost:11434/api/generate"
 MODEL = "qwen2.5-coder:latest"  # 使用 qwen2.5-coder（不会输出思考过程）
 
+MAX_TOKENS = 100
+TEMPERATURE = 0.7
+MAX_PROMPT_TOKENS = 1000  # 输入提示词的 token 上限（为系统提示词和输出留出 2048 上下文）
+
 # 系统提示词
 SYSTEM_PROMPT = """你是一个专业的提示词分析专家。分析图像生成提示词，输出简洁中文描述。
 
@@ -30,149 +41,243 @@ SYSTEM_PROMPT = """你是一个专业的提示词分析专家。分析图像生
 4. 不含技术参数
 5. 只输出描述，无解释"""
 
+# 打包模式的用户消息开头，后接编号的提示词
+PACKED_HEADER = "为以下 {count} 条图像提示词分别生成简洁中文描述（10-30字）："
+PACKED_EXAMPLE = '{"1": "霓虹街头的赛博朋克女孩", "2": "咖啡馆里看书的文艺女生"}'
+# 默认上下文只有 2048，打包的输入预算和条数都要小一些
+PACK_TOKENS = 1000
+PACK_MAX = 8
+
+
+def strip_think(response: str) -> str:
+    """移除 <think> 标签内容（含未闭合的思考块）"""
+    response = re.sub(r'<think>.*?</think>', '', response, flags=re.DOTALL)
+    return re.sub(r'<think>.*', '', response, flags=re.DOTALL)
+
+
+def match_description(line: str) -> str | None:
+    """判断一行是否为有效描述，返回去掉引号和前缀后的内容"""
+    line = line.strip()
+    # 跳过空行、思考内容、标签
+    if not line or line.startswith('<') or line.startswith('思考') or line.startswith('接下来'):
+        return None
+    # 移除可能的引号和前缀
+    line = line.strip('"\'')
+    line = re.sub(r'^(描述：|输出：|答案：)', '', line)
+    if 5 <= len(line) <= 60:
+        return line
+    return None
+
+
+def clean_response(response: str) -> str | None:
+    """清理模型输出，提取描述行"""
+    lines = strip_think(response).split('\n')
+    for line in lines:
+        description = match_description(line)
+        if description:
+            return description
+    # 如果没找到合适的行，返回清理后的第一行
+    cleaned = [l.strip('"\'') for l in lines if l.strip() and not l.startswith('<')]
+    return cleaned[0] if cleaned else None
+
+
+def has_description(partial: str) -> bool:
+    """流式判定：思考块之外已出现一条完整（以换行结束）的有效描述行"""
+    lines = strip_think(partial).split('\n')
+    # 最后一段可能还没生成完
+    return any(match_description(line) for line in lines[:-1])
+
+
+def build_user_prompt(prompt: str) -> str:
+    """构造用户消息"""
+    return f"""为以下图像提示词生成简洁中文描述（10-30字）：
+
+{truncate_tokens(prompt, MAX_PROMPT_TOKENS, "ollama", MODEL)}
+
+直接输出描述："""
+
+
+def build_slot(prompt: str) -> str:
+    """打包模式中单条提示词的槽位内容"""
+    return truncate_tokens(prompt, MAX_PROMPT_TOKENS, "ollama", MODEL)
+
+
+def valid_description(value) -> str | None:
+    """校验打包结果中的一个槽位"""
+    return match_description(value) if isinstance(value, str) and "\n" not in value else None
+
 
 async def generate_description(
-    session: aiohttp.ClientSession,
+    client: LLMClient,
     prompt: str,
     prompt_type: str,
-    semaphore: asyncio.Semaphore,
-    max_retries: int = 3
+    stream: bool = True
 ) -> str | None:
-    """调用 Ollama API 生成简单描述"""
+    """调用 Ollama API 生成简单描述
+
+    stream 为 True 时边生成边解析，拿到第一条有效描述行就中止生成，
+    省掉后续多余的解码（对会输出思考过程的模型尤其明显）。
+    """
     
-    user_prompt = f"""为以下图像提示词生成简洁中文描述（10-30字）：
+    user_prompt = build_user_prompt(prompt)
+    # 缓存的是模型原始输出，清理逻辑调整后回放仍然有效；
+    # 提前中止的输出包含完整的第一条有效行，与完整输出的清理结果一致，共用缓存
+    response = await client.complete(
+        SYSTEM_PROMPT, user_prompt, max_tokens=MAX_TOKENS, temperature=TEMPERATURE,
+        stop_when=has_description if stream else None
+    )
+    if not response:
+        return None
+    return clean_response(response)
 
-{prompt[:2000]}
 
-直接输出描述："""
-
-    async with semaphore:
-        for attempt in range(max_retries):
-            try:
-                async with session.post(
-                    OLLAMA_URL,
-                    json={
-                        "model": MODEL,
-                        "prompt": f"{SYSTEM_PROMPT}\n\n{user_prompt}",
-                        "stream": False,
-                        "options": {
-                            "temperature": 0.7,
-                            "num_predict": 100
-                        }
-                    },
-                    timeout=aiohttp.ClientTimeout(total=60)
-                ) as resp:
-                    if resp.status == 200:
-                        result = await resp.json()
-                        response = result.get("response", "").strip()
-                        # 清理输出
-                        # 移除 <think> 标签内容
-                        import re
-                        response = re.sub(r'<think>.*?</think>', '', response, flags=re.DOTALL)
-                        response = re.sub(r'<think>.*', '', response, flags=re.DOTALL)
-                        
-                        lines = response.split('\n')
-                        for line in lines:
-                            line = line.strip()
-                            # 跳过空行、思考内容、标签
-                            if not line or line.startswith('<') or line.startswith('思考') or line.startswith('接下来'):
-                                continue
-                            # 移除可能的引号和前缀
-                            line = line.strip('"\'')
-                            line = re.sub(r'^(描述：|输出：|答案：)', '', line)
-                            if 5 <= len(line) <= 60:
-                                return line
-                        # 如果没找到合适的行，返回清理后的第一行
-                        cleaned = [l.strip('"\'') for l in lines if l.strip() and not l.startswith('<')]
-                        return cleaned[0] if cleaned else None
-            except Exception as e:
-                if attempt == max_retries - 1:
-                    print(f"Error: {e}")
-                    return None
-                await asyncio.sleep(1)
-    return None
+async def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="调用本地 Ollama 为原始提示词生成简单描述")
+    add_client_args(parser, "ollama")
+    parser.add_argument("--no-compact", action="store_true",
+                        help="结束时不把 JSONL 日志压缩成 JSON（下游直接读日志）")
+    parser.add_argument("--no-stream", action="store_true",
+                        help="关闭流式提前中止，等待模型完整输出")
+    add_budget_args(parser)
+    add_dedup_args(parser, threshold=0.9, ngram=5)
+    add_shard_args(parser)
+    add_dead_letter_args(parser)
+    add_pack_args(parser, tokens=PACK_TOKENS, max_items=PACK_MAX)
+    args = parser.parse_args()
+    # 分片运行时使用独立的输出和断点日志
+    output_path = shard_output_path(OUTPUT_PATH, args.shard)
 
+    # 任何退出路径都由 stack 关闭客户端、断点日志和死信队列
+    async with AsyncExitStack() as stack:
+        client = open_client(args, "ollama", MODEL)
+        stack.push_async_callback(client.close)
 
-async def main():
-    # 检查 Ollama 是否运行
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get("http://localhost:11434/api/tags") as resp:
-                if resp.status != 200:
-                    print("Error: Ollama is not running")
-                    print("Please start Ollama: ollama serve")
-                    return
-    except Exception:
-        print("Error: Cannot connect to Ollama")
-        print("Please start Ollama: ollama serve")
-        return
-    
-    # 读取原始数据
-    print(f"Reading data from {RAW_DATA_PATH}")
-    df = pd.read_excel(RAW_DATA_PATH, header=2)
-    print(f"Loaded {len(df)} prompts")
-    
-    # 过滤掉空数据
-    df = df.dropna(subset=['prompt'])
-    print(f"After filtering: {len(df)} valid prompts")
-    
-    # 检查是否已有部分处理结果
-    existing_data = []
-    processed_indices = set()
-    if OUTPUT_PATH.exists():
-        with open(OUTPUT_PATH, 'r', encoding='utf-8') as f:
-            existing_data = json.load(f)
-            processed_indices = {item['original_index'] for item in existing_data}
-        print(f"Found {len(existing_data)} already processed items")
-    
-    # 过滤已处理的数据
-    remaining_indices = [i for i in range(len(df)) if i not in processed_indices]
-    print(f"Remaining to process: {len(remaining_indices)} items")
-    
-    if not remaining_indices:
-        print("All items already processed!")
-        return
-    
-    # 并发控制
-    semaphore = asyncio.Semaphore(3)  # Ollama 本地运行，限制并发
-    
-    # 处理数据
-    all_results = existing_data.copy()
-    
-    print(f"\nProcessing {len(remaining_indices)} prompts using {MODEL}...")
-    
-    async with aiohttp.ClientSession() as session:
-        for idx in tqdm(remaining_indices, desc="Generating"):
-            row = df.iloc[idx]
-            
-            result = await generate_description(
-                session,
+        # 检查 Ollama 是否运行（只读回放和 dry-run 不发请求，跳过检查）
+        if args.cache_mode != "replay" and not args.dry_run and not await client.health_check():
+            print("Error: Cannot connect to Ollama")
+            print("Please start Ollama: ollama serve")
+            return
+    
+        # 读取原始数据（内存映射的列式缓存，工作簿变化时自动重新转换）
+        print(f"Reading data from {RAW_DATA_PATH}")
+        corpus = load_corpus(RAW_DATA_PATH)
+        print(f"Loaded {len(corpus)} valid prompts")
+    
+        # 检查是否已有部分处理结果（一次流式扫描断点日志）
+        checkpoint = JsonlCheckpoint(journal_path(output_path))
+        stack.callback(checkpoint.close)
+        processed_indices = checkpoint.resume(legacy_json=output_path)
+        if checkpoint.count:
+            print(f"Found {checkpoint.count} already processed items")
+    
+        # 近似重复的提示词只生成一次
+        duplicates = set()
+        if not args.no_dedup:
+            duplicates = dedup_corpus(corpus, args.dedup_threshold, args.dedup_ngram)
+    
+        # 本分片负责的数据（不分片时为全部）
+        assigned = [
+            i for i in range(len(corpus))
+            if i not in duplicates and (args.shard is None or args.shard.owns(i))
+        ]
+        if args.shard:
+            print(f"Shard {args.shard}: {len(assigned)} items")
+            write_manifest(output_path, args.shard, assigned)
+    
+        # 过滤已处理的数据；之前失败的数据在死信队列中，留到最后统一重试
+        dead_letters = DeadLetterQueue(dead_letter_path(output_path), "generate")
+        stack.callback(dead_letters.close)
+        if len(dead_letters):
+            print(f"Found {len(dead_letters)} dead-lettered items")
+        remaining_indices = [
+            i for i in assigned if i not in processed_indices and i not in dead_letters
+        ]
+        if args.retry_only:
+            remaining_indices = []
+        print(f"Remaining to process: {len(remaining_indices)} items")
+    
+        if not remaining_indices and (not len(dead_letters) or args.no_retry_pass):
+            print("All items already processed!")
+            if not args.no_compact:
+                checkpoint.compact(output_path)
+            return
+    
+        packer = Packer(
+            client, SYSTEM_PROMPT, PACKED_HEADER, "对应的中文描述字符串", PACKED_EXAMPLE,
+            MAX_TOKENS, valid_description, temperature=TEMPERATURE,
+            token_budget=args.pack_tokens, max_items=args.pack_max
+        )
+    
+        def slots(indices: list[int]) -> list[tuple[int, str]]:
+            return [(idx, build_slot(corpus.prompt(idx))) for idx in indices]
+    
+        if args.dry_run:
+            if args.pack:
+                requests = packer.requests_for(packer.plan(slots(remaining_indices)))
+            else:
+                requests = (
+                    (SYSTEM_PROMPT, build_user_prompt(corpus.prompt(idx)), MAX_TOKENS, TEMPERATURE)
+                    for idx in remaining_indices
+                )
+            print(dry_run(client, requests, args.rpm, args.tpm))
+            return
+    
+        async def work(idx: int) -> str | None:
+            row = corpus.row(idx)
+            return await generate_description(
+                client,
                 row['prompt'],
                 row['prompt_type'],
-                semaphore
+                stream=not args.no_stream
             )
-            
+    
+        def sink(idx: int, result: str | None):
             if result:
-                all_results.append({
+                # 按输入顺序每完成一条追加一行（断点续传）
+                row = corpus.row(idx)
+                checkpoint.append({
                     "simple_description": result,
                     "prompt": row['prompt'],
                     "prompt_type": row['prompt_type'],
                     "original_index": idx
                 })
-            
-            # 每 20 条保存一次
-            if len(all_results) % 20 == 0:
-                OUTPUT_PATH.parent.mkdir(parents=True, exist_ok=True)
-                with open(OUTPUT_PATH, 'w', encoding='utf-8') as f:
-                    json.dump(all_results, f, ensure_ascii=False, indent=2)
-    
-    # 最终保存
-    OUTPUT_PATH.parent.mkdir(parents=True, exist_ok=True)
-    with open(OUTPUT_PATH, 'w', encoding='utf-8') as f:
-        json.dump(all_results, f, ensure_ascii=False, indent=2)
-    
-    print(f"\nDone! Generated {len(all_results)} training samples")
-    print(f"Output saved to: {OUTPUT_PATH}")
+    
+        if args.pack and remaining_indices:
+            # 打包模式：校验失败的槽位拆出来按单条请求重新排队
+            print(f"\nProcessing {len(remaining_indices)} prompts in packed requests using {MODEL}...")
+            remaining_indices = await run_packed(
+                packer, slots(remaining_indices), sink,
+                client.limiter.max_limit, desc="Generating (packed)"
+            )
+    
+        if remaining_indices:
+            print(f"\nProcessing {len(remaining_indices)} prompts using {MODEL} "
+                  f"(concurrency={client.limiter.window}..{client.limiter.max_limit})...")
+            # worker 数取窗口上限，实际在途请求数由自适应限制器决定；
+            # 重试耗尽的数据进入死信队列，不拖慢后面的数据
+            stats = await run_pipeline(
+                remaining_indices, work, dead_letters.wrap(sink, "no description after retries"),
+                client.limiter.max_limit, desc="Generating"
+            )
+            print(f"Throughput: {stats['items_per_sec']:.2f} items/s "
+                  f"({stats['succeeded']} ok, {stats['failed']} failed in {stats['elapsed']:.1f}s)")
+    
+        # 主流程结束后低并发重试死信队列
+        if len(dead_letters) and not args.no_retry_pass:
+            await retry_pass(
+                dead_letters, dead_letters.keys(), work, sink, client,
+                args.retry_concurrency, args.retry_attempts, "no description after retries"
+            )
+    
+        print(dead_letters.summary())
+        print(f"\nDone! Generated {checkpoint.count} training samples")
+        if args.no_compact:
+            print(f"Output saved to: {checkpoint.path}")
+        else:
+            checkpoint.compact(output_path)
+            print(f"Output saved to: {output_path}")
+        print(client.summary())
 
 
 if __name__ == "__main__":
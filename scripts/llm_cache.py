@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""
+LLM 响应缓存
+
+按 (backend, model, system, prompt, params) 的内容哈希缓存模型原始输出，
+数据存放在 SQLite 中。支持命中统计、按总大小淘汰（最久未访问优先）
+以及只读回放模式：回放时未命中直接返回 None，不发起任何网络请求。
+
+用法：
+    python llm_cache.py stats            # 查看缓存统计
+    python llm_cache.py clear            # 清空缓存
+"""
+
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+
+# 配置
+BASE_DIR = Path(__file__).parent.parent
+DEFAULT_CACHE_PATH = BASE_DIR / "data/cache/llm_cache.sqlite"
+
+# 缓存模式
+#   readwrite: 命中直接返回，未命中调用模型并写入
+#   replay:    只读回放，未命中返回 None，不调用模型
+#   off:       完全绕过缓存
+CACHE_MODES = ("readwrite", "replay", "off")
+
+
+def make_cache_key(
+    backend: str,
+    model: str,
+    system: str,
+    prompt: str,
+    params: dict
+) -> str:
+    """根据请求内容计算缓存键"""
+    payload = json.dumps(
+        {
+            "backend": backend,
+            "model": model,
+            "system": system,
+            "prompt": prompt,
+            "params": params,
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """基于 SQLite 的内容寻址响应缓存"""
+
+    def __init__(
+        self,
+        path: Path = DEFAULT_CACHE_PATH,
+        mode: str = "readwrite",
+        max_bytes: Optional[int] = None
+    ):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown cache mode: {mode}")
+        self.path = Path(path)
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._conn = None
+        self._total_bytes = 0
+
+        if mode == "off":
+            return
+
+        if mode == "replay" and not self.path.exists():
+            print(f"Warning: cache file not found, replay will miss everything: {self.path}")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(str(self.path))
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                backend TEXT NOT NULL,
+                model TEXT NOT NULL,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses(accessed_at)"
+        )
+        self._conn.commit()
+        row = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+        self._total_bytes = row[0]
+
+    @property
+    def enabled(self) -> bool:
+        return self._conn is not None
+
+    def get(self, key: str) -> Optional[str]:
+        """读取缓存，未命中返回 None"""
+        if not self.enabled:
+            return None
+        row = self._conn.execute(
+            "SELECT response FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.mode == "readwrite":
+            self._conn.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key)
+            )
+            self._conn.commit()
+        return row[0]
+
+    def contains(self, key: str) -> bool:
+        """是否已缓存（不计入命中统计，不更新访问时间）"""
+        if not self.enabled:
+            return False
+        row = self._conn.execute(
+            "SELECT 1 FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        return row is not None
+
+    def put(self, key: str, backend: str, model: str, response: str):
+        """写入缓存（回放模式下忽略）"""
+        if not self.enabled or self.mode != "readwrite":
+            return
+        size = len(response.encode("utf-8"))
+        now = time.time()
+        old = self._conn.execute(
+            "SELECT size FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (key, backend, model, response, size, now, now),
+        )
+        self._conn.commit()
+        self._total_bytes += size - (old[0] if old else 0)
+        self.writes += 1
+        self._evict()
+
+    def _evict(self):
+        """超过容量上限时按最久未访问淘汰"""
+        if self.max_bytes is None or self._total_bytes <= self.max_bytes:
+            return
+        rows = self._conn.execute(
+            "SELECT key, size FROM responses ORDER BY accessed_at ASC"
+        )
+        to_delete = []
+        excess = self._total_bytes - self.max_bytes
+        for key, size in rows:
+            if excess <= 0:
+                break
+            to_delete.append((key,))
+            excess -= size
+            self._total_bytes -= size
+        self._conn.executemany("DELETE FROM responses WHERE key = ?", to_delete)
+        self._conn.commit()
+        self.evictions += len(to_delete)
+
+    async def get_or_call(
+        self,
+        backend: str,
+        model: str,
+        system: str,
+        prompt: str,
+        params: dict,
+        call: Callable[[], Awaitable[Optional[str]]]
+    ) -> Optional[str]:
+        """命中则返回缓存，否则调用 call() 并缓存非空结果"""
+        if not self.enabled:
+            return await call()
+        key = make_cache_key(backend, model, system, prompt, params)
+        cached = self.get(key)
+        if cached is not None:
+            return cached
+        if self.mode == "replay":
+            return None
+        response = await call()
+        if response:
+            self.put(key, backend, model, response)
+        return response
+
+    def stats(self) -> dict:
+        """命中统计"""
+        entries = 0
+        if self.enabled:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            "mode": self.mode,
+            "entries": entries,
+            "bytes": self._total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "writes": self.writes,
+            "evictions": self.evictions,
+        }
+
+    def summary(self) -> str:
+        s = self.stats()
+        return (
+            f"Cache [{s['mode']}]: {s['hits']} hits, {s['misses']} misses "
+            f"({s['hit_rate']:.1%}), {s['writes']} writes, {s['evictions']} evicted, "
+            f"{s['entries']} entries / {s['bytes'] / 1024 / 1024:.1f} MB"
+        )
+
+    def clear(self):
+        if not self.enabled:
+            return
+        self._conn.execute("DELETE FROM responses")
+        self._conn.commit()
+        self._conn.execute("VACUUM")
+        self._total_bytes = 0
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def add_cache_args(parser):
+    """为脚本添加缓存相关命令行参数"""
+    parser.add_argument("--cache-path", type=Path, default=DEFAULT_CACHE_PATH,
+                        help="响应缓存文件路径")
+    parser.add_argument("--cache-mode", choices=CACHE_MODES, default="readwrite",
+                        help="缓存模式: readwrite=读写, replay=只读回放(不发请求), off=关闭")
+    parser.add_argument("--cache-max-mb", type=float, default=None,
+                        help="缓存容量上限 (MB)，超出后淘汰最久未访问的条目")
+
+
+def open_cache(args) -> ResponseCache:
+    """根据命令行参数创建缓存"""
+    max_bytes = int(args.cache_max_mb * 1024 * 1024) if args.cache_max_mb else None
+    return ResponseCache(args.cache_path, mode=args.cache_mode, max_bytes=max_bytes)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="LLM 响应缓存管理")
+    parser.add_argument("command", choices=["stats", "clear"], help="stats=查看统计, clear=清空缓存")
+    parser.add_argument("--cache-path", type=Path, default=DEFAULT_CACHE_PATH, help="缓存文件路径")
+    args = parser.parse_args()
+
+    if not args.cache_path.exists():
+        print(f"Cache not found: {args.cache_path}")
+        return
+
+    cache = ResponseCache(args.cache_path)
+    if args.command == "clear":
+        cache.clear()
+        print(f"Cleared cache: {args.cache_path}")
+    else:
+        s = cache.stats()
+        print(f"Cache: {args.cache_path}")
+        print(f"Entries: {s['entries']}")
+        print(f"Size: {s['bytes'] / 1024 / 1024:.2f} MB")
+        rows = cache._conn.execute(
+            "SELECT backend, model, COUNT(*), SUM(size) FROM responses GROUP BY backend, model"
+        ).fetchall()
+        for backend, model, count, size in rows:
+            print(f"  {backend}/{model}: {count} entries, {size / 1024:.1f} KB")
+    cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,585 @@
+#!/usr/bin/env python3
+"""
+统一的异步 LLM 客户端
+
+三个生成脚本共用的调用层：
+- 连接池：Anthropic 复用 SDK 自带的 keep-alive 连接池，Ollama 复用一个 aiohttp 会话
+- 令牌桶：按每分钟请求数 (RPM) 和每分钟 token 数 (TPM) 限速
+- 重试：full jitter 退避，服务端给出 retry-after 时以其为准
+- 超时：按后端分别设置
+- 并发：AIMD 自适应限制器；缓存：命中时不发请求
+- 流式：Ollama 逐 token 解析，调用方判定输出已够用时立即断开
+- 遥测：每次调用记录排队、首字节、延迟、token 和重试（见 telemetry.py）
+- 前缀复用：Anthropic 系统提示词标记 cache_control；Ollama 走 system 字段并用 keep_alive 保持模型常驻，
+  固定的系统提示词前缀不再每次重新计算。
+  注意 Anthropic 只缓存不短于 1024 token（Haiku 为 2048）的前缀，目前各脚本的系统提示词都不到这个长度，
+  cache_control 暂不生效、不节省费用（运行时会给出提示），系统提示词变长后自动生效。
+  Ollama 的复用量由真实分词器数出的完整输入减去 prompt_eval_count 得到，没有分词器时记为未知
+"""
+
+import asyncio
+import json
+import os
+import random
+import time
+from typing import Callable, NamedTuple, Optional
+
+import aiohttp
+import anthropic
+
+from adaptive_limiter import (
+    AdaptiveLimiter, OverloadError, add_limiter_args, is_overload_status,
+    open_limiter, parse_retry_after,
+)
+from llm_cache import ResponseCache, add_cache_args, make_cache_key, open_cache
+from ollama_pool import OllamaHostPool
+from telemetry import Telemetry, add_telemetry_args, open_telemetry
+from token_budget import estimate_tokens, ollama_prompt_tokens
+
+# 各后端默认配置
+DEFAULT_TIMEOUTS = {
+    "anthropic": 60.0,
+    "ollama": 60.0,
+}
+DEFAULT_OLLAMA_HOST = "http://localhost:11434"
+DEFAULT_KEEP_ALIVE = "30m"  # Ollama 模型常驻时间，期间系统提示词前缀的 KV 可复用
+
+# 重试退避参数（秒）
+BACKOFF_BASE = 1.0
+BACKOFF_CAP = 30.0
+
+
+class RequestError(RuntimeError):
+    """请求本身有误（4xx：模型不存在、参数错误等），重试或换主机都不会成功"""
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+class Completion(NamedTuple):
+    """一次模型调用的结果"""
+    text: str
+    input_tokens: int
+    output_tokens: int
+    ttfb: Optional[float] = None           # 首字节时间（秒）
+    eval_duration: Optional[float] = None  # 后端报告的解码耗时（秒）
+    cache_read_tokens: Optional[int] = 0   # 命中前缀缓存的输入 token（不含在 input_tokens 内），None 表示未知
+    cache_write_tokens: int = 0            # 写入前缀缓存的输入 token（不含在 input_tokens 内）
+
+
+def prompt_cache_min_tokens(model: str) -> int:
+    """Anthropic 可缓存前缀的最小长度，低于此长度时 cache_control 不生效"""
+    return 2048 if "haiku" in model else 1024
+
+
+def full_jitter(attempt: int, base: float = BACKOFF_BASE, cap: float = BACKOFF_CAP) -> float:
+    """full jitter 退避：在 [0, min(cap, base * 2^attempt)] 内均匀取值"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class TokenBucket:
+    """令牌桶，按每分钟速率连续补充，容量为一分钟的额度"""
+
+    def __init__(self, rate_per_min: float):
+        self.capacity = float(rate_per_min)
+        self.rate = rate_per_min / 60.0
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def take(self, amount: float):
+        """取出 amount 个令牌，不足时等待（先到先得）"""
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    def adjust(self, delta: float):
+        """按实际用量修正：delta > 0 退还，delta < 0 追扣（允许欠额）"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + delta)
+
+
+class RateLimiter:
+    """RPM + TPM 双令牌桶"""
+
+    def __init__(self, rpm: Optional[float] = None, tpm: Optional[float] = None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+
+    async def acquire(self, estimated_tokens: int):
+        if self.requests:
+            await self.requests.take(1)
+        if self.tokens:
+            await self.tokens.take(estimated_tokens)
+
+    def settle(self, estimated_tokens: int, actual_tokens: int):
+        """请求完成后按实际 token 数修正"""
+        if self.tokens:
+            self.tokens.adjust(estimated_tokens - actual_tokens)
+
+
+class LLMClient:
+    """后端无关的调用逻辑：缓存 → 限速 → 并发控制 → 请求 → 重试"""
+
+    backend = ""
+
+    def __init__(
+        self,
+        model: str,
+        limiter: AdaptiveLimiter,
+        cache: ResponseCache,
+        rate_limiter: Optional[RateLimiter] = None,
+        timeout: Optional[float] = None,
+        max_retries: int = 3,
+        telemetry: Optional[Telemetry] = None
+    ):
+        self.model = model
+        self.limiter = limiter
+        self.cache = cache
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.timeout = timeout or DEFAULT_TIMEOUTS[self.backend]
+        self.max_retries = max_retries
+        self.telemetry = telemetry or Telemetry(None)
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cache_read_tokens = 0
+        self.cache_write_tokens = 0
+        self.cache_reads_unknown = 0  # 无法得知缓存命中量的请求数
+
+    async def complete(
+        self,
+        system: str,
+        prompt: str,
+        max_tokens: int,
+        temperature: Optional[float] = None,
+        stop_when: Optional[Callable[[str], bool]] = None
+    ) -> Optional[str]:
+        """生成文本；重试耗尽返回 None
+
+        stop_when: 流式生成时对已累积的文本调用，返回 True 即中止生成
+        （仅 Ollama 支持；提前中止的输出同样写入缓存，调用方解析结果不变）
+        """
+        params = self._cache_params(max_tokens, temperature)
+
+        async def call() -> Optional[str]:
+            return await self._call_with_retries(
+                system, prompt, max_tokens, temperature, stop_when
+            )
+
+        return await self.cache.get_or_call(
+            self.backend, self.model, system, prompt, params, call
+        )
+
+    def cache_key(
+        self,
+        system: str,
+        prompt: str,
+        max_tokens: int,
+        temperature: Optional[float] = None
+    ) -> str:
+        """与 complete() 相同口径的缓存键"""
+        return make_cache_key(
+            self.backend, self.model, system, prompt,
+            self._cache_params(max_tokens, temperature)
+        )
+
+    def _cache_params(self, max_tokens: int, temperature: Optional[float]) -> dict:
+        """参与缓存键的采样参数"""
+        params = {"max_tokens": max_tokens}
+        if temperature is not None:
+            params["temperature"] = temperature
+        return params
+
+    async def _call_with_retries(
+        self,
+        system: str,
+        prompt: str,
+        max_tokens: int,
+        temperature: Optional[float],
+        stop_when: Optional[Callable[[str], bool]] = None
+    ) -> Optional[str]:
+        estimated = estimate_tokens(system) + estimate_tokens(prompt) + max_tokens
+        started = time.time()
+        queue_wait = 0.0  # 各次尝试等待限速和并发名额的总时间，不含退避
+        for attempt in range(self.max_retries):
+            waiting = time.monotonic()
+            sent = None
+            try:
+                await self.rate_limiter.acquire(estimated)
+                # 每次尝试单独占用一个名额，退避期间不占用
+                async with self.limiter.slot():
+                    sent = time.monotonic()
+                    queue_wait += sent - waiting
+                    self.requests += 1
+                    completion = await self._request(
+                        system, prompt, max_tokens, temperature, stop_when
+                    )
+                    latency = time.monotonic() - sent
+                self.input_tokens += completion.input_tokens
+                self.output_tokens += completion.output_tokens
+                if completion.cache_read_tokens is None:
+                    self.cache_reads_unknown += 1
+                else:
+                    self.cache_read_tokens += completion.cache_read_tokens
+                self.cache_write_tokens += completion.cache_write_tokens
+                self.rate_limiter.settle(
+                    estimated, completion.input_tokens + completion.output_tokens
+                )
+                self.telemetry.record(
+                    self.backend, self.model, "ok", started,
+                    queue_wait=queue_wait,
+                    ttfb=completion.ttfb,
+                    latency=latency,
+                    input_tokens=completion.input_tokens,
+                    output_tokens=completion.output_tokens,
+                    eval_duration=completion.eval_duration,
+                    cache_read_tokens=completion.cache_read_tokens,
+                    cache_write_tokens=completion.cache_write_tokens,
+                    retries=attempt
+                )
+                return completion.text
+            except Exception as e:
+                # 4xx 是请求本身的问题，不再重试
+                if isinstance(e, RequestError) or attempt == self.max_retries - 1:
+                    self.failures += 1
+                    print(f"Error after {attempt + 1} attempts: {e}")
+                    self.telemetry.record(
+                        self.backend, self.model, "failed", started,
+                        queue_wait=queue_wait,
+                        latency=time.monotonic() - sent if sent else None,
+                        retries=attempt,
+                        error=str(e)
+                    )
+                    return None
+                self.retries += 1
+                await asyncio.sleep(getattr(e, "retry_after", None) or full_jitter(attempt))
+        return None
+
+    async def _request(
+        self,
+        system: str,
+        prompt: str,
+        max_tokens: int,
+        temperature: Optional[float],
+        stop_when: Optional[Callable[[str], bool]] = None
+    ) -> Completion:
+        raise NotImplementedError
+
+    async def close(self):
+        self.cache.close()
+        self.telemetry.close()
+
+    def prompt_cache_summary(self) -> str:
+        """输入 token 中命中前缀缓存和未命中的数量"""
+        total = self.input_tokens + self.cache_read_tokens + self.cache_write_tokens
+        ratio = self.cache_read_tokens / total if total else 0.0
+        summary = (
+            f"Prompt cache: {self.cache_read_tokens} cached / "
+            f"{self.input_tokens + self.cache_write_tokens} uncached input tokens ({ratio:.1%} cached), "
+            f"{self.cache_write_tokens} written"
+        )
+        if self.cache_reads_unknown:
+            summary += f"; cached tokens unknown for {self.cache_reads_unknown} requests (no tokenizer for {self.model})"
+        return summary
+
+    def summary(self) -> str:
+        return "\n".join([
+            f"Client [{self.backend}/{self.model}]: {self.requests} requests, "
+            f"{self.retries} retries, {self.failures} failed, "
+            f"{self.input_tokens} input / {self.output_tokens} output tokens",
+            self.prompt_cache_summary(),
+            self.limiter.summary(),
+            self.cache.summary(),
+            self.telemetry.summary(),
+        ])
+
+
+class AnthropicClient(LLMClient):
+    """Claude Messages API"""
+
+    backend = "anthropic"
+
+    def __init__(
+        self,
+        model: str,
+        api_key: Optional[str],
+        prompt_cache: bool = True,
+        **kwargs
+    ):
+        super().__init__(model, **kwargs)
+        # 关闭 SDK 内置重试，让限制器看到 429/5xx；只读回放模式下没有 Key 也不会发请求
+        self.sdk = anthropic.AsyncAnthropic(
+            api_key=api_key, max_retries=0, timeout=self.timeout
+        ) if api_key else None
+        self.prompt_cache = prompt_cache
+        self._short_prefixes = set()
+
+    def system_param(self, system: str):
+        """系统提示词参数：开启前缀缓存时作为带 cache_control 的文本块（批处理同样适用）"""
+        if not self.prompt_cache:
+            return system
+        if estimate_tokens(system) < prompt_cache_min_tokens(self.model) and system not in self._short_prefixes:
+            self._short_prefixes.add(system)
+            print(f"Warning: system prompt is ~{estimate_tokens(system)} tokens, below the "
+                  f"{prompt_cache_min_tokens(self.model)}-token minimum for prompt caching on "
+                  f"{self.model}; it will be sent uncached")
+        return [{"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}]
+
+    def _overload(self, e: Exception) -> Optional[OverloadError]:
+        """429 / 5xx / 超时转换为 OverloadError，带上 retry-after"""
+        if isinstance(e, anthropic.APITimeoutError):
+            return OverloadError(str(e))
+        if isinstance(e, anthropic.APIStatusError) and is_overload_status(e.status_code):
+            retry_after = parse_retry_after(e.response.headers.get("retry-after"))
+            return OverloadError(str(e), e.status_code, retry_after)
+        return None
+
+    async def _request(self, system, prompt, max_tokens, temperature, stop_when=None) -> Completion:
+        # Messages API 一次返回完整结果，stop_when 不生效，也没有单独的首字节时间
+        kwargs = {}
+        if temperature is not None:
+            kwargs["temperature"] = temperature
+        try:
+            message = await self.sdk.messages.create(
+                model=self.model,
+                max_tokens=max_tokens,
+                system=self.system_param(system),
+                messages=[
+                    {
+                        "role": "user",
+                        "content": prompt
+                    }
+                ],
+                **kwargs
+            )
+        except anthropic.APIError as e:
+            overload = self._overload(e)
+            if overload:
+                raise overload from e
+            if isinstance(e, anthropic.APIStatusError) and 400 <= e.status_code < 500:
+                raise RequestError(str(e), e.status_code) from e
+            raise
+        return Completion(
+            message.content[0].text.strip(),
+            message.usage.input_tokens,
+            message.usage.output_tokens,
+            cache_read_tokens=message.usage.cache_read_input_tokens or 0,
+            cache_write_tokens=message.usage.cache_creation_input_tokens or 0,
+        )
+
+    async def close(self):
+        if self.sdk is not None:
+            await self.sdk.close()
+        await super().close()
+
+
+class OllamaClient(LLMClient):
+    """Ollama /api/generate，支持多主机负载均衡"""
+
+    backend = "ollama"
+
+    def __init__(
+        self,
+        model: str,
+        hosts: Optional[list[str]] = None,
+        keep_alive: str = DEFAULT_KEEP_ALIVE,
+        **kwargs
+    ):
+        super().__init__(model, **kwargs)
+        self.pool = OllamaHostPool(hosts or [DEFAULT_OLLAMA_HOST])
+        self.keep_alive = keep_alive
+        self.early_stops = 0
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """懒加载的 keep-alive 会话，连接数与并发上限一致"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limiter.max_limit, keepalive_timeout=60
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    def _cache_params(self, max_tokens, temperature) -> dict:
+        # 与 Ollama 的 options 保持一致
+        params = {"num_predict": max_tokens}
+        if temperature is not None:
+            params["temperature"] = temperature
+        return params
+
+    async def health_check(self) -> bool:
+        """检查所有 Ollama 主机，至少一台可用时启动后台探测"""
+        ok = await self.pool.check_all(self.session)
+        if ok:
+            self.pool.start_monitor(self.session)
+        return ok
+
+    async def _request(self, system, prompt, max_tokens, temperature, stop_when=None) -> Completion:
+        host = self.pool.acquire()
+        start = time.monotonic()
+        outcome = "error"
+        try:
+            async with self.session.post(
+                f"{host.url}/api/generate",
+                json={
+                    "model": self.model,
+                    # 系统提示词单独传入，模板中位于最前面，各请求共享同一前缀
+                    "system": system,
+                    "prompt": prompt,
+                    "stream": stop_when is not None,
+                    "keep_alive": self.keep_alive,
+                    "options": self._cache_params(max_tokens, temperature)
+                },
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            ) as resp:
+                if resp.status in (429, 503):
+                    outcome = "busy"
+                if is_overload_status(resp.status):
+                    raise OverloadError(
+                        f"HTTP {resp.status} from {host.url}",
+                        resp.status,
+                        parse_retry_after(resp.headers.get("Retry-After"))
+                    )
+                if 400 <= resp.status < 500:
+                    # 主机正常响应，只是请求本身有误，不计入主机的连续失败
+                    outcome = "rejected"
+                    raise RequestError(f"HTTP {resp.status} from {host.url}: {await resp.text()}", resp.status)
+                if resp.status != 200:
+                    raise RuntimeError(f"HTTP {resp.status} from {host.url}: {await resp.text()}")
+                if stop_when is None:
+                    ttfb = time.monotonic() - start
+                    result = await resp.json()
+                else:
+                    result, ttfb = await self._read_stream(resp, stop_when, start)
+                outcome = "ok"
+        except asyncio.TimeoutError as e:
+            raise OverloadError(f"Request to {host.url} timed out") from e
+        finally:
+            self.pool.release(host, outcome, time.monotonic() - start)
+        text = result.get("response", "")
+        # eval_duration 单位为纳秒；提前中止时没有
+        eval_duration = result.get("eval_duration")
+        # prompt_eval_count 只统计实际计算的输入 token，复用的前缀不计入；
+        # Ollama 不直接报告复用量，用真实分词器数出套模板后的完整输入，差值即复用量。
+        # 没有分词器时字符估算和真实 token 数不可比，复用量记为未知
+        prompt_tokens = ollama_prompt_tokens(self.model, system, prompt)
+        evaluated = result.get("prompt_eval_count")
+        if evaluated is None:
+            input_tokens = prompt_tokens or estimate_tokens(system) + estimate_tokens(prompt)
+            cache_read = 0 if prompt_tokens is not None else None
+        else:
+            input_tokens = evaluated
+            cache_read = max(0, prompt_tokens - evaluated) if prompt_tokens is not None else None
+        return Completion(
+            text.strip(),
+            input_tokens,
+            result.get("eval_count") or estimate_tokens(text),
+            ttfb,
+            eval_duration / 1e9 if eval_duration else None,
+            cache_read_tokens=cache_read,
+        )
+
+    async def _read_stream(
+        self,
+        resp: aiohttp.ClientResponse,
+        stop_when,
+        start: float
+    ) -> tuple[dict, Optional[float]]:
+        """逐行读取 NDJSON 流，返回 (最终结果, 首字节时间)；
+        stop_when 满足时断开连接，Ollama 随之停止生成"""
+        text = ""
+        ttfb = None
+        async for line in resp.content:
+            if not line.strip():
+                continue
+            if ttfb is None:
+                ttfb = time.monotonic() - start
+            chunk = json.loads(line)
+            text += chunk.get("response", "")
+            if chunk.get("done"):
+                chunk["response"] = text
+                return chunk, ttfb
+            # 只在出现换行时判定，避免每个 token 都重新解析
+            if "\n" in chunk.get("response", "") and stop_when(text):
+                self.early_stops += 1
+                resp.close()
+                return {"response": text}, ttfb
+        raise RuntimeError("Ollama stream ended before completion")
+
+    async def close(self):
+        await self.pool.close()
+        if self._session is not None:
+            await self._session.close()
+        await super().close()
+
+    def summary(self) -> str:
+        lines = [super().summary()]
+        if self.early_stops:
+            lines.append(f"Streaming: {self.early_stops} generations stopped early")
+        lines.append(self.pool.summary())
+        return "\n".join(lines)
+
+
+def add_client_args(parser, backend: str):
+    """为脚本添加客户端参数（含缓存和并发控制）"""
+    add_cache_args(parser)
+    add_telemetry_args(parser)
+    if backend == "ollama":
+        # 默认按主机数放大：每台初始 3、上限 8（建议与 OLLAMA_NUM_PARALLEL 一致）
+        add_limiter_args(parser, initial=None, max_limit=None)
+    else:
+        add_limiter_args(parser, initial=5, max_limit=32)
+    parser.add_argument("--rpm", type=float, default=None, help="每分钟请求数上限")
+    parser.add_argument("--tpm", type=float, default=None, help="每分钟 token 数上限（输入+输出）")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUTS[backend],
+                        help="单次请求超时（秒）")
+    parser.add_argument("--max-retries", type=int, default=3, help="每条数据最多尝试次数")
+    if backend == "ollama":
+        parser.add_argument("--ollama-host", action="append", dest="ollama_hosts",
+                            help=f"Ollama 服务地址，可重复指定多台主机（默认 {DEFAULT_OLLAMA_HOST}）")
+        parser.add_argument("--keep-alive", default=DEFAULT_KEEP_ALIVE,
+                            help="Ollama 模型常驻时间（如 30m、1h，-1m 表示一直常驻），期间复用系统提示词前缀")
+    else:
+        parser.add_argument("--no-prompt-cache", action="store_true",
+                            help="不给系统提示词标记 cache_control")
+
+
+def open_client(args, backend: str, model: str) -> LLMClient:
+    """根据命令行参数创建客户端"""
+    if backend == "ollama":
+        hosts = len(args.ollama_hosts or [DEFAULT_OLLAMA_HOST])
+        if args.concurrency is None:
+            args.concurrency = 3 * hosts
+        if args.max_concurrency is None:
+            args.max_concurrency = 8 * hosts
+    kwargs = {
+        "limiter": open_limiter(args, name=backend),
+        "cache": open_cache(args),
+        "rate_limiter": RateLimiter(args.rpm, args.tpm),
+        "timeout": args.timeout,
+        "max_retries": args.max_retries,
+        "telemetry": open_telemetry(args),
+    }
+    if backend == "anthropic":
+        return AnthropicClient(
+            model, api_key=os.environ.get("ANTHROPIC_API_KEY"),
+            prompt_cache=not args.no_prompt_cache, **kwargs
+        )
+    if backend == "ollama":
+        return OllamaClient(model, hosts=args.ollama_hosts, keep_alive=args.keep_alive, **kwargs)
+    raise ValueError(f"Unknown backend: {backend}")
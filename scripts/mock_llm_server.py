@@ -0,0 +1,448 @@
+#!/usr/bin/env python3
+"""
+本地模拟 LLM 服务
+
+实现 Anthropic Messages（含流式和 Message Batches）和 Ollama /api/generate（含流式），
+用于在不花钱、不跑真实模型的情况下测量数据生成管线的吞吐。
+- 延迟：首 token 延迟服从对数正态分布，之后按固定速度输出 token
+- 容量：在途请求超过 --capacity 时返回 529 / 503（带 retry-after）
+- 错误注入：按比例返回 429 / 500 或超时不响应
+- 思考过程：--think 为 Ollama 输出加上 <think> 块，--chatter 在描述后追加多余解释
+- 前缀缓存：带 cache_control 的系统提示词（不短于 --cache-min-tokens）5 分钟内再次出现时按命中计，
+  usage 中分别报告 cache_read / cache_creation；Ollama 的 system 字段在 keep_alive 非 0 时复用，
+  prompt_eval_count 不含复用的部分
+- 打包请求：系统提示词含“批量模式”时按编号槽位返回 JSON，--slot-error-rate 按比例丢掉槽位
+
+用法：
+    python mock_llm_server.py --port 18080 --latency 0.8 --capacity 16 --error-rate 0.02
+    ANTHROPIC_API_KEY=mock ANTHROPIC_BASE_URL=http://localhost:18080 python generate_training_data.py
+    python generate_training_data_ollama.py --ollama-host http://localhost:18080
+"""
+
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+import uuid
+
+from aiohttp import web
+
+SUBJECTS = ["赛博朋克女孩", "白色小猫", "复古跑车", "雪山旅人", "机械巨龙", "街头舞者", "古风少女", "宇航员"]
+SCENES = ["霓虹街头", "雨夜城市", "金色麦田", "深海遗迹", "樱花庭院", "沙漠公路", "星空下", "老式咖啡馆"]
+STYLES = ["电影感光影", "胶片质感", "超写实风格", "水彩插画", "赛璐璐动画", "暗黑哥特", "温暖柔光", "极简构图"]
+
+
+def fake_description(seed_text: str, salt: int = 0) -> str:
+    """按输入内容确定性地拼出一条 10-30 字的中文描述"""
+    digest = hashlib.sha256(f"{salt}:{seed_text}".encode("utf-8")).digest()
+    return f"{SCENES[digest[0] % len(SCENES)]}的{SUBJECTS[digest[1] % len(SUBJECTS)]}，" \
+           f"{STYLES[digest[2] % len(STYLES)]}"
+
+
+def count_tokens(text: str) -> int:
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_chars) + ascii_chars // 4 + 1
+
+
+class MockLLM:
+    """共享的延迟、容量和错误注入逻辑"""
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.rejected = 0
+        self.injected_errors = 0
+        self.aborted_streams = 0
+        self.batches = {}
+        self.prefixes = {}
+
+    def reply(self, system: str, prompt: str) -> str:
+        """生成回复：增强请求返回两行变体，其余返回一行描述；打包请求返回 JSON"""
+        if "批量模式" in system:
+            return self.packed_reply(system, prompt)
+        if "变体" in system or "变体" in prompt:
+            return "\n".join(fake_description(prompt, salt) for salt in (1, 2))
+        return fake_description(prompt)
+
+    def packed_reply(self, system: str, prompt: str) -> str:
+        parts = re.split(r"^\[(\d+)\]\n", prompt, flags=re.MULTILINE)
+        slots = {}
+        for number, text in zip(parts[1::2], parts[2::2]):
+            if self.rng.random() < self.args.slot_error_rate:
+                continue
+            if "变体" in system:
+                slots[number] = [fake_description(text.strip(), salt) for salt in (1, 2)]
+            else:
+                slots[number] = fake_description(text.strip())
+        return json.dumps(slots, ensure_ascii=False)
+
+    def ollama_text(self, system: str, prompt: str) -> str:
+        text = self.reply(system, prompt)
+        if self.args.think:
+            text = "<think>\n" + "让我分析一下这个提示词的主体和场景。\n" * self.args.think + "</think>\n" + text
+        if self.args.chatter:
+            text += "\n" + "这个描述概括了提示词的核心内容。" * self.args.chatter
+        return text
+
+    def prefix_cache(self, key: str, tokens: int, ttl: float) -> tuple[int, int]:
+        """模拟前缀缓存，返回 (命中的 token 数, 写入的 token 数)"""
+        now = time.time()
+        hit = self.prefixes.get(key, 0) > now
+        self.prefixes[key] = now + ttl
+        return (tokens, 0) if hit else (0, tokens)
+
+    def ttft(self) -> float:
+        """首 token 延迟：中位数为 --latency 的对数正态分布"""
+        return self.args.latency * self.rng.lognormvariate(0, self.args.latency_sigma)
+
+    def decode_time(self, tokens: int) -> float:
+        return tokens / self.args.tokens_per_sec
+
+    def admit(self) -> str | None:
+        """返回 None 表示接受请求，否则返回注入的错误类型"""
+        self.requests += 1
+        if self.in_flight >= self.args.capacity:
+            self.rejected += 1
+            return "overloaded"
+        roll = self.rng.random()
+        if roll < self.args.error_rate:
+            self.injected_errors += 1
+            return self.rng.choice(["rate_limit", "server_error"])
+        if roll < self.args.error_rate + self.args.hang_rate:
+            self.injected_errors += 1
+            return "hang"
+        return None
+
+    def enter(self):
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def leave(self):
+        self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "rejected": self.rejected,
+            "injected_errors": self.injected_errors,
+            "aborted_streams": self.aborted_streams,
+        }
+
+
+def anthropic_error(kind: str, retry_after: float) -> web.Response:
+    status, error_type = {
+        "overloaded": (529, "overloaded_error"),
+        "rate_limit": (429, "rate_limit_error"),
+        "server_error": (500, "api_error"),
+    }[kind]
+    return web.json_response(
+        {"type": "error", "error": {"type": error_type, "message": f"mock {error_type}"}},
+        status=status,
+        headers={"retry-after": str(retry_after)} if status != 500 else None,
+    )
+
+
+def anthropic_message(
+    model: str,
+    text: str,
+    input_tokens: int,
+    cache_read: int = 0,
+    cache_write: int = 0
+) -> dict:
+    return {
+        "id": f"msg_{uuid.uuid4().hex[:24]}",
+        "type": "message",
+        "role": "assistant",
+        "model": model,
+        "content": [{"type": "text", "text": text}],
+        "stop_reason": "end_turn",
+        "stop_sequence": None,
+        "usage": {
+            "input_tokens": input_tokens,
+            "output_tokens": count_tokens(text),
+            "cache_read_input_tokens": cache_read,
+            "cache_creation_input_tokens": cache_write,
+        },
+    }
+
+
+def message_prompt(body: dict) -> tuple[str, str]:
+    system = body.get("system") or ""
+    if isinstance(system, list):
+        system = "".join(block.get("text", "") for block in system)
+    content = body["messages"][-1]["content"]
+    if isinstance(content, list):
+        content = "".join(block.get("text", "") for block in content if block.get("type") == "text")
+    return system, content
+
+
+def anthropic_usage(mock: "MockLLM", params: dict, system: str, prompt: str) -> tuple[int, int, int]:
+    """(未缓存输入, 缓存命中, 缓存写入) token 数"""
+    system_tokens = count_tokens(system)
+    blocks = params.get("system")
+    marked = isinstance(blocks, list) and any(block.get("cache_control") for block in blocks)
+    if not marked or system_tokens < mock.args.cache_min_tokens:
+        return system_tokens + count_tokens(prompt), 0, 0
+    read, write = mock.prefix_cache(f"anthropic:{params['model']}:{system}", system_tokens, 300)
+    return count_tokens(prompt), read, write
+
+
+async def sse(resp: web.StreamResponse, event: str, data: dict):
+    await resp.write(f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode())
+
+
+async def messages(request: web.Request) -> web.StreamResponse:
+    """POST /v1/messages"""
+    mock: MockLLM = request.app["mock"]
+    body = await request.json()
+    error = mock.admit()
+    if error == "hang":
+        await asyncio.sleep(3600)
+    if error:
+        return anthropic_error(error, mock.args.retry_after)
+
+    system, prompt = message_prompt(body)
+    text = mock.reply(system, prompt)
+    usage = anthropic_usage(mock, body, system, prompt)
+    mock.enter()
+    try:
+        await asyncio.sleep(mock.ttft())
+        if not body.get("stream"):
+            await asyncio.sleep(mock.decode_time(count_tokens(text)))
+            return web.json_response(anthropic_message(body["model"], text, *usage))
+
+        message = anthropic_message(body["model"], "", *usage)
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        await sse(resp, "message_start", {"type": "message_start", "message": message})
+        await sse(resp, "content_block_start", {
+            "type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}
+        })
+        for ch in text:
+            await asyncio.sleep(mock.decode_time(1))
+            await sse(resp, "content_block_delta", {
+                "type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": ch}
+            })
+        await sse(resp, "content_block_stop", {"type": "content_block_stop", "index": 0})
+        await sse(resp, "message_delta", {
+            "type": "message_delta",
+            "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+            "usage": {"output_tokens": count_tokens(text)},
+        })
+        await sse(resp, "message_stop", {"type": "message_stop"})
+        return resp
+    finally:
+        mock.leave()
+
+
+def batch_meta(request: web.Request, batch: dict) -> dict:
+    mock: MockLLM = request.app["mock"]
+    ended = time.time() - batch["created"] >= mock.args.batch_delay
+    total = len(batch["requests"])
+    return {
+        "id": batch["id"],
+        "type": "message_batch",
+        "processing_status": "ended" if ended else "in_progress",
+        "request_counts": {
+            "processing": 0 if ended else total,
+            "succeeded": batch["succeeded"] if ended else 0,
+            "errored": total - batch["succeeded"] if ended else 0,
+            "expired": 0,
+            "canceled": 0,
+        },
+        "created_at": "2025-01-01T00:00:00Z",
+        "expires_at": "2025-01-02T00:00:00Z",
+        "ended_at": "2025-01-01T00:00:00Z" if ended else None,
+        "archived_at": None,
+        "cancel_initiated_at": None,
+        "results_url": f"{request.url.origin()}/v1/messages/batches/{batch['id']}/results"
+        if ended else None,
+    }
+
+
+async def create_batch(request: web.Request) -> web.Response:
+    """POST /v1/messages/batches：结果在 --batch-delay 秒后可用"""
+    mock: MockLLM = request.app["mock"]
+    body = await request.json()
+    batch_id = f"msgbatch_{uuid.uuid4().hex[:24]}"
+    results = []
+    for entry in body["requests"]:
+        if mock.rng.random() < mock.args.error_rate:
+            result = {"type": "errored", "error": {
+                "type": "error", "error": {"type": "api_error", "message": "mock api_error"}
+            }}
+        else:
+            system, prompt = message_prompt(entry["params"])
+            text = mock.reply(system, prompt)
+            result = {"type": "succeeded", "message": anthropic_message(
+                entry["params"]["model"], text,
+                *anthropic_usage(mock, entry["params"], system, prompt)
+            )}
+        results.append({"custom_id": entry["custom_id"], "result": result})
+    mock.batches[batch_id] = {
+        "id": batch_id,
+        "created": time.time(),
+        "requests": body["requests"],
+        "results": results,
+        "succeeded": sum(1 for r in results if r["result"]["type"] == "succeeded"),
+    }
+    return web.json_response(batch_meta(request, mock.batches[batch_id]))
+
+
+async def get_batch(request: web.Request) -> web.Response:
+    """GET /v1/messages/batches/{id}"""
+    batch = request.app["mock"].batches.get(request.match_info["id"])
+    if batch is None:
+        raise web.HTTPNotFound()
+    return web.json_response(batch_meta(request, batch))
+
+
+async def batch_results(request: web.Request) -> web.Response:
+    """GET /v1/messages/batches/{id}/results（JSONL）"""
+    batch = request.app["mock"].batches.get(request.match_info["id"])
+    if batch is None:
+        raise web.HTTPNotFound()
+    lines = [json.dumps(r, ensure_ascii=False) for r in batch["results"]]
+    return web.Response(text="\n".join(lines), content_type="application/binary")
+
+
+async def generate(request: web.Request) -> web.StreamResponse:
+    """POST /api/generate（Ollama，stream 默认为 true）"""
+    mock: MockLLM = request.app["mock"]
+    body = await request.json()
+    error = mock.admit()
+    if error == "hang":
+        await asyncio.sleep(3600)
+    if error == "overloaded":
+        return web.json_response(
+            {"error": "server busy, please try again"},
+            status=503, headers={"Retry-After": str(mock.args.retry_after)},
+        )
+    if error == "rate_limit":
+        return web.json_response(
+            {"error": "too many requests"},
+            status=429, headers={"Retry-After": str(mock.args.retry_after)},
+        )
+    if error:
+        return web.json_response({"error": "mock error"}, status=500)
+
+    prompt = body.get("prompt", "")
+    num_predict = (body.get("options") or {}).get("num_predict", 128)
+    text = mock.ollama_text(body.get("system", ""), prompt)
+    # 按 num_predict 截断（模拟 token 数约等于字符数）
+    text = text[:num_predict] if num_predict > 0 else text
+    # 模型常驻期间同一 system 前缀的 KV 可复用
+    system = body.get("system", "")
+    system_tokens = count_tokens(system) if system else 0
+    reused = 0
+    if system and body.get("keep_alive") not in (0, "0", "0s"):
+        reused, _ = mock.prefix_cache(f"ollama:{body.get('model')}:{system}", system_tokens, 300)
+    done = {
+        "model": body.get("model"),
+        "done": True,
+        "done_reason": "stop",
+        "prompt_eval_count": count_tokens(prompt) + system_tokens - reused,
+        "eval_count": count_tokens(text),
+        "eval_duration": int(mock.decode_time(len(text)) * 1e9),
+    }
+    mock.enter()
+    try:
+        await asyncio.sleep(mock.ttft())
+        if not body.get("stream", True):
+            await asyncio.sleep(mock.decode_time(len(text)))
+            return web.json_response({**done, "response": text})
+
+        resp = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await resp.prepare(request)
+        try:
+            for ch in text:
+                await asyncio.sleep(mock.decode_time(1))
+                chunk = {"model": body.get("model"), "response": ch, "done": False}
+                await resp.write((json.dumps(chunk, ensure_ascii=False) + "\n").encode())
+            await resp.write((json.dumps({**done, "response": ""}) + "\n").encode())
+        except (ConnectionResetError, asyncio.CancelledError):
+            # 客户端提前断开：真实 Ollama 此时停止生成
+            mock.aborted_streams += 1
+        return resp
+    finally:
+        mock.leave()
+
+
+async def tags(request: web.Request) -> web.Response:
+    """GET /api/tags（Ollama 健康检查）"""
+    return web.json_response({"models": [{"name": "mock:latest"}]})
+
+
+async def stats(request: web.Request) -> web.Response:
+    """GET /_stats：服务端计数"""
+    return web.json_response(request.app["mock"].stats())
+
+
+def make_app(args) -> web.Application:
+    app = web.Application(client_max_size=256 * 1024 * 1024)
+    app["mock"] = MockLLM(args)
+    app.router.add_post("/v1/messages", messages)
+    app.router.add_post("/v1/messages/batches", create_batch)
+    app.router.add_get("/v1/messages/batches/{id}", get_batch)
+    app.router.add_get("/v1/messages/batches/{id}/results", batch_results)
+    app.router.add_post("/api/generate", generate)
+    app.router.add_get("/api/tags", tags)
+    app.router.add_get("/_stats", stats)
+    return app
+
+
+def add_server_args(parser):
+    """模拟服务的行为参数（基准测试脚本也会用到）"""
+    parser.add_argument("--latency", type=float, default=0.5, help="首 token 延迟中位数（秒）")
+    parser.add_argument("--latency-sigma", type=float, default=0.3, help="首 token 延迟的对数标准差")
+    parser.add_argument("--tokens-per-sec", type=float, default=200.0, help="输出速度（token/秒）")
+    parser.add_argument("--capacity", type=int, default=16,
+                        help="同时处理的请求上限，超过返回 529/503")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="过载时的 retry-after（秒）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="随机返回 429/500 的比例")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="随机不响应（触发超时）的比例")
+    parser.add_argument("--think", type=int, default=0, help="Ollama 输出前的 <think> 行数")
+    parser.add_argument("--chatter", type=int, default=0, help="Ollama 描述后追加的多余句子数")
+    parser.add_argument("--batch-delay", type=float, default=2.0, help="批任务完成所需时间（秒）")
+    parser.add_argument("--slot-error-rate", type=float, default=0.0,
+                        help="打包请求中随机丢掉槽位的比例")
+    parser.add_argument("--cache-min-tokens", type=int, default=1024,
+                        help="Anthropic 可缓存前缀的最小 token 数")
+    parser.add_argument("--seed", type=int, default=42, help="随机种子")
+
+
+SERVER_ARGS = (
+    "latency", "latency_sigma", "tokens_per_sec", "capacity", "retry_after",
+    "error_rate", "hang_rate", "think", "chatter", "batch_delay", "slot_error_rate", "cache_min_tokens", "seed",
+)
+
+
+def server_argv(args) -> list[str]:
+    """把解析后的服务参数还原成命令行"""
+    argv = []
+    for name in SERVER_ARGS:
+        argv += [f"--{name.replace('_', '-')}", str(getattr(args, name))]
+    return argv
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="本地模拟 Anthropic / Ollama 服务")
+    parser.add_argument("--host", default="127.0.0.1", help="监听地址")
+    parser.add_argument("--port", type=int, default=18080, help="监听端口")
+    add_server_args(parser)
+    args = parser.parse_args()
+    print(f"Mock LLM server on http://{args.host}:{args.port} "
+          f"(latency={args.latency}s, capacity={args.capacity}, error_rate={args.error_rate})")
+    web.run_app(make_app(args), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
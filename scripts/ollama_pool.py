@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+多主机 Ollama 负载均衡
+
+按最少在途请求选择主机；通过 /api/tags 做健康检查，
+连续失败的主机被摘除，后台定期探测恢复后重新加入。
+统计每台主机的请求数、失败数、平均延迟和吞吐。
+"""
+
+import asyncio
+import random
+import time
+from typing import Optional
+
+import aiohttp
+
+from adaptive_limiter import OverloadError
+
+
+class OllamaHost:
+    """单台 Ollama 主机的状态"""
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.healthy = True
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.ejections = 0
+        self.total_latency = 0.0
+        self.started = time.monotonic()
+
+    @property
+    def throughput(self) -> float:
+        elapsed = time.monotonic() - self.started
+        return self.completed / elapsed if elapsed > 0 else 0.0
+
+    def summary(self) -> str:
+        avg = self.total_latency / self.completed if self.completed else 0.0
+        state = "up" if self.healthy else "ejected"
+        return (
+            f"  {self.url} [{state}]: {self.completed} ok, {self.failed} failed, {self.rejected} rejected, "
+            f"{self.ejections} ejections, avg {avg:.2f}s, {self.throughput:.2f} req/s"
+        )
+
+
+class OllamaHostPool:
+    """最少在途请求负载均衡 + 健康检查"""
+
+    def __init__(
+        self,
+        urls: list[str],
+        eject_after: int = 3,
+        probe_interval: float = 10.0
+    ):
+        if not urls:
+            raise ValueError("At least one Ollama host is required")
+        self.hosts = [OllamaHost(url) for url in urls]
+        self.eject_after = eject_after
+        self.probe_interval = probe_interval
+        self._monitor_task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.hosts)
+
+    @property
+    def healthy_hosts(self) -> list[OllamaHost]:
+        return [host for host in self.hosts if host.healthy]
+
+    def acquire(self) -> OllamaHost:
+        """选择在途请求最少的健康主机（并列时随机）"""
+        candidates = self.healthy_hosts
+        if not candidates:
+            raise OverloadError("No healthy Ollama hosts", retry_after=self.probe_interval)
+        least = min(host.outstanding for host in candidates)
+        host = random.choice([h for h in candidates if h.outstanding == least])
+        host.outstanding += 1
+        return host
+
+    def release(self, host: OllamaHost, outcome: str, latency: float = 0.0):
+        """归还主机并记录结果
+
+        outcome: "ok" 成功；"busy" 主机繁忙（429/503，只计失败不摘除）；
+        "rejected" 请求本身有误（其他 4xx，与主机健康无关，不计失败）；
+        "error" 连接失败、超时或其他 5xx，连续达到阈值时摘除。
+        """
+        host.outstanding -= 1
+        if outcome == "ok":
+            host.completed += 1
+            host.total_latency += latency
+            host.consecutive_failures = 0
+            return
+        if outcome == "rejected":
+            host.rejected += 1
+            return
+        host.failed += 1
+        if outcome == "busy":
+            return
+        host.consecutive_failures += 1
+        if host.healthy and host.consecutive_failures >= self.eject_after:
+            host.healthy = False
+            host.ejections += 1
+            print(f"Warning: ejecting Ollama host {host.url} after "
+                  f"{host.consecutive_failures} consecutive failures")
+
+    async def probe(self, session: aiohttp.ClientSession, host: OllamaHost) -> bool:
+        """GET /api/tags 检查主机是否可用"""
+        try:
+            async with session.get(
+                f"{host.url}/api/tags", timeout=aiohttp.ClientTimeout(total=5)
+            ) as resp:
+                return resp.status == 200
+        except Exception:
+            return False
+
+    async def check_all(self, session: aiohttp.ClientSession) -> bool:
+        """检查所有主机，返回是否至少有一台可用"""
+        results = await asyncio.gather(*(self.probe(session, host) for host in self.hosts))
+        for host, ok in zip(self.hosts, results):
+            host.healthy = ok
+            host.consecutive_failures = 0
+            if not ok:
+                print(f"Warning: Ollama host {host.url} is not reachable")
+        return any(results)
+
+    def start_monitor(self, session: aiohttp.ClientSession):
+        """后台定期探测被摘除的主机，恢复后重新加入"""
+        if self._monitor_task is None:
+            self._monitor_task = asyncio.create_task(self._monitor(session))
+
+    async def _monitor(self, session: aiohttp.ClientSession):
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            for host in self.hosts:
+                if not host.healthy and await self.probe(session, host):
+                    host.healthy = True
+                    host.consecutive_failures = 0
+                    print(f"Re-admitted Ollama host {host.url}")
+
+    async def close(self):
+        if self._monitor_task is not None:
+            self._monitor_task.cancel()
+            try:
+                await self._monitor_task
+            except asyncio.CancelledError:
+                pass
+            self._monitor_task = None
+
+    def summary(self) -> str:
+        lines = [f"Ollama hosts: {len(self.healthy_hosts)}/{len(self.hosts)} healthy"]
+        lines.extend(host.summary() for host in self.hosts)
+        return "\n".join(lines)
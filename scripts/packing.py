@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+多条打包请求
+
+单条描述的输出只有 10-30 字，请求开销和系统提示词占了大头。打包模式把 K 条输入
+编号后放进一次请求，要求模型输出 JSON 对象（键为编号），逐个槽位解析和校验；
+没通过校验的槽位拆出来，交回调用方按单条请求重新排队。
+K 按输入 token 预算自动确定：连续的条目依次装入，直到加上下一条会超出预算
+或达到单包上限。
+"""
+
+import json
+import re
+from typing import Any, Callable, Hashable, Iterable, Optional
+
+from pipeline import run_pipeline
+from token_budget import get_tokenizer
+
+# 配置
+DEFAULT_PACK_TOKENS = 3000  # 单个打包请求的目标输入 token 数（含系统提示词）
+DEFAULT_PACK_MAX = 16       # 单包最多条目数
+SLOT_OVERHEAD_TOKENS = 8    # 每个槽位的编号和 JSON 结构开销
+
+PACK_INSTRUCTIONS = """
+
+批量模式：用户消息包含多条编号的输入（[1]、[2] ...）。请逐条独立处理，
+只输出一个 JSON 对象，键为编号字符串，值为{value_format}，例如 {example}。
+不要输出 JSON 以外的任何内容，不要遗漏或合并编号。"""
+
+
+def parse_slots(text: Optional[str]) -> dict:
+    """从模型输出中取出 JSON 对象；无法解析时返回空字典"""
+    if not text:
+        return {}
+    # 去掉思考块和代码块标记，取最外层的大括号
+    text = re.sub(r"<think>.*?</think>", "", text, flags=re.DOTALL)
+    text = re.sub(r"```(?:json)?", "", text)
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end <= start:
+        return {}
+    try:
+        slots = json.loads(text[start:end + 1])
+    except json.JSONDecodeError:
+        return {}
+    return {str(k).strip("[] "): v for k, v in slots.items()} if isinstance(slots, dict) else {}
+
+
+class Packer:
+    """把 (key, 输入文本) 分组打包成请求，返回通过校验的槽位结果"""
+
+    def __init__(
+        self,
+        client,
+        system: str,
+        header: str,
+        value_format: str,
+        example: str,
+        max_tokens_per_item: int,
+        validate: Callable[[Any], Any],
+        temperature: Optional[float] = None,
+        token_budget: int = DEFAULT_PACK_TOKENS,
+        max_items: int = DEFAULT_PACK_MAX
+    ):
+        self.client = client
+        self.system = system + PACK_INSTRUCTIONS.format(value_format=value_format, example=example)
+        self.header = header
+        self.max_tokens_per_item = max_tokens_per_item
+        self.validate = validate
+        self.temperature = temperature
+        self.token_budget = token_budget
+        self.max_items = max_items
+        self.tokenizer = get_tokenizer(client.backend, client.model)
+        self.requests = 0
+        self.slots_ok = 0
+        self.slots_failed = 0
+
+    def plan(self, items: Iterable[tuple[Hashable, str]]) -> list[list[tuple[Hashable, str]]]:
+        """按 token 预算把连续的条目分组（单条超出预算时独占一包）"""
+        fixed = self.tokenizer.count(self.system) + self.tokenizer.count(self.header)
+        groups, group, used = [], [], fixed
+        for key, text in items:
+            cost = self.tokenizer.count(text) + SLOT_OVERHEAD_TOKENS
+            if group and (used + cost > self.token_budget or len(group) >= self.max_items):
+                groups.append(group)
+                group, used = [], fixed
+            group.append((key, text))
+            used += cost
+        if group:
+            groups.append(group)
+        return groups
+
+    def build_prompt(self, group: list[tuple[Hashable, str]]) -> str:
+        slots = "\n\n".join(f"[{n}]\n{text}" for n, (_, text) in enumerate(group, 1))
+        return f"{self.header.format(count=len(group))}\n\n{slots}"
+
+    def max_tokens(self, group: list) -> int:
+        return len(group) * (self.max_tokens_per_item + SLOT_OVERHEAD_TOKENS)
+
+    def requests_for(self, groups: list[list]) -> Iterable[tuple]:
+        """dry-run 用的 (system, prompt, max_tokens, temperature)"""
+        for group in groups:
+            yield self.system, self.build_prompt(group), self.max_tokens(group), self.temperature
+
+    async def run(self, group: list[tuple[Hashable, str]]) -> dict:
+        """发送一个打包请求，返回 {key: 校验后的结果}，缺失或无效的槽位不在其中"""
+        self.requests += 1
+        text = await self.client.complete(
+            self.system, self.build_prompt(group),
+            max_tokens=self.max_tokens(group), temperature=self.temperature
+        )
+        slots = parse_slots(text)
+        results = {}
+        for n, (key, _) in enumerate(group, 1):
+            value = self.validate(slots.get(str(n)))
+            if value:
+                results[key] = value
+                self.slots_ok += 1
+            else:
+                self.slots_failed += 1
+        return results
+
+    def summary(self) -> str:
+        total = self.slots_ok + self.slots_failed
+        return (
+            f"Packing: {total} items in {self.requests} requests "
+            f"({total / max(1, self.requests):.1f} per request), "
+            f"{self.slots_failed} slots missing or invalid, re-queued as single requests"
+        )
+
+
+async def run_packed(
+    packer: Packer,
+    items: list[tuple[Hashable, str]],
+    sink: Callable[[Hashable, Any], None],
+    concurrency: int,
+    desc: str = "Processing"
+) -> list[Hashable]:
+    """打包处理全部条目，通过校验的结果按输入顺序交给 sink(key, result)，
+    返回需要按单条请求重新排队的 key"""
+    groups = packer.plan(items)
+    print(f"Packed {len(items)} items into {len(groups)} requests "
+          f"(budget {packer.token_budget} input tokens, at most {packer.max_items} per request)")
+    requeue = []
+
+    def pack_sink(group: list, results: Optional[dict]):
+        for key, _ in group:
+            if results and key in results:
+                sink(key, results[key])
+            else:
+                requeue.append(key)
+
+    await run_pipeline(groups, packer.run, pack_sink, concurrency, desc=desc)
+    print(packer.summary())
+    return requeue
+
+
+def add_pack_args(parser, tokens: int = DEFAULT_PACK_TOKENS, max_items: int = DEFAULT_PACK_MAX):
+    """为脚本添加打包参数"""
+    parser.add_argument("--pack", action="store_true",
+                        help="多条打包成一次请求（JSON 编号槽位），校验失败的条目改为单条重试")
+    parser.add_argument("--pack-tokens", type=int, default=tokens,
+                        help="单个打包请求的目标输入 token 数，据此自动确定每包条数")
+    parser.add_argument("--pack-max", type=int, default=max_items,
+                        help="单包最多条目数")
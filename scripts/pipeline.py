@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+有界并发流水线
+
+生产者把任务放进有界队列，N 个 worker 并发处理，
+结果经重排序缓冲按输入顺序交给 sink，进度条实时显示吞吐和在途请求数。
+"""
+
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Iterable
+
+from tqdm import tqdm
+
+
+async def run_pipeline(
+    items: Iterable[Any],
+    worker: Callable[[Any], Awaitable[Any]],
+    sink: Callable[[Any, Any], None],
+    concurrency: int,
+    desc: str = "Processing",
+    total: int | None = None
+) -> dict:
+    """并发执行 worker(item)，按输入顺序调用 sink(item, result)
+
+    worker 抛出的异常会被记录并当作 None 结果处理，不会中断流水线。
+    返回 {"completed", "succeeded", "failed", "elapsed", "items_per_sec"} 统计。
+    """
+    items = list(items) if total is None else items
+    if total is None:
+        total = len(items)
+
+    queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+    pending: dict[int, tuple[Any, Any]] = {}
+    next_seq = 0
+    in_flight = 0
+    stats = {"completed": 0, "succeeded": 0, "failed": 0}
+    start = time.monotonic()
+    progress = tqdm(total=total, desc=desc)
+
+    def drain():
+        """按顺序把已完成的结果交给 sink"""
+        nonlocal next_seq
+        while next_seq in pending:
+            item, result = pending.pop(next_seq)
+            sink(item, result)
+            next_seq += 1
+
+    def update_progress():
+        elapsed = time.monotonic() - start
+        progress.set_postfix(
+            in_flight=in_flight,
+            ok=stats["succeeded"],
+            failed=stats["failed"],
+            rate=f"{stats['completed'] / elapsed:.2f}/s" if elapsed > 0 else "-",
+            refresh=False,
+        )
+        progress.update(1)
+
+    async def produce():
+        for seq, item in enumerate(items):
+            await queue.put((seq, item))
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def consume():
+        nonlocal in_flight
+        while True:
+            entry = await queue.get()
+            if entry is None:
+                return
+            seq, item = entry
+            in_flight += 1
+            try:
+                result = await worker(item)
+            except Exception as e:
+                print(f"Error processing item: {e}")
+                result = None
+            in_flight -= 1
+            stats["completed"] += 1
+            stats["succeeded" if result else "failed"] += 1
+            pending[seq] = (item, result)
+            drain()
+            update_progress()
+
+    try:
+        await asyncio.gather(produce(), *(consume() for _ in range(concurrency)))
+    finally:
+        progress.close()
+
+    elapsed = time.monotonic() - start
+    stats["elapsed"] = elapsed
+    stats["items_per_sec"] = stats["completed"] / elapsed if elapsed > 0 else 0.0
+    return stats
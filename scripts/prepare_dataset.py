@@ -4,20 +4,44 @@
 
 将增强后的数据转换为 LLaMA-Factory / Unsloth 训练格式
 并划分训练集和验证集
+
+--stream 模式：逐行读取增强数据的 JSONL 日志，按 original_index 的稳定哈希决定划分
+（同一提示词的所有变体落在同一侧），输出 training_data.jsonl / validation_data.jsonl。
+读到的字节位置记在状态文件里，上游追加数据后再次运行只处理新增的行并追加到输出，
+已有样本的划分和顺序不变；内存占用与数据量无关。
+
+--profile 报告 token 长度分布、截断率和填充浪费，--length-policy 处理超长样本（见 dataset_profile.py）。
 """
 
+import hashlib
 import json
+import os
 import random
+import subprocess
+import sys
 from pathlib import Path
+from typing import Iterator, Optional
+
+from checkpoint import atomic_write_json, journal_path, load_records
+from dataset_profile import (
+    LengthPolicy, add_length_args, load_tokenizer, long_output_path, profile_report, read_dataset
+)
 
 # 配置
 BASE_DIR = Path(__file__).parent.parent
 INPUT_PATH = BASE_DIR / "data/processed/augmented_training_data.json"
 TRAIN_OUTPUT_PATH = BASE_DIR / "data/processed/training_data.json"
 VAL_OUTPUT_PATH = BASE_DIR / "data/processed/validation_data.json"
+STREAM_STATE_PATH = BASE_DIR / "data/processed/prepare_state.json"
 
 # 训练/验证集比例
 TRAIN_RATIO = 0.9
+SPLIT_SALT = "nano-banana-split"
+HEAD_BYTES = 4096  # 用输入文件开头的指纹判断上游是追加还是重写
+
+# 预分词存储和长度分析默认使用 train_lora_mac.py 的模型
+TOKENIZER = "Qwen/Qwen2.5-1.5B-Instruct"
+TOKEN_STORE_SCRIPT = BASE_DIR / "training/token_store.py"
 
 # 指令模板
 INSTRUCTION_TEMPLATE_TEXT = """根据以下描述生成 NanoBananaPro 图像提示词。
@@ -65,15 +89,126 @@ def format_training_sample(item: dict) -> dict:
     }
 
 
-def main():
+def split_of(item: dict, train_ratio: float = TRAIN_RATIO) -> str:
+    """按 original_index 的稳定哈希划分（缺失时用提示词），与数据顺序和总量无关"""
+    key = item.get('original_index')
+    if key is None:
+        key = item['prompt']
+    digest = hashlib.sha256(f"{SPLIT_SALT}:{key}".encode("utf-8")).digest()
+    return "train" if int.from_bytes(digest[:8], "big") / 2 ** 64 < train_ratio else "val"
+
+
+def head_digest(path: Path, size: int) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read(min(size, HEAD_BYTES))).hexdigest()
+
+
+def iter_jsonl_from(path: Path, offset: int) -> Iterator[tuple[dict, int]]:
+    """从字节位置 offset 开始流式读取 JSONL，返回 (记录, 该行结束的字节位置)，
+    写了一半的尾行留到下次"""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line), offset
+            except json.JSONDecodeError:
+                break
+
+
+def prepare_stream(rebuild: bool = False, policy: Optional[LengthPolicy] = None) -> bool:
+    """流式划分：只处理上次之后追加的行"""
+    input_path = journal_path(INPUT_PATH)
+    if not input_path.exists():
+        print(f"Error: Input journal not found: {input_path}")
+        print("Please run augment_data.py first (the JSONL journal is kept after compaction)")
+        return False
+    policy_key = [policy.policy, policy.max_tokens, policy.tokenizer.name] if policy else None
+    outputs = {"train": journal_path(TRAIN_OUTPUT_PATH), "val": journal_path(VAL_OUTPUT_PATH)}
+
+    state = None
+    if STREAM_STATE_PATH.exists() and not rebuild:
+        with open(STREAM_STATE_PATH, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        # 上游被重写（变短或开头变了）、划分参数变了或输出丢失时从头重建
+        size = input_path.stat().st_size
+        if (
+            state.get("input") != str(input_path)
+            or state.get("train_ratio") != TRAIN_RATIO
+            or state.get("salt") != SPLIT_SALT
+            or state.get("length_policy") != policy_key
+            or state["offset"] > size
+            or state["head"] != head_digest(input_path, state["offset"])
+            or any(not path.exists() or path.stat().st_size < state[split]["bytes"]
+                   for split, path in outputs.items())
+        ):
+            print("Input journal was rewritten or split settings changed, rebuilding")
+            state = None
+    if state is None:
+        state = {
+            "input": str(input_path),
+            "train_ratio": TRAIN_RATIO,
+            "salt": SPLIT_SALT,
+            "length_policy": policy_key,
+            "offset": 0,
+            "head": "",
+            "train": {"count": 0, "bytes": 0},
+            "val": {"count": 0, "bytes": 0},
+        }
+    else:
+        print(f"Resuming at byte {state['offset']} of {input_path.name} "
+              f"({state['train']['count']} train / {state['val']['count']} validation samples)")
+
+    TRAIN_OUTPUT_PATH.parent.mkdir(parents=True, exist_ok=True)
+    files = {}
+    for split, path in outputs.items():
+        # 截掉上次中断时没记入状态的部分，再追加
+        files[split] = open(path, "ab")
+        files[split].truncate(state[split]["bytes"])
+
+    added = {"train": 0, "val": 0}
+    offset = state["offset"]
+    try:
+        for item, offset in iter_jsonl_from(input_path, offset):
+            split = split_of(item)
+            sample = format_training_sample(item)
+            if policy and policy.apply(sample) is None:
+                continue
+            line = json.dumps(sample, ensure_ascii=False) + "\n"
+            files[split].write(line.encode("utf-8"))
+            added[split] += 1
+        for split, f in files.items():
+            f.flush()
+            os.fsync(f.fileno())
+            state[split]["bytes"] = f.tell()
+            state[split]["count"] += added[split]
+    finally:
+        for f in files.values():
+            f.close()
+    # 输出落盘后才推进状态；中途失败时下次运行会截掉多写的部分
+    state["offset"] = offset
+    state["head"] = head_digest(input_path, offset)
+    atomic_write_json(STREAM_STATE_PATH, state)
+
+    print(f"Appended {added['train']} training / {added['val']} validation samples")
+    print(f"Training set: {state['train']['count']} samples -> {outputs['train']}")
+    print(f"Validation set: {state['val']['count']} samples -> {outputs['val']}")
+    return True
+
+
+def prepare_json(policy: Optional[LengthPolicy] = None) -> bool:
+    """读取全部增强数据，随机打乱后按比例划分"""
     # 读取增强数据
-    if not INPUT_PATH.exists():
+    if not INPUT_PATH.exists() and not journal_path(INPUT_PATH).exists():
         print(f"Error: Input file not found: {INPUT_PATH}")
         print("Please run augment_data.py first")
-        return
+        return False
     
-    with open(INPUT_PATH, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    data = load_records(INPUT_PATH)
     
     print(f"Loaded {len(data)} samples")
     
@@ -86,8 +221,22 @@ def main():
     
     # 划分训练集和验证集
     split_idx = int(len(formatted_data) * TRAIN_RATIO)
-    train_data = formatted_data[:split_idx]
-    val_data = formatted_data[split_idx:]
+    splits = {
+        TRAIN_OUTPUT_PATH: formatted_data[:split_idx],
+        VAL_OUTPUT_PATH: formatted_data[split_idx:],
+    }
+    
+    # 超长样本处理：丢弃、移到 .long 文件或标注分桶
+    if policy:
+        for path, samples in splits.items():
+            targets = [policy.apply(sample) for sample in samples]
+            splits[path] = [s for s, t in zip(samples, targets) if t == "main"]
+            long_samples = [s for s, t in zip(samples, targets) if t == "long"]
+            if long_samples:
+                with open(long_output_path(path), 'w', encoding='utf-8') as f:
+                    json.dump(long_samples, f, ensure_ascii=False, indent=2)
+                print(f"Long samples: {len(long_samples)} -> {long_output_path(path)}")
+    train_data, val_data = splits[TRAIN_OUTPUT_PATH], splits[VAL_OUTPUT_PATH]
     
     print(f"Training set: {len(train_data)} samples")
     print(f"Validation set: {len(val_data)} samples")
@@ -105,12 +254,68 @@ def main():
     print(f"Validation data saved to: {VAL_OUTPUT_PATH}")
     
     # 输出示例
-    print("\n" + "=" * 50)
-    print("Sample training data:")
-    print("=" * 50)
-    sample = train_data[0]
-    print(f"Instruction:\n{sample['instruction'][:200]}...")
-    print(f"\nOutput:\n{sample['output'][:300]}...")
+    if train_data:
+        print("\n" + "=" * 50)
+        print("Sample training data:")
+        print("=" * 50)
+        sample = train_data[0]
+        print(f"Instruction:\n{sample['instruction'][:200]}...")
+        print(f"\nOutput:\n{sample['output'][:300]}...")
+    return True
+
+
+def build_token_store(tokenizer_name: str, workers: int):
+    """为刚写出的训练/验证集构建预分词存储：在子进程中运行 training/token_store.py（需要 transformers）"""
+    print(f"\nBuilding token store for {tokenizer_name} ({workers} workers)...")
+    result = subprocess.run([
+        sys.executable, str(TOKEN_STORE_SCRIPT), "--tokenizer", tokenizer_name, "--workers", str(workers)
+    ])
+    if result.returncode:
+        print(f"Error: token store build failed (exit code {result.returncode})")
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="格式化增强数据并划分训练/验证集")
+    parser.add_argument("--stream", action="store_true",
+                        help="JSONL 流式模式：按 original_index 哈希划分，只追加新增数据")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="流式模式下忽略状态文件，从头重建输出")
+    parser.add_argument("--tokenize", action="store_true",
+                        help="同时构建预分词存储（内存映射的 token 数组），训练脚本直接读取")
+    parser.add_argument("--tokenizer", default=TOKENIZER,
+                        help="预分词和长度分析使用的分词器（须与训练脚本的 MODEL_NAME 一致）")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="分词进程数")
+    parser.add_argument("--profile", action="store_true",
+                        help="划分后报告 token 长度分布、截断率和填充浪费")
+    add_length_args(parser)
+    args = parser.parse_args()
+
+    if args.stream and args.length_policy == "split":
+        print("Error: --length-policy split is not supported with --stream (use drop or bucket)")
+        return
+    tokenizer = None
+    if args.profile or args.length_policy != "truncate":
+        tokenizer = load_tokenizer(args.tokenizer)
+    policy = None
+    if args.length_policy != "truncate":
+        policy = LengthPolicy(args.length_policy, args.max_tokens, tokenizer)
+
+    if args.stream:
+        ok = prepare_stream(args.rebuild, policy)
+    else:
+        ok = prepare_json(policy)
+    if not ok:
+        return
+    if policy:
+        print(policy.summary())
+
+    if args.profile:
+        samples = read_dataset(TRAIN_OUTPUT_PATH) + read_dataset(VAL_OUTPUT_PATH)
+        print("\n" + profile_report(samples, tokenizer))
+
+    if args.tokenize:
+        build_token_store(args.tokenizer, args.workers)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+规则数据增强（不调用 LLM）
+
+描述只有 10-30 字，逐条请求 Claude 改写很不划算。这里用三类规则在本地生成变体：
+- 同义词替换：内置词表，所有词条编译成一个正则（长词优先），逐条描述替换
+- 语序调整：按逗号切分子句，归为主体/场景/风格三类，按另一种类别顺序重排
+- 标点/虚词变化：和/与/及互换，短子句间逗号改顿号，句末句号增删
+描述放在 pandas Series 中按变体逐列生成，但替换和重排都是逐条执行的 Python 代码（不是向量化运算）；
+260 条描述约几十毫秒。随机数按种子固定，结果可复现。部分描述没有可替换的词、也无法重排，
+变体会少于要求的条数，augment_data.py 会报告缺口。
+augment_data.py --engine rules 直接使用，--engine hybrid 时作为预处理，
+规则变体不足的条目再交给 LLM。
+
+用法：
+    python rule_augment.py --samples 10     # 对原始描述试跑，输出吞吐和示例
+"""
+
+import re
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# 配置
+BASE_DIR = Path(__file__).parent.parent
+INPUT_PATH = BASE_DIR / "data/processed/raw_training_data.json"
+
+DEFAULT_VARIANTS = 2
+DEFAULT_SEED = 42
+DEFAULT_SYNONYM_RATE = 0.7  # 每个命中词条被替换的概率
+
+# 同义词表：同一组内的词可以互换
+SYNONYM_GROUPS = [
+    ["一位", "一名"],
+    ["一个年轻", "一位年轻", "一名年轻"],
+    ["年轻女子", "年轻女性"],
+    ["女子", "女性"],
+    ["男子", "男士", "男性"],
+    ["身穿", "穿着", "身着"],
+    ["戴着", "佩戴"],
+    ["手持", "手拿", "拿着"],
+    ["站在", "立于"],
+    ["坐在", "坐于"],
+    ["凝视", "注视"],
+    ["直视镜头", "看向镜头"],
+    ["表情", "神情"],
+    ["自信", "从容"],
+    ["背景是", "背景为"],
+    ["超写实", "超逼真", "超真实"],
+    ["肖像", "人像"],
+    ["特写", "近景"],
+    ["城市", "都市"],
+    ["夜晚", "夜间"],
+    ["黄昏", "傍晚"],
+    ["户外", "室外"],
+    ["海滩", "沙滩"],
+    ["阳光明媚", "阳光灿烂"],
+    ["温馨", "温暖"],
+    ["宁静", "静谧"],
+    ["华丽", "奢华"],
+    ["优雅", "典雅"],
+    ["复古", "怀旧"],
+    ["现代", "当代"],
+    ["简约", "极简"],
+    ["模糊的", "虚化的"],
+    ["氛围", "气氛"],
+    ["营造", "打造"],
+    ["充满", "洋溢"],
+    ["细腻", "细致"],
+    ["精致", "精美"],
+    ["柔和", "柔美"],
+    ["照明", "打光"],
+    ["高清", "高清晰度"],
+    ["电影级", "电影感"],
+    ["照片", "相片"],
+    ["霓虹灯", "霓虹"],
+]
+
+# 连词变化（排除“温和”“和服”等词内的“和”）
+CONJUNCTION_PATTERN = re.compile(r"(?<![温柔平缓祥暖])和(?![服谐])|与|及(?![时格])")
+CONJUNCTIONS = ["和", "与", "及"]
+
+# 子句分类关键词，未命中的归为主体
+STYLE_KEYWORDS = (
+    "风格", "写实", "电影", "摄影", "肖像", "人像", "特写", "近景", "高清", "8k", "4k",
+    "画质", "细节", "光线", "照明", "光影", "色调", "构图", "镜头", "视角", "俯视", "仰视",
+    "3D", "插画", "动漫", "卡通", "胶片", "复古",
+)
+SCENE_KEYWORDS = (
+    "背景", "场景", "环境", "街", "城市", "都市", "海滩", "沙滩", "室内", "户外", "夜",
+    "雨", "雪", "阳光", "黄昏", "夕阳", "森林", "房间", "卧室", "咖啡馆", "公园", "天空",
+    "氛围", "灯",
+)
+SUBJECT, SCENE, STYLE = 0, 1, 2
+# 以代词开头的子句接在上一个子句后面，不单独移动
+PRONOUNS = ("她", "他", "其", "它")
+ORDERS = [
+    (SUBJECT, SCENE, STYLE),
+    (STYLE, SUBJECT, SCENE),
+    (SUBJECT, STYLE, SCENE),
+    (SCENE, SUBJECT, STYLE),
+]
+
+SENTENCE_PATTERN = re.compile(r"[^。！？!?]+[。！？!?]?")
+SHORT_CLAUSE = 6  # 两个相邻子句都不超过该长度时，逗号可改为顿号
+
+
+def _build_lexicon(groups: list[list[str]]) -> tuple[re.Pattern, dict[str, list[str]]]:
+    """词表编译成一个正则（长词优先），并给出每个词的可替换词"""
+    alternatives = {}
+    for group in groups:
+        for word in group:
+            alternatives[word] = [w for w in group if w != word]
+    words = sorted(alternatives, key=len, reverse=True)
+    return re.compile("|".join(map(re.escape, words))), alternatives
+
+
+LEXICON_PATTERN, LEXICON = _build_lexicon(SYNONYM_GROUPS)
+
+
+def classify(clause: str) -> int:
+    if any(k in clause for k in STYLE_KEYWORDS):
+        return STYLE
+    if any(k in clause for k in SCENE_KEYWORDS):
+        return SCENE
+    return SUBJECT
+
+
+def reorder_sentence(sentence: str, order: tuple) -> str:
+    """按类别顺序重排一句话内的子句（同类子句保持原有先后）"""
+    end = sentence[-1] if sentence[-1] in "。！？!?" else ""
+    clauses = [c.strip() for c in re.split(r"[，,；;]", sentence.rstrip("。！？!?")) if c.strip()]
+    if len(clauses) < 2:
+        return sentence
+    # 代词开头的子句并入上一个子句的分组
+    groups = []
+    for clause in clauses:
+        if groups and clause.startswith(PRONOUNS):
+            groups[-1][1].append(clause)
+        else:
+            groups.append([classify(clause), [clause]])
+    rank = {category: n for n, category in enumerate(order)}
+    groups.sort(key=lambda group: rank[group[0]])
+    return "，".join(c for _, members in groups for c in members) + end
+
+
+def reorder(text: str, start: int) -> str:
+    """从第 start 种类别顺序开始依次尝试，返回第一个改变了语序的结果"""
+    sentences = SENTENCE_PATTERN.findall(text)
+    for n in range(len(ORDERS)):
+        order = ORDERS[(start + n) % len(ORDERS)]
+        result = "".join(reorder_sentence(s, order) for s in sentences)
+        if result != text:
+            return result
+    return text
+
+
+def vary_punctuation(text: str, drop_period: bool) -> str:
+    """短子句间的逗号改为顿号，句末句号增删"""
+    clauses = text.split("，")
+    out = clauses[0]
+    for prev, clause in zip(clauses, clauses[1:]):
+        short = len(prev) <= SHORT_CLAUSE and len(clause.rstrip("。")) <= SHORT_CLAUSE
+        out += ("、" if short and " " not in prev + clause else "，") + clause
+    if drop_period:
+        return out[:-1] if out.endswith("。") else out
+    return out if out.endswith(("。", "！", "？", "!", "?")) else out + "。"
+
+
+def _substitute(series: pd.Series, pattern: re.Pattern, choices, rate: float, rng) -> pd.Series:
+    """对每条描述做正则替换（Series.str.replace 逐条调用）；命中的词条按 rate 概率替换为随机候选"""
+    def replace(match: re.Match) -> str:
+        if rng.random() >= rate:
+            return match.group(0)
+        options = choices(match.group(0))
+        return options[rng.integers(len(options))]
+    return series.str.replace(pattern, replace, regex=True)
+
+
+def rule_variants(
+    descriptions: list[str],
+    n: int = DEFAULT_VARIANTS,
+    seed: int = DEFAULT_SEED,
+    synonym_rate: float = DEFAULT_SYNONYM_RATE
+) -> list[list[str]]:
+    """为每条描述生成至多 n 个互不相同、且与原文不同的变体"""
+    original = pd.Series(descriptions, dtype=object).fillna("").astype(str).str.strip()
+    columns = []
+    for k in range(n):
+        rng = np.random.default_rng(seed + k)
+        # 同义词替换（所有变体）+ 连词变化
+        variant = _substitute(original, LEXICON_PATTERN, LEXICON.__getitem__, synonym_rate, rng)
+        variant = _substitute(
+            variant, CONJUNCTION_PATTERN,
+            lambda word: [c for c in CONJUNCTIONS if c != word], synonym_rate / 2, rng
+        )
+        if k % 2:
+            # 奇数变体调整语序，偶数变体变化标点，两种改写交替出现
+            start = (k // 2 + seed) % len(ORDERS)
+            variant = variant.map(lambda text: reorder(text, start))
+        else:
+            drop = pd.Series(rng.random(len(variant)) < 0.5, index=variant.index)
+            variant = pd.Series(
+                [vary_punctuation(text, d) for text, d in zip(variant, drop)], index=variant.index
+            )
+        columns.append(variant)
+
+    results = []
+    for row in zip(original, *columns):
+        seen = {row[0].rstrip("。")}
+        kept = []
+        for variant in row[1:]:
+            key = variant.rstrip("。")
+            if variant and key not in seen:
+                seen.add(key)
+                kept.append(variant)
+        results.append(kept)
+    return results
+
+
+def add_rule_args(parser):
+    """为脚本添加规则增强参数"""
+    parser.add_argument("--rule-seed", type=int, default=DEFAULT_SEED, help="规则增强的随机种子")
+    parser.add_argument("--synonym-rate", type=float, default=DEFAULT_SYNONYM_RATE,
+                        help="同义词命中后被替换的概率")
+
+
+def main():
+    import argparse
+    from checkpoint import load_records
+
+    parser = argparse.ArgumentParser(description="对原始描述试跑规则增强")
+    parser.add_argument("--input", type=Path, default=INPUT_PATH, help="原始训练数据")
+    parser.add_argument("-n", "--variants", type=int, default=DEFAULT_VARIANTS, help="每条生成的变体数")
+    parser.add_argument("--samples", type=int, default=5, help="输出的示例条数")
+    add_rule_args(parser)
+    args = parser.parse_args()
+
+    records = load_records(args.input)
+    if not records:
+        print(f"Error: No records found in {args.input}")
+        return
+    descriptions = [record['simple_description'] for record in records]
+
+    start = time.perf_counter()
+    variants = rule_variants(descriptions, args.variants, args.rule_seed, args.synonym_rate)
+    elapsed = time.perf_counter() - start
+    total = sum(len(v) for v in variants)
+    short = sum(1 for v in variants if len(v) < args.variants)
+    print(f"Generated {total} variants for {len(descriptions)} descriptions in {elapsed:.3f}s "
+          f"({total / max(elapsed, 1e-9):.0f} variants/s), {short} with fewer than {args.variants}")
+
+    for description, row in list(zip(descriptions, variants))[:args.samples]:
+        print(f"\n原文: {description}")
+        for variant in row:
+            print(f"  -> {variant}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,6 +6,12 @@ set -e
 SCRIPT_DIR="$(cd "$(dirname "${BASH_SOURCE[0]}")" && pwd)"
 cd "$SCRIPT_DIR"
 
+echo "=========================================="
+echo "Step 0: Convert raw workbook to columnar cache"
+echo "=========================================="
+python3 corpus.py
+
+echo ""
 echo "=========================================="
 echo "Step 1: Generate training data from prompts"
 echo "=========================================="
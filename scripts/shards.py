@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+分片执行与合并
+
+--shard i/N 让生成脚本只处理 original_index % N == i 的数据，
+每个分片使用独立的输出、断点日志和批任务状态文件（xxx.shard-i-of-N.json），
+开始时写入清单（本分片负责的全部 original_index）。多个进程或机器各跑一个分片，
+最后用合并步骤校验完整性后按 original_index 顺序合并成原来的输出文件。
+
+用法：
+    python generate_training_data.py --shard 0/4     # 每台机器跑一个分片
+    python shards.py generate --num-shards 4          # 校验并合并
+    python shards.py augment --num-shards 4 --allow-missing
+"""
+
+import json
+import os
+from pathlib import Path
+from typing import Iterable, NamedTuple, Optional
+
+from checkpoint import atomic_write_json, journal_path, load_records
+
+# 配置
+BASE_DIR = Path(__file__).parent.parent
+STAGE_OUTPUTS = {
+    "generate": BASE_DIR / "data/processed/raw_training_data.json",
+    "augment": BASE_DIR / "data/processed/augmented_training_data.json",
+}
+
+
+class Shard(NamedTuple):
+    index: int
+    count: int
+
+    def __str__(self) -> str:
+        return f"{self.index}/{self.count}"
+
+    def owns(self, key: int) -> bool:
+        return key % self.count == self.index
+
+
+def parse_shard(value: str) -> Shard:
+    """解析 "i/N"（argparse type）"""
+    import argparse
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Shard must look like i/N, got {value!r}")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Shard index must be in [0, N), got {value!r}")
+    return Shard(index, count)
+
+
+def shard_output_path(output_path: Path, shard: Optional[Shard]) -> Path:
+    """分片的输出路径；不分片时原样返回"""
+    output_path = Path(output_path)
+    if shard is None:
+        return output_path
+    return output_path.with_name(
+        f"{output_path.stem}.shard-{shard.index}-of-{shard.count}{output_path.suffix}"
+    )
+
+
+def manifest_path(output_path: Path) -> Path:
+    return Path(output_path).with_suffix(".manifest.json")
+
+
+def write_manifest(output_path: Path, shard: Optional[Shard], keys: Iterable[int]):
+    """记录本分片负责的全部 key，供合并时校验完整性"""
+    if shard is None:
+        return
+    atomic_write_json(manifest_path(output_path), {
+        "shard": shard.index,
+        "num_shards": shard.count,
+        "keys": sorted(keys),
+    })
+
+
+def write_journal(path: Path, records: list):
+    """原子重写 JSONL 日志"""
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def add_shard_args(parser):
+    """为脚本添加分片参数"""
+    parser.add_argument("--shard", type=parse_shard, default=None,
+                        help="只处理第 i 个分片（共 N 个），格式 i/N，按 original_index 取模分配")
+
+
+def merge_shards(
+    output_path: Path,
+    num_shards: int,
+    key: str = "original_index",
+    allow_missing: bool = False
+) -> bool:
+    """校验各分片并按 key 顺序合并；校验失败时不写输出，返回 False"""
+    records = []
+    problems = []
+    missing = []
+    seen_in = {}
+    for index in range(num_shards):
+        shard = Shard(index, num_shards)
+        path = shard_output_path(output_path, shard)
+        manifest_file = manifest_path(path)
+        if not manifest_file.exists():
+            problems.append(f"shard {shard}: manifest not found ({manifest_file})")
+            continue
+        with open(manifest_file, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest["num_shards"] != num_shards:
+            problems.append(f"shard {shard}: manifest says {manifest['num_shards']} shards")
+            continue
+        if not path.exists() and not journal_path(path).exists():
+            problems.append(f"shard {shard}: no output ({path})")
+            continue
+
+        shard_records = load_records(path)
+        keys = set()
+        for record in shard_records:
+            k = record[key]
+            if not shard.owns(k):
+                problems.append(f"shard {shard}: {key}={k} belongs to shard {k % num_shards}")
+            if seen_in.setdefault(k, index) != index:
+                problems.append(f"{key}={k} appears in shards {seen_in[k]} and {index}")
+            keys.add(k)
+        shard_missing = sorted(set(manifest["keys"]) - keys)
+        missing.extend(shard_missing)
+        print(f"Shard {shard}: {len(shard_records)} records, "
+              f"{len(keys)}/{len(manifest['keys'])} keys, {len(shard_missing)} missing")
+        records.extend(shard_records)
+
+    for problem in problems:
+        print(f"Error: {problem}")
+    if missing:
+        preview = ", ".join(str(k) for k in missing[:20])
+        more = f" ... (+{len(missing) - 20})" if len(missing) > 20 else ""
+        print(f"{'Warning' if allow_missing else 'Error'}: {len(missing)} keys missing: {preview}{more}")
+    if problems or (missing and not allow_missing):
+        print("Merge aborted, output not written")
+        return False
+
+    # 稳定排序：同一条数据的多条记录（原始 + 变体）保持原有先后
+    records.sort(key=lambda record: record[key])
+    # 同时重写不分片时使用的断点日志，之后不分片续跑也能看到全部结果；JSON 最后写，保持最新
+    write_journal(journal_path(output_path), records)
+    atomic_write_json(output_path, records)
+    print(f"Merged {len(records)} records from {num_shards} shards into {output_path}")
+    return True
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="校验并合并分片输出")
+    parser.add_argument("stage", choices=list(STAGE_OUTPUTS), help="要合并的阶段")
+    parser.add_argument("--num-shards", type=int, required=True, help="分片总数 N")
+    parser.add_argument("--allow-missing", action="store_true",
+                        help="允许缺少部分条目（例如生成失败的数据）")
+    args = parser.parse_args()
+
+    ok = merge_shards(STAGE_OUTPUTS[args.stage], args.num_shards, allow_missing=args.allow_missing)
+    raise SystemExit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
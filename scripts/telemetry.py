@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+"""
+请求级遥测
+
+每次模型调用（含全部重试）完成后记录一行 JSONL（data/telemetry/requests.jsonl，
+三个生成脚本共用，按 run 区分）：排队等待、首字节时间、总延迟、输入/输出 token、
+生成速度（Ollama 优先用 eval_count / eval_duration）、重试次数和状态。
+前缀缓存命中/写入的输入 token 单独记录。
+同时维护直方图和计数器，定期把 Prometheus 文本格式快照原子写入
+data/telemetry/<脚本名>.prom（可直接交给 node_exporter 的 textfile collector）。
+
+Anthropic 非流式请求的响应头与完整结果同时到达，不单独记录首字节时间；
+批处理结果的延迟为从提交到下载结果的周转时间，按 mode=batch 单独汇总。
+
+用法：
+    python telemetry.py                          # 按后端/模型汇总吞吐和 p50/p95/p99
+    python telemetry.py --run latest --script augment_data
+"""
+
+import json
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+
+from adaptive_limiter import percentile
+
+# 配置
+BASE_DIR = Path(__file__).parent.parent
+DEFAULT_TELEMETRY_DIR = BASE_DIR / "data/telemetry"
+
+# 直方图分桶上界（秒）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+EXPORT_INTERVAL = 15.0  # Prometheus 快照最短写入间隔（秒）
+
+# 记录中的计时字段
+TIMING_FIELDS = ("queue_wait", "ttfb", "latency")
+
+
+class Histogram:
+    """Prometheus 风格的累计直方图"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name: str, labels: str) -> list[str]:
+        lines = [
+            f'{name}_bucket{{{labels},le="{bound}"}} {count}'
+            for bound, count in zip(self.buckets, self.counts)
+        ]
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum:.6f}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class _Series:
+    """一个 (backend, model) 的累计指标"""
+
+    def __init__(self):
+        self.histograms = {field: Histogram() for field in TIMING_FIELDS}
+        self.requests = {}
+        self.retries = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cache_read_tokens = 0
+        self.cache_write_tokens = 0
+
+
+def tokens_per_sec(
+    output_tokens: int,
+    latency: Optional[float],
+    ttfb: Optional[float] = None,
+    eval_duration: Optional[float] = None
+) -> Optional[float]:
+    """生成速度：优先用后端报告的解码耗时，否则用首字节之后的时间"""
+    duration = eval_duration
+    if not duration and latency:
+        duration = latency - (ttfb or 0.0) if ttfb and latency > ttfb else latency
+    if not duration or not output_tokens:
+        return None
+    return output_tokens / duration
+
+
+class Telemetry:
+    """记录请求指标；directory 为 None 时只做内存统计，不写文件"""
+
+    def __init__(self, directory: Optional[Path], script: Optional[str] = None):
+        self.script = script or Path(sys.argv[0]).stem or "python"
+        self.run_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+        self.directory = Path(directory) if directory else None
+        self.series = {}
+        self.count = 0
+        self._file = None
+        self._exported = 0.0
+
+    @property
+    def path(self) -> Optional[Path]:
+        return self.directory / "requests.jsonl" if self.directory else None
+
+    @property
+    def prom_path(self) -> Optional[Path]:
+        return self.directory / f"{self.script}.prom" if self.directory else None
+
+    def record(
+        self,
+        backend: str,
+        model: str,
+        status: str,
+        started: float,
+        queue_wait: Optional[float] = None,
+        ttfb: Optional[float] = None,
+        latency: Optional[float] = None,
+        input_tokens: int = 0,
+        output_tokens: int = 0,
+        eval_duration: Optional[float] = None,
+        cache_read_tokens: Optional[int] = 0,
+        cache_write_tokens: int = 0,
+        retries: int = 0,
+        mode: str = "online",
+        error: Optional[str] = None
+    ):
+        """记录一次调用；started 为开始时的 time.time()"""
+        entry = {
+            "ts": time.time(),
+            "started": started,
+            "run": self.run_id,
+            "script": self.script,
+            "backend": backend,
+            "model": model,
+            "mode": mode,
+            "status": status,
+            "retries": retries,
+            "queue_wait": queue_wait,
+            "ttfb": ttfb,
+            "latency": latency,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "cache_read_tokens": cache_read_tokens,
+            "cache_write_tokens": cache_write_tokens,
+            # 批处理的延迟是整批周转时间，不计算生成速度
+            "tokens_per_sec": (
+                tokens_per_sec(output_tokens, latency, ttfb, eval_duration) if mode == "online" else None
+            ),
+        }
+        if error:
+            entry["error"] = error[:200]
+
+        series = self.series.setdefault((backend, model), _Series())
+        for field in TIMING_FIELDS:
+            if entry[field] is not None:
+                series.histograms[field].observe(entry[field])
+        series.requests[status] = series.requests.get(status, 0) + 1
+        series.retries += retries
+        series.input_tokens += input_tokens
+        series.output_tokens += output_tokens
+        # None 表示后端无法得知缓存命中量，不计入计数器
+        series.cache_read_tokens += cache_read_tokens or 0
+        series.cache_write_tokens += cache_write_tokens
+        self.count += 1
+
+        if self.directory is None:
+            return
+        if self._file is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+        if time.monotonic() - self._exported >= EXPORT_INTERVAL:
+            self.export()
+
+    def prometheus(self) -> str:
+        """Prometheus 文本格式"""
+        metrics = {
+            "llm_request_queue_wait_seconds": ("histogram", "Time waiting for rate limits and a concurrency slot"),
+            "llm_request_ttfb_seconds": ("histogram", "Time to first byte of the final attempt"),
+            "llm_request_latency_seconds": ("histogram", "Duration of the final attempt"),
+            "llm_requests_total": ("counter", "Requests by final status"),
+            "llm_request_retries_total": ("counter", "Retried attempts"),
+            "llm_input_tokens_total": ("counter", "Input tokens not served from the prefix cache"),
+            "llm_cache_read_tokens_total": ("counter", "Input tokens read from the prefix cache"),
+            "llm_cache_write_tokens_total": ("counter", "Input tokens written to the prefix cache"),
+            "llm_output_tokens_total": ("counter", "Output tokens"),
+        }
+        body = {name: [] for name in metrics}
+        for (backend, model), series in sorted(self.series.items()):
+            labels = f'script="{self.script}",backend="{backend}",model="{model}"'
+            for field in TIMING_FIELDS:
+                name = f"llm_request_{field}_seconds"
+                body[name].extend(series.histograms[field].lines(name, labels))
+            for status, count in sorted(series.requests.items()):
+                body["llm_requests_total"].append(
+                    f'llm_requests_total{{{labels},status="{status}"}} {count}'
+                )
+            body["llm_request_retries_total"].append(f"llm_request_retries_total{{{labels}}} {series.retries}")
+            body["llm_input_tokens_total"].append(f"llm_input_tokens_total{{{labels}}} {series.input_tokens}")
+            body["llm_cache_read_tokens_total"].append(
+                f"llm_cache_read_tokens_total{{{labels}}} {series.cache_read_tokens}"
+            )
+            body["llm_cache_write_tokens_total"].append(
+                f"llm_cache_write_tokens_total{{{labels}}} {series.cache_write_tokens}"
+            )
+            body["llm_output_tokens_total"].append(f"llm_output_tokens_total{{{labels}}} {series.output_tokens}")
+
+        lines = []
+        for name, (kind, help_text) in metrics.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(body[name])
+        return "\n".join(lines) + "\n"
+
+    def export(self):
+        """原子写入 Prometheus 快照"""
+        self._exported = time.monotonic()
+        if self.directory is None or not self.series:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.prom_path.with_name(f".{self.prom_path.name}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.prometheus())
+        os.replace(tmp_path, self.prom_path)
+
+    def close(self):
+        self.export()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def summary(self) -> str:
+        location = f" -> {self.path}" if self.directory and self.count else ""
+        return f"Telemetry: {self.count} requests recorded{location}"
+
+
+def add_telemetry_args(parser):
+    """为脚本添加遥测参数"""
+    parser.add_argument("--telemetry-dir", type=Path, default=DEFAULT_TELEMETRY_DIR,
+                        help="请求遥测 JSONL 和 Prometheus 快照的目录")
+    parser.add_argument("--no-telemetry", action="store_true",
+                        help="不写遥测文件")
+
+
+def open_telemetry(args) -> Telemetry:
+    """根据命令行参数创建遥测记录器"""
+    return Telemetry(None if args.no_telemetry else args.telemetry_dir)
+
+
+def busy_span(entries: list[dict]) -> float:
+    """各次运行活跃时间的并集（秒）：不计运行之间的空闲，同时进行的运行（如分片）不重复计时"""
+    intervals = {}
+    for entry in entries:
+        start, end = intervals.get(entry.get("run"), (entry["started"], entry["ts"]))
+        intervals[entry.get("run")] = (min(start, entry["started"]), max(end, entry["ts"]))
+    total, covered = 0.0, None
+    for start, end in sorted(intervals.values()):
+        if covered is None or start > covered[1]:
+            if covered:
+                total += covered[1] - covered[0]
+            covered = [start, end]
+        else:
+            covered[1] = max(covered[1], end)
+    return total + (covered[1] - covered[0] if covered else 0.0)
+
+
+def summarize(entries: list[dict]) -> str:
+    """按后端/模型/模式汇总"""
+    groups = {}
+    for entry in entries:
+        groups.setdefault((entry["backend"], entry["model"], entry["mode"]), []).append(entry)
+
+    def quantiles(values: list[float]) -> str:
+        if not values:
+            return f"{'-':>24}"
+        return " ".join(f"{percentile(values, q):>7.2f}s" for q in (0.5, 0.95, 0.99))
+
+    lines = []
+    for (backend, model, mode), group in sorted(groups.items()):
+        ok = [e for e in group if e["status"] == "ok"]
+        span = busy_span(group)
+        output_tokens = sum(e["output_tokens"] for e in group)
+        speeds = [e["tokens_per_sec"] for e in ok if e.get("tokens_per_sec")]
+        lines.append(f"{backend}/{model} [{mode}]")
+        lines.append(
+            f"  requests: {len(group)} ({len(ok)} ok, {len(group) - len(ok)} failed), "
+            f"{sum(e['retries'] for e in group)} retries"
+        )
+        if span > 0:
+            lines.append(
+                f"  throughput: {len(ok) / span:.2f} req/s, {output_tokens / span:.1f} output tokens/s "
+                f"over {span:.1f}s"
+            )
+        # 旧记录没有前缀缓存字段；值为 None 的记录缓存命中量未知
+        cached = sum(e.get("cache_read_tokens") or 0 for e in group)
+        unknown = sum(1 for e in ok if "cache_read_tokens" in e and e["cache_read_tokens"] is None)
+        uncached = sum(e["input_tokens"] + e.get("cache_write_tokens", 0) for e in group)
+        lines.append(
+            f"  tokens: {uncached} uncached + {cached} cached input "
+            f"({cached / max(1, cached + uncached):.1%} cached) / {output_tokens} output"
+            + (f", decode p50 {percentile(speeds, 0.5):.1f} tokens/s" if speeds else "")
+            + (f", cached tokens unknown for {unknown} requests" if unknown else "")
+        )
+        lines.append(f"  {'':<12}{'p50':>8} {'p95':>8} {'p99':>8}")
+        for field in TIMING_FIELDS:
+            values = [e[field] for e in ok if e.get(field) is not None]
+            lines.append(f"  {field:<12}{quantiles(values)}")
+    return "\n".join(lines)
+
+
+def main():
+    import argparse
+    from checkpoint import iter_jsonl
+    parser = argparse.ArgumentParser(description="汇总请求遥测")
+    parser.add_argument("--path", type=Path, default=DEFAULT_TELEMETRY_DIR / "requests.jsonl",
+                        help="遥测 JSONL 文件")
+    parser.add_argument("--run", default="all",
+                        help="只看某次运行：all=全部，latest=最近一次，或具体的 run id")
+    parser.add_argument("--script", default=None, help="只看某个脚本")
+    args = parser.parse_args()
+
+    if not args.path.exists():
+        print(f"Telemetry not found: {args.path}")
+        return
+
+    entries = [e for e in iter_jsonl(args.path) if args.script in (None, e["script"])]
+    if args.run == "latest" and entries:
+        latest = max(entries, key=lambda e: e["started"])["run"]
+        entries = [e for e in entries if e["run"] == latest]
+    elif args.run != "all":
+        entries = [e for e in entries if e["run"] == args.run]
+    if not entries:
+        print("No matching requests")
+        return
+
+    runs = sorted({e["run"] for e in entries})
+    print(f"Telemetry: {args.path} ({len(entries)} requests, {len(runs)} runs)")
+    print(summarize(entries))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+BatchRunner 的断点续传测试
+
+用 mock_llm_server.py 的 Message Batches 接口（本地随机端口）走完 提交 → 轮询 → 下载，
+中途中断后用同一个状态文件重新运行，确认只继续轮询未合并的批任务，不重复提交。
+
+用法：
+    python -m pytest -q test_batch_jobs.py
+"""
+
+import argparse
+import asyncio
+import json
+
+from aiohttp import web
+
+from batch_jobs import BatchRunner
+from llm_cache import ResponseCache
+from llm_client import AnthropicClient
+from mock_llm_server import add_server_args, make_app
+
+SYSTEM = "为提示词生成简洁中文描述"
+PROMPTS = {f"row-{i}": f"提示词 {i}" for i in range(5)}
+
+
+def make_requests(custom_ids) -> dict:
+    return {custom_id: (SYSTEM, PROMPTS[custom_id], 64) for custom_id in custom_ids}
+
+
+async def start_server(batch_delay: float = 0.2) -> tuple[web.AppRunner, web.Application, str]:
+    parser = argparse.ArgumentParser()
+    add_server_args(parser)
+    app = make_app(parser.parse_args(["--batch-delay", str(batch_delay)]))
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, app, f"http://127.0.0.1:{port}"
+
+
+def make_runner(tmp_path, monkeypatch, base_url: str) -> BatchRunner:
+    monkeypatch.setenv("ANTHROPIC_BASE_URL", base_url)
+    client = AnthropicClient(
+        "claude-mock", api_key="mock", prompt_cache=False,
+        limiter=None, cache=ResponseCache(tmp_path / "cache.db", mode="off"),
+    )
+    return BatchRunner(client, tmp_path / "out.batches.json", batch_size=2, poll_interval=0.05)
+
+
+def test_resume_after_interrupt(tmp_path, monkeypatch):
+    async def scenario():
+        server, app, base_url = await start_server()
+        try:
+            # 第一次运行：5 条请求分成 3 个批任务，合并完第一个批任务并取到第二个的首条后中断
+            first = make_runner(tmp_path, monkeypatch, base_url)
+            results = first.run(make_requests(PROMPTS))
+            done = [await results.__anext__() for _ in range(3)]
+            await results.aclose()
+            assert first.submitted == 5
+            assert len(app["mock"].batches) == 3
+
+            state_path = tmp_path / "out.batches.json"
+            with open(state_path, encoding="utf-8") as f:
+                state = json.load(f)
+            assert [batch["merged"] for batch in state["batches"]] == [True, False, False]
+
+            # 调用方已经写入日志的条目不再请求；第三条的结果没有落盘，需要重新取回
+            journaled = [custom_id for custom_id, _ in done[:2]]
+            remaining = [custom_id for custom_id in PROMPTS if custom_id not in journaled]
+            second = make_runner(tmp_path, monkeypatch, base_url)
+            resumed = {custom_id: text async for custom_id, text in second.run(make_requests(remaining))}
+        finally:
+            await server.cleanup()
+
+        assert second.submitted == 0
+        assert len(app["mock"].batches) == 3
+        assert sorted(resumed) == sorted(remaining)
+        assert all(resumed.values())
+        assert not state_path.exists()
+
+    asyncio.run(scenario())
+
+
+def test_failed_entries_are_resubmitted(tmp_path, monkeypatch):
+    async def scenario():
+        server, app, base_url = await start_server()
+        try:
+            app["mock"].args.error_rate = 1.0
+            first = make_runner(tmp_path, monkeypatch, base_url)
+            failed = {custom_id: text async for custom_id, text in first.run(make_requests(PROMPTS))}
+
+            app["mock"].args.error_rate = 0.0
+            second = make_runner(tmp_path, monkeypatch, base_url)
+            retried = {custom_id: text async for custom_id, text in second.run(make_requests(PROMPTS))}
+        finally:
+            await server.cleanup()
+
+        assert first.failed == 5 and not any(failed.values())
+        assert second.submitted == 5 and all(retried.values())
+        assert len(app["mock"].batches) == 6
+
+    asyncio.run(scenario())
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+"""
+多主机 Ollama 负载均衡测试
+
+启动两个 mock_llm_server.py 实例（本地随机端口）作为 Ollama 主机，覆盖：
+最少在途请求选主机、5xx / 超时连续失败后摘除、/api/tags 探测恢复后重新加入、
+429 / 503 只计失败不摘除、4xx 既不摘除也不重试。
+
+用法：
+    python -m pytest -q test_ollama_pool.py
+"""
+
+import argparse
+import asyncio
+import random
+
+from aiohttp import web
+
+from adaptive_limiter import AdaptiveLimiter
+from llm_cache import ResponseCache
+from llm_client import OllamaClient
+from mock_llm_server import add_server_args, make_app
+from ollama_pool import OllamaHostPool
+
+
+async def start_server(*argv: str) -> tuple[web.AppRunner, web.Application, str]:
+    parser = argparse.ArgumentParser()
+    add_server_args(parser)
+    app = make_app(parser.parse_args(["--latency", "0.05", "--latency-sigma", "0", *argv]))
+    # 超时用例里的请求会一直挂起，关闭时直接取消
+    runner = web.AppRunner(app, shutdown_timeout=0.1, handler_cancellation=True)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, app, f"http://127.0.0.1:{port}"
+
+
+def make_client(tmp_path, hosts: list[str], max_retries: int = 1, timeout: float = 5.0) -> OllamaClient:
+    client = OllamaClient(
+        "mock:latest", hosts=hosts, limiter=AdaptiveLimiter(initial=8, max_limit=8),
+        cache=ResponseCache(tmp_path / "cache.db", mode="off"),
+        timeout=timeout, max_retries=max_retries,
+    )
+    client.pool.probe_interval = 0.05
+    return client
+
+
+def run_with_servers(scenario, *server_argv):
+    """启动两台模拟主机，执行 scenario(servers) 后关闭；server_argv 为每台主机的参数"""
+    async def main():
+        servers = [await start_server(*argv) for argv in server_argv]
+        try:
+            await scenario(servers)
+        finally:
+            for runner, _, _ in servers:
+                await runner.cleanup()
+    asyncio.run(main())
+
+
+def test_acquire_prefers_least_outstanding():
+    pool = OllamaHostPool(["http://a", "http://b"])
+    first = pool.acquire()
+    second = pool.acquire()
+    assert first is not second
+    pool.release(first, "ok")
+    assert pool.acquire() is first
+
+
+def test_requests_spread_across_hosts(tmp_path):
+    async def scenario(servers):
+        client = make_client(tmp_path, [url for _, _, url in servers])
+        try:
+            results = await asyncio.gather(*(client.complete("系统", f"提示词 {i}", 16) for i in range(8)))
+        finally:
+            await client.close()
+        assert all(results)
+        assert [host.completed for host in client.pool.hosts] == [4, 4]
+        assert all(app["mock"].peak_in_flight == 4 for _, app, _ in servers)
+
+    run_with_servers(scenario, [], [])
+
+
+def test_server_errors_eject_and_probe_readmits(tmp_path):
+    async def scenario(servers):
+        (_, bad, bad_url), (_, _, good_url) = servers
+        bad["mock"].args.error_rate = 1.0
+        bad["mock"].rng.choice = lambda options: "server_error"
+        client = make_client(tmp_path, [bad_url, good_url])
+        try:
+            await client.health_check()
+            host = client.pool.hosts[0]
+            for i in range(30):
+                if not host.healthy:
+                    break
+                await client.complete("系统", f"提示词 {i}", 16)
+            assert not host.healthy and host.ejections == 1
+            assert host.failed == client.pool.eject_after
+
+            # 摘除期间所有请求都发往另一台
+            assert await client.complete("系统", "摘除后", 16)
+            assert bad["mock"].requests == client.pool.eject_after
+
+            # 恢复后由后台 /api/tags 探测重新加入
+            bad["mock"].args.error_rate = 0.0
+            await asyncio.sleep(0.3)
+            assert host.healthy and host.consecutive_failures == 0
+        finally:
+            await client.close()
+
+    run_with_servers(scenario, [], [])
+
+
+def test_timeouts_eject(tmp_path):
+    async def scenario(servers):
+        (_, _, hang_url), (_, _, good_url) = servers
+        client = make_client(tmp_path, [hang_url, good_url], timeout=0.3)
+        try:
+            host = client.pool.hosts[0]
+            for i in range(30):
+                if not host.healthy:
+                    break
+                await client.complete("系统", f"提示词 {i}", 16)
+        finally:
+            await client.close()
+        assert not host.healthy and host.ejections == 1
+
+    run_with_servers(scenario, ["--hang-rate", "1.0"], [])
+
+
+def test_busy_hosts_are_not_ejected(tmp_path):
+    async def scenario(servers):
+        (_, rate_limited, _), _ = servers
+        rate_limited["mock"].rng.choice = lambda options: "rate_limit"
+        client = make_client(tmp_path, [url for _, _, url in servers])
+        random.seed(0)  # 并列时随机选主机，固定种子让两台都收到足够多的请求
+        try:
+            for i in range(20):
+                await client.complete("系统", f"提示词 {i}", 16)
+        finally:
+            await client.close()
+        # 一台总是 429，另一台容量为 0 总是 503
+        assert all(host.healthy and host.ejections == 0 for host in client.pool.hosts)
+        assert all(host.failed > client.pool.eject_after for host in client.pool.hosts)
+
+    run_with_servers(scenario, ["--error-rate", "1.0"], ["--capacity", "0"])
+
+
+def test_request_errors_neither_eject_nor_retry(tmp_path):
+    async def scenario(servers):
+        # 路径前缀不存在，模拟服务对 /api/generate 返回 404
+        client = make_client(tmp_path, [f"{url}/missing" for _, _, url in servers], max_retries=3)
+        try:
+            results = [await client.complete("系统", f"提示词 {i}", 16) for i in range(8)]
+        finally:
+            await client.close()
+        assert results == [None] * 8
+        assert client.requests == 8 and client.retries == 0 and client.failures == 8
+        assert all(host.healthy and host.consecutive_failures == 0 for host in client.pool.hosts)
+        assert sum(host.rejected for host in client.pool.hosts) == 8
+
+    run_with_servers(scenario, [], [])
@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+"""
+Token 预算
+
+按后端分词器精确截断输入，并在发请求前估算总 token 数、费用和耗时（--dry-run）。
+- Ollama：安装了 tokenizers 时加载与本地模型对应的 Hugging Face 分词器，按 token 精确截断
+- Claude：分词器未公开。设置了 ANTHROPIC_API_KEY 时用 messages.count_tokens 接口计数：
+  --dry-run 按接口实测抽样请求并换算总量，截断时对估算接近上限的文本实测（同步调用，结果按文本缓存）；
+  没有 key 或接口不可用时按字符类别估算，这只是近似值，不保证是上界
+"""
+
+import os
+import re
+from functools import lru_cache
+from typing import Optional
+
+# Ollama 模型对应的 Hugging Face 分词器
+HF_TOKENIZERS = {
+    "qwen2.5-coder:latest": "Qwen/Qwen2.5-Coder-7B-Instruct",
+    "qwen2.5:latest": "Qwen/Qwen2.5-7B-Instruct",
+}
+
+# Ollama 为 Qwen 模型套用的 ChatML 模板；prompt_eval_count 按渲染后的完整输入计数
+OLLAMA_TEMPLATE = "<|im_start|>system\n{system}<|im_end|>\n<|im_start|>user\n{prompt}<|im_end|>\n<|im_start|>assistant\n"
+
+# 标准价格（美元 / 百万 token：输入, 输出）；本地模型不计费
+PRICES = {
+    "claude-sonnet-4-20250514": (3.0, 15.0),
+}
+BATCH_DISCOUNT = 0.5
+
+# --dry-run 最多用 count_tokens 实测的请求数（均匀抽样），其余按实测与估算之比换算
+COUNT_SAMPLE = 100
+# 截断时估算不到上限这一比例的文本不调用 count_tokens
+EXACT_CHECK_RATIO = 0.5
+# 实测超出上限时按比例缩短文本，再多留的余量
+TRUNCATE_SHRINK = 0.95
+
+# 单个请求的耗时模型：固定开销（秒）+ 输出 token / 解码速度（token/秒）
+LATENCY_MODEL = {
+    "anthropic": (1.0, 60.0),
+    "ollama": (0.5, 30.0),
+}
+
+
+# 字符类别估算的切分：ASCII 字母数字串、空白、其余单个字符
+TOKEN_PIECES = re.compile(r"[A-Za-z0-9]+|\s+|.", re.S)
+
+
+def piece_tokens(piece: str) -> int:
+    """字母数字串每 4 个字符 1 token（不足 4 个也算 1 个），空白不计，
+    标点符号（JSON 的括号、引号等）和非 ASCII 字符（中文等）每个 1 token"""
+    if piece[0].isascii() and piece[0].isalnum():
+        return -(-len(piece) // 4)
+    if piece.isspace():
+        return 0
+    return 1
+
+
+def estimate_tokens(text: str) -> int:
+    """按字符类别估算 token 数（近似值，标点密集或罕见词较多的文本可能偏低）"""
+    return sum(piece_tokens(m.group()) for m in TOKEN_PIECES.finditer(text))
+
+
+class HeuristicTokenizer:
+    """字符估算分词器，与 estimate_tokens 口径一致"""
+
+    name = "heuristic"
+
+    def count(self, text: str) -> int:
+        return estimate_tokens(text)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """截断到不超过 max_tokens 个估算 token"""
+        used = 0
+        for m in TOKEN_PIECES.finditer(text):
+            cost = piece_tokens(m.group())
+            if used + cost > max_tokens:
+                # 字母数字串可以从中间截断
+                keep = (max_tokens - used) * 4 if cost > 1 else 0
+                return text[:m.start() + keep]
+            used += cost
+        return text
+
+
+class HFTokenizer:
+    """Hugging Face 分词器（tokenizers 库），按 token 精确截断"""
+
+    def __init__(self, name: str):
+        from tokenizers import Tokenizer
+        self.name = name
+        self._tokenizer = Tokenizer.from_pretrained(name)
+
+    def count(self, text: str) -> int:
+        return len(self._tokenizer.encode(text, add_special_tokens=False).ids)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """截断到恰好 max_tokens 个 token，按字符偏移切分，不会切坏多字节字符"""
+        encoding = self._tokenizer.encode(text, add_special_tokens=False)
+        if len(encoding.ids) <= max_tokens:
+            return text
+        return text[:encoding.offsets[max_tokens - 1][1]]
+
+
+class AnthropicTokenCounter:
+    """Anthropic messages.count_tokens 接口（不计费，有单独的速率限制）；
+    接口出错后不再调用，count 返回 None，由调用方退回估算"""
+
+    name = "count_tokens"
+
+    def __init__(self, model: str, api_key: str):
+        import anthropic
+        self.model = model
+        self.available = True
+        self._client = anthropic.Anthropic(api_key=api_key, max_retries=2)
+        self._counts = {}
+
+    def count(self, system: str, prompt: str) -> Optional[int]:
+        """一个请求（系统提示词 + 单条用户消息）的输入 token 数"""
+        key = (system, prompt)
+        if key not in self._counts and self.available:
+            import anthropic
+            kwargs = {"system": system} if system else {}
+            try:
+                self._counts[key] = self._client.messages.count_tokens(
+                    model=self.model, messages=[{"role": "user", "content": prompt}], **kwargs
+                ).input_tokens
+            except anthropic.APIError as e:
+                print(f"Warning: messages.count_tokens failed ({e}), "
+                      f"falling back to estimated token counts")
+                self.available = False
+        return self._counts.get(key)
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """截断到实测不超过 max_tokens 个 token（含消息本身的少量固定开销，结果略偏短）"""
+        if estimate_tokens(text) <= max_tokens * EXACT_CHECK_RATIO:
+            return text
+        tokens = self.count("", text)
+        while tokens is not None and tokens > max_tokens and text:
+            text = text[:int(len(text) * max_tokens / tokens * TRUNCATE_SHRINK)]
+            tokens = self.count("", text) if text else 0
+        if tokens is None:
+            return HeuristicTokenizer().truncate(text, max_tokens)
+        return text
+
+
+@lru_cache(maxsize=None)
+def get_token_counter(backend: str, model: str) -> Optional[AnthropicTokenCounter]:
+    """有 ANTHROPIC_API_KEY 时返回 count_tokens 计数器，否则返回 None"""
+    api_key = os.environ.get("ANTHROPIC_API_KEY")
+    if backend != "anthropic" or not api_key:
+        return None
+    return AnthropicTokenCounter(model, api_key)
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(backend: str, model: str):
+    """获取后端对应的分词器；缺少依赖或下载失败时退回字符估算"""
+    name = HF_TOKENIZERS.get(model) if backend == "ollama" else None
+    if name:
+        try:
+            return HFTokenizer(name)
+        except ImportError:
+            print("Warning: tokenizers not installed, falling back to estimated token counts "
+                  "(pip install tokenizers)")
+        except Exception as e:
+            print(f"Warning: cannot load tokenizer {name} ({e}), "
+                  f"falling back to estimated token counts")
+    return HeuristicTokenizer()
+
+
+def ollama_prompt_tokens(model: str, system: str, prompt: str) -> Optional[int]:
+    """用模型的真实分词器计算套模板后的输入 token 数（与 prompt_eval_count 同口径）；
+    没有对应分词器、只能字符估算时返回 None"""
+    tokenizer = get_tokenizer("ollama", model)
+    if isinstance(tokenizer, HeuristicTokenizer):
+        return None
+    return tokenizer.count(OLLAMA_TEMPLATE.format(system=system, prompt=prompt))
+
+
+def truncate_tokens(text: str, max_tokens: int, backend: str, model: str) -> str:
+    """按后端分词器把文本截断到 max_tokens 个 token；Claude 有 key 时按 count_tokens 实测"""
+    counter = get_token_counter(backend, model)
+    if counter is not None:
+        return counter.truncate(text, max_tokens)
+    return get_tokenizer(backend, model).truncate(text, max_tokens)
+
+
+class BudgetPlanner:
+    """汇总待发请求的 token 用量，估算费用和耗时"""
+
+    def __init__(self, backend: str, model: str):
+        self.backend = backend
+        self.model = model
+        self.tokenizer = get_tokenizer(backend, model)
+        self.requests = 0
+        self.cached = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.max_input = 0
+        self.pending = []  # 待发请求的 (system, prompt, 估算 token 数)，供 calibrate 抽样
+        self.counted = 0
+        self.ratio = None
+
+    def add(self, system: str, prompt: str, max_tokens: int, cached: bool = False):
+        """登记一个请求；命中缓存的请求不会发出，不计入用量"""
+        if cached:
+            self.cached += 1
+            return
+        tokens = self.tokenizer.count(system) + self.tokenizer.count(prompt)
+        self.requests += 1
+        self.input_tokens += tokens
+        self.output_tokens += max_tokens
+        self.max_input = max(self.max_input, tokens)
+        self.pending.append((system, prompt, tokens))
+
+    def calibrate(self, counter: AnthropicTokenCounter, sample: int = COUNT_SAMPLE):
+        """用 count_tokens 实测均匀抽样的请求，按实测与估算之比换算输入 token 总量；
+        请求数不超过 sample 时即为精确值。接口不可用时保留估算"""
+        n = min(sample, len(self.pending))
+        picked = [self.pending[i * len(self.pending) // n] for i in range(n)]
+        exact = estimated = 0
+        for system, prompt, tokens in picked:
+            count = counter.count(system, prompt)
+            if count is None:
+                return
+            exact += count
+            estimated += tokens
+        if not picked:
+            return
+        self.counted = len(picked)
+        self.ratio = exact / max(1, estimated)
+        self.input_tokens = round(self.input_tokens * self.ratio)
+        self.max_input = round(self.max_input * self.ratio)
+
+    def cost(self, batch: bool = False) -> Optional[float]:
+        """费用上限（美元）；未知价格返回 None"""
+        if self.backend == "ollama":
+            return 0.0
+        if self.model not in PRICES:
+            return None
+        input_price, output_price = PRICES[self.model]
+        cost = (self.input_tokens * input_price + self.output_tokens * output_price) / 1e6
+        return cost * BATCH_DISCOUNT if batch else cost
+
+    def wall_time(
+        self,
+        concurrency: int,
+        rpm: Optional[float] = None,
+        tpm: Optional[float] = None
+    ) -> float:
+        """按并发数和限速估算耗时上限（秒）"""
+        overhead, decode_rate = LATENCY_MODEL[self.backend]
+        busy = self.requests * overhead + self.output_tokens / decode_rate
+        seconds = busy / max(1, concurrency)
+        if rpm:
+            seconds = max(seconds, self.requests / rpm * 60)
+        if tpm:
+            seconds = max(seconds, (self.input_tokens + self.output_tokens) / tpm * 60)
+        return seconds
+
+    def report(
+        self,
+        concurrency: int,
+        rpm: Optional[float] = None,
+        tpm: Optional[float] = None,
+        batch: bool = False
+    ) -> str:
+        lines = [
+            f"Dry run [{self.backend}/{self.model}] (tokenizer: {self.tokenizer.name})",
+            f"  Requests: {self.requests + self.cached} "
+            f"({self.cached} cached, {self.requests} to send)",
+            f"  Input tokens: {self.input_tokens:,} "
+            f"(avg {self.input_tokens // max(1, self.requests):,}, max {self.max_input:,})",
+            f"  Output tokens: <= {self.output_tokens:,} (max_tokens per request)",
+        ]
+        if self.ratio is not None:
+            lines.insert(3, f"  Input tokens counted with messages.count_tokens for {self.counted} of "
+                            f"{self.requests} requests (x{self.ratio:.2f} vs estimate)")
+        elif self.backend == "anthropic":
+            lines.insert(3, "  Input tokens estimated by character class "
+                            "(approximate; counted with messages.count_tokens when ANTHROPIC_API_KEY works)")
+        cost = self.cost(batch)
+        if cost is None:
+            lines.append(f"  Estimated cost: unknown (no price for {self.model})")
+        else:
+            note = " with batch discount" if batch else ""
+            lines.append(f"  Estimated cost: <= ${cost:,.2f}{note}")
+        if batch:
+            lines.append("  Estimated wall time: batches usually finish within 24 hours")
+        else:
+            minutes = self.wall_time(concurrency, rpm, tpm) / 60
+            lines.append(f"  Estimated wall time: <= {minutes:,.1f} min "
+                         f"at concurrency {concurrency}")
+        return "\n".join(lines)
+
+
+def dry_run(client, requests, rpm=None, tpm=None, batch: bool = False) -> str:
+    """估算一组请求的用量并返回报告，不发送任何请求
+
+    requests: 可迭代的 (system, prompt, max_tokens, temperature)
+    """
+    planner = BudgetPlanner(client.backend, client.model)
+    for system, prompt, max_tokens, temperature in requests:
+        key = client.cache_key(system, prompt, max_tokens, temperature)
+        planner.add(system, prompt, max_tokens, cached=client.cache.contains(key))
+    counter = get_token_counter(client.backend, client.model)
+    if counter is not None:
+        planner.calibrate(counter)
+    return planner.report(client.limiter.max_limit, rpm, tpm, batch)
+
+
+def add_budget_args(parser):
+    """为脚本添加 --dry-run 参数"""
+    parser.add_argument("--dry-run", action="store_true",
+                        help="只估算 token 用量、费用和耗时，不发送任何请求")
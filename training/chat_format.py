@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+训练数据的聊天模板与读取
+
+训练脚本的 format_prompt、预分词存储（token_store.py）和 scripts/dataset_profile.py 的长度分析
+都用这里的 render，保证三处的 token 口径一致。只依赖标准库，scripts/ 按文件路径显式加载本模块。
+"""
+
+import json
+from pathlib import Path
+
+# 修改模板时递增 TEMPLATE_VERSION，旧的预分词存储随之失效
+TEMPLATE_VERSION = 1
+SYSTEM_PROMPT = "你是 NanoBananaPro 提示词生成专家。根据用户的简单描述，生成高质量的图像生成提示词。"
+PROMPT_TEMPLATE = """<|im_start|>system
+{system}<|im_end|>
+<|im_start|>user
+{instruction}<|im_end|>
+<|im_start|>assistant
+"""
+RESPONSE_TEMPLATE = "{output}<|im_end|>"
+
+
+def render(sample: dict) -> tuple[str, str]:
+    """(提示词部分, 回复部分)，两段拼起来等于 format_prompt(sample)"""
+    prompt = PROMPT_TEMPLATE.format(system=SYSTEM_PROMPT, instruction=sample['instruction'])
+    return prompt, RESPONSE_TEMPLATE.format(output=sample['output'])
+
+
+def format_prompt(sample: dict) -> str:
+    """完整训练文本（提示词 + 回复）"""
+    prompt, response = render(sample)
+    return prompt + response
+
+
+def read_dataset(path: Path) -> list:
+    """读取数据集；prepare_dataset.py --stream 输出的 JSONL 比 JSON 新（或 JSON 不存在）时读 JSONL"""
+    with open(dataset_file(path), 'r', encoding='utf-8') as f:
+        if f.name.endswith(".jsonl"):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
+
+
+def dataset_file(path: Path) -> Path:
+    """实际生效的数据文件（JSON 或更新的 JSONL）"""
+    jsonl = path.with_suffix(".jsonl")
+    if jsonl.exists() and (not path.exists() or jsonl.stat().st_mtime > path.stat().st_mtime):
+        return jsonl
+    return path
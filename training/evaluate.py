@@ -11,14 +11,14 @@ from pathlib import Path
 from tqdm import tqdm
 import re
 
+from chat_format import read_dataset
+
 BASE_DIR = Path(__file__).parent.parent
 
 
 def load_validation_data():
     """加载验证集"""
-    val_path = BASE_DIR / "data/processed/validation_data.json"
-    with open(val_path, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    return read_dataset(BASE_DIR / "data/processed/validation_data.json")
 
 
 def load_model(use_finetuned=True):
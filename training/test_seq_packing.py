@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+序列打包测试
+
+只覆盖不需要模型的部分：pack_rows 的容量约束和首次适配递减顺序，
+PackedDataset 取出的行布局（position_ids 分段重置、每段首个 label 和行尾填充为 -100）。
+
+用法：
+    python -m pytest -q test_seq_packing.py
+"""
+
+import numpy as np
+
+from seq_packing import IGNORE_INDEX, PackedDataset, pack_rows
+
+PAD = 0
+
+
+def test_rows_respect_capacity():
+    lengths = [7, 3, 6, 2, 5, 1, 4, 8]
+    rows = pack_rows(lengths, 8)
+    assert sorted(i for row in rows for i in row) == list(range(len(lengths)))
+    assert all(sum(lengths[i] for i in row) <= 8 for row in rows)
+    # 总长 36，至少需要 5 行；首次适配递减在这组数据上正好达到下界
+    assert len(rows) == 5
+
+
+def test_first_fit_decreasing_order():
+    # 从长到短依次放入第一行放得下的行：5 → 行0，4 → 行1，3 → 行0，3 → 行1，1 → 行1
+    assert pack_rows([5, 4, 3, 3, 1], 8) == [[0, 2], [1, 3, 4]]
+
+
+def test_overlong_sample_is_truncated_into_own_row():
+    rows = pack_rows([12, 3], 8)
+    assert rows == [[0], [1]]
+    dataset = PackedDataset([list(range(1, 13)), [1, 2, 3]], 8, PAD)
+    assert dataset.lengths == [8, 3]
+    assert dataset[0]["input_ids"].tolist() == list(range(1, 9))
+
+
+def test_row_layout():
+    samples = [[11, 12, 13, 14, 15], [21, 22, 23, 24], [31, 32, 33], [41, 42, 43], [51]]
+    dataset = PackedDataset(samples, 10, PAD)
+    assert dataset.rows == [[0, 1, 4], [2, 3]]
+
+    row = dataset[0]
+    assert row["input_ids"].tolist() == [11, 12, 13, 14, 15, 21, 22, 23, 24, 51]
+    assert row["position_ids"].tolist() == [0, 1, 2, 3, 4, 0, 1, 2, 3, 0]
+    assert row["labels"].tolist() == [IGNORE_INDEX, 12, 13, 14, 15, IGNORE_INDEX, 22, 23, 24, IGNORE_INDEX]
+
+    # 行尾填充自成一段：position_ids 从 0 重新计数，label 全部为 -100
+    row = dataset[1]
+    assert row["input_ids"].tolist() == [31, 32, 33, 41, 42, 43, PAD, PAD, PAD, PAD]
+    assert row["position_ids"].tolist() == [0, 1, 2, 0, 1, 2, 0, 1, 2, 3]
+    assert row["labels"].tolist() == [IGNORE_INDEX, 32, 33, IGNORE_INDEX, 42, 43] + [IGNORE_INDEX] * 4
+    assert all(value.dtype == np.int64 for value in row.values())
+
+
+def test_store_arrays_are_widened():
+    # 预分词存储返回 uint32 的内存映射切片，取行时转成 int64
+    samples = [np.array([7, 8, 9], dtype=np.uint32), np.array([5, 6], dtype=np.uint32)]
+    row = PackedDataset(samples, 6, PAD)[0]
+    assert row["input_ids"].tolist() == [7, 8, 9, 5, 6, PAD]
+    assert row["labels"].dtype == np.int64
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+"""
+预分词的训练数据存储
+
+每次训练都要重新套聊天模板并分词整个数据集。这里由 prepare_dataset.py --tokenize
+提前做一次：每个划分存成一个扁平的 uint32 token 数组（tokens.bin，内存映射读取）、
+样本起止偏移（offsets.npy）和提示词/回复分界（boundaries.npy，回复第一个 token 的位置）。
+存储目录按 分词器内容哈希 + 模板版本 区分（与分词器名称无关：Qwen2.5 各尺寸共用同一分词器，
+默认用 1.5B 的分词器构建的存储同样供 7B 的 train_lora.py 使用），元数据里记录分词器名称、
+源文件的大小和修改时间，源数据变化后训练脚本会自动回退到现场分词。
+训练时 TokenDataset 直接返回内存映射切片（不复制），由 StoreCollator 在组批时转成 int64 并填充。
+聊天模板和数据读取在 chat_format.py 中，与训练脚本、scripts/dataset_profile.py 共用。
+
+用法：
+    python token_store.py --tokenizer Qwen/Qwen2.5-1.5B-Instruct --workers 8
+"""
+
+import hashlib
+import json
+import os
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Iterator, Optional
+
+import numpy as np
+
+from chat_format import TEMPLATE_VERSION, dataset_file, read_dataset, render
+
+# 配置
+BASE_DIR = Path(__file__).parent.parent
+STORE_ROOT = BASE_DIR / "data/processed/token_store"
+SPLIT_PATHS = {
+    "train": BASE_DIR / "data/processed/training_data.json",
+    "val": BASE_DIR / "data/processed/validation_data.json",
+}
+
+DEFAULT_TOKENIZER = "Qwen/Qwen2.5-1.5B-Instruct"
+CHUNK_SIZE = 256  # 每个工作进程一次处理的样本数
+
+
+def source_signature(path: Path) -> dict:
+    source = dataset_file(path)
+    stat = source.stat()
+    return {"path": str(source.resolve()), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def tokenizer_hash(tokenizer) -> str:
+    """分词器内容的哈希（词表、合并规则、特殊 token），同名但内容不同的分词器不会共用存储"""
+    digest = hashlib.sha256()
+    backend = getattr(tokenizer, "backend_tokenizer", None)
+    if backend is not None:
+        digest.update(backend.to_str().encode("utf-8"))
+    else:
+        digest.update(json.dumps(tokenizer.get_vocab(), sort_keys=True).encode("utf-8"))
+    digest.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def store_dir(tokenizer, root: Path = STORE_ROOT) -> Path:
+    """按分词器内容哈希定位存储，同一分词器的不同模型（如 Qwen2.5-1.5B / 7B）共用"""
+    return root / f"{tokenizer_hash(tokenizer)[:16]}-t{TEMPLATE_VERSION}"
+
+
+# 工作进程各自加载一次分词器
+_worker_tokenizer = None
+
+
+def _init_worker(tokenizer_name: str):
+    global _worker_tokenizer
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    from transformers import AutoTokenizer
+    _worker_tokenizer = AutoTokenizer.from_pretrained(tokenizer_name, trust_remote_code=True)
+
+
+def _encode_chunk(samples: list[dict]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """整段文本一起分词（与训练时一致），按字符偏移找到回复的起始 token"""
+    tokens, lengths, boundaries = [], [], []
+    for sample in samples:
+        prompt, response = render(sample)
+        encoding = _worker_tokenizer(prompt + response, return_offsets_mapping=True)
+        ids = encoding["input_ids"]
+        boundary = next(
+            (n for n, (start, _) in enumerate(encoding["offset_mapping"]) if start >= len(prompt)),
+            len(ids)
+        )
+        tokens.append(np.asarray(ids, dtype=np.uint32))
+        lengths.append(len(ids))
+        boundaries.append(boundary)
+    return (
+        np.concatenate(tokens) if tokens else np.zeros(0, dtype=np.uint32),
+        np.asarray(lengths, dtype=np.int64),
+        np.asarray(boundaries, dtype=np.uint32),
+    )
+
+
+def _chunks(path: Path, size: int) -> Iterator[list[dict]]:
+    """JSONL 逐行读取，JSON 整体读取后切块"""
+    source = dataset_file(path)
+    if source.suffix == ".jsonl":
+        chunk = []
+        with open(source, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    chunk.append(json.loads(line))
+                    if len(chunk) >= size:
+                        yield chunk
+                        chunk = []
+        if chunk:
+            yield chunk
+        return
+    data = read_dataset(path)
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+def build_store(
+    tokenizer_name: str = DEFAULT_TOKENIZER,
+    workers: Optional[int] = None,
+    splits: dict = SPLIT_PATHS,
+    root: Path = STORE_ROOT
+) -> Path:
+    """多进程分词全部划分，写入存储目录并返回目录路径"""
+    from transformers import AutoTokenizer
+    from tqdm import tqdm
+
+    tokenizer = AutoTokenizer.from_pretrained(tokenizer_name, trust_remote_code=True)
+    if not tokenizer.is_fast:
+        raise ValueError(f"{tokenizer_name} has no fast tokenizer (offset mapping is required)")
+    directory = store_dir(tokenizer, root)
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / "meta.json").unlink(missing_ok=True)
+    meta = {
+        "tokenizer": tokenizer_name,
+        "tokenizer_hash": tokenizer_hash(tokenizer),
+        "template_version": TEMPLATE_VERSION,
+        "splits": {},
+    }
+
+    workers = workers or os.cpu_count() or 1
+    with Pool(workers, initializer=_init_worker, initargs=(tokenizer_name,)) as pool:
+        for split, path in splits.items():
+            if not path.exists() and not path.with_suffix(".jsonl").exists():
+                continue
+            signature = source_signature(path)
+            offsets, boundaries = [np.zeros(1, dtype=np.int64)], []
+            total = 0
+            tmp_path = directory / f".{split}.tokens.bin.tmp"
+            with open(tmp_path, "wb") as f:
+                chunks = pool.imap(_encode_chunk, _chunks(path, CHUNK_SIZE))
+                for tokens, lengths, bounds in tqdm(chunks, desc=f"Tokenizing {split}"):
+                    tokens.tofile(f)
+                    offsets.append(total + np.cumsum(lengths))
+                    boundaries.append(bounds)
+                    total += int(lengths.sum())
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, directory / f"{split}.tokens.bin")
+            np.save(directory / f"{split}.offsets.npy", np.concatenate(offsets))
+            np.save(directory / f"{split}.boundaries.npy",
+                    np.concatenate(boundaries) if boundaries else np.zeros(0, dtype=np.uint32))
+            count = sum(len(b) for b in boundaries)
+            meta["splits"][split] = {"source": signature, "samples": count, "tokens": total}
+            print(f"{split}: {count} samples, {total} tokens")
+
+    # 元数据最后写入，存在即表示存储完整
+    with open(directory / "meta.json", "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+    return directory
+
+
+class TokenStore:
+    """一个划分的只读视图：token 数组内存映射，取样本只是切片，不复制不解析"""
+
+    def __init__(self, directory: Path, split: str):
+        self.directory = Path(directory)
+        self.split = split
+        tokens_path = self.directory / f"{split}.tokens.bin"
+        # 空文件无法内存映射
+        if tokens_path.stat().st_size:
+            self.tokens = np.memmap(tokens_path, dtype=np.uint32, mode="r")
+        else:
+            self.tokens = np.zeros(0, dtype=np.uint32)
+        self.offsets = np.load(self.directory / f"{split}.offsets.npy", mmap_mode="r")
+        self.boundaries = np.load(self.directory / f"{split}.boundaries.npy", mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    def boundary(self, i: int) -> int:
+        """回复第一个 token 在样本内的位置"""
+        return int(self.boundaries[i])
+
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+
+def open_store(
+    tokenizer,
+    splits: dict = SPLIT_PATHS,
+    root: Path = STORE_ROOT
+) -> Optional[dict]:
+    """返回 {split: TokenStore}；存储不存在、分词器/模板不匹配或源数据已变化时返回 None"""
+    directory = store_dir(tokenizer, root)
+    meta_path = directory / "meta.json"
+    if not meta_path.exists():
+        return None
+    with open(meta_path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    stores = {}
+    for split, path in splits.items():
+        info = meta["splits"].get(split)
+        if info is None or info["source"] != source_signature(path):
+            print(f"Warning: Token store {directory.name} is stale for {split}, re-tokenizing")
+            return None
+        stores[split] = TokenStore(directory, split)
+    return stores
+
+
+class TokenDataset:
+    """训练用的 torch 风格数据集：返回截断到 max_length 的内存映射切片（uint32，不复制），
+    配合 StoreCollator 使用"""
+
+    def __init__(self, store: TokenStore, max_length: int):
+        self.store = store
+        self.max_length = max_length
+
+    def __len__(self) -> int:
+        return len(self.store)
+
+    def __getitem__(self, i: int) -> dict:
+        return {"input_ids": self.store[i][:self.max_length]}
+
+    def lengths(self) -> np.ndarray:
+        return np.minimum(self.store.lengths(), self.max_length)
+
+
+class StoreCollator:
+    """把一批 TokenDataset 样本转成 int64 张量并填充；pad_to 为 None 时只填充到批内最长
+    （向上取 pad_to_multiple_of 的倍数）。填充位置的 label 为 -100"""
+
+    def __init__(self, pad_token_id: int, pad_to: Optional[int] = None, pad_to_multiple_of: Optional[int] = None):
+        import torch
+        self.torch = torch
+        self.pad_token_id = pad_token_id
+        self.pad_to = pad_to
+        self.pad_to_multiple_of = pad_to_multiple_of
+
+    def __call__(self, features: list[dict]) -> dict:
+        lengths = [len(f["input_ids"]) for f in features]
+        width = self.pad_to or max(lengths)
+        if self.pad_to_multiple_of:
+            width = -(-width // self.pad_to_multiple_of) * self.pad_to_multiple_of
+        ids = np.full((len(features), width), self.pad_token_id, dtype=np.int64)
+        mask = np.zeros_like(ids)
+        for n, (feature, length) in enumerate(zip(features, lengths)):
+            ids[n, :length] = feature["input_ids"]
+            mask[n, :length] = 1
+        return {
+            "input_ids": self.torch.from_numpy(ids),
+            "attention_mask": self.torch.from_numpy(mask),
+            "labels": self.torch.from_numpy(np.where(mask == 1, ids, -100)),
+        }
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="为训练/验证集构建预分词存储")
+    parser.add_argument("--tokenizer", default=DEFAULT_TOKENIZER, help="分词器名称或本地路径")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="分词进程数")
+    args = parser.parse_args()
+
+    if not SPLIT_PATHS["train"].exists() and not SPLIT_PATHS["train"].with_suffix(".jsonl").exists():
+        print(f"Error: Training data not found: {SPLIT_PATHS['train']}")
+        print("Please run prepare_dataset.py first")
+        return
+    try:
+        directory = build_store(args.tokenizer, args.workers)
+    except ImportError:
+        print("Error: transformers is required to build the token store")
+        print("Please install training dependencies: pip install -r requirements.txt")
+        raise SystemExit(1)
+    print(f"Token store saved to: {directory}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,6 @@ LoRA 微调脚本 (使用 Unsloth)
 在 Mac M系列或 NVIDIA GPU 上微调 Qwen2.5-7B
 """
 
-import json
 import torch
 from pathlib import Path
 from datasets import Dataset
@@ -13,6 +12,9 @@ from unsloth import FastLanguageModel
 from trl import SFTTrainer
 from transformers import TrainingArguments
 
+from chat_format import format_prompt, read_dataset
+from token_store import StoreCollator, TokenDataset, open_store
+
 # 配置
 BASE_DIR = Path(__file__).parent.parent
 TRAIN_DATA_PATH = BASE_DIR / "data/processed/training_data.json"
@@ -31,23 +33,7 @@ LORA_DROPOUT = 0.05
 
 def load_data():
     """加载训练数据"""
-    with open(TRAIN_DATA_PATH, 'r', encoding='utf-8') as f:
-        train_data = json.load(f)
-    
-    with open(VAL_DATA_PATH, 'r', encoding='utf-8') as f:
-        val_data = json.load(f)
-    
-    return train_data, val_data
-
-
-def format_prompt(sample):
-    """格式化为模型输入格式"""
-    return f"""<|im_start|>system
-你是 NanoBananaPro 提示词生成专家。根据用户的简单描述，生成高质量的图像生成提示词。<|im_end|>
-<|im_start|>user
-{sample['instruction']}<|im_end|>
-<|im_start|>assistant
-{sample['output']}<|im_end|>"""
+    return read_dataset(TRAIN_DATA_PATH), read_dataset(VAL_DATA_PATH)
 
 
 def main():
@@ -56,23 +42,13 @@ def main():
     print("=" * 50)
     
     # 检查数据
-    if not TRAIN_DATA_PATH.exists():
+    if not TRAIN_DATA_PATH.exists() and not TRAIN_DATA_PATH.with_suffix(".jsonl").exists():
         print(f"Error: Training data not found: {TRAIN_DATA_PATH}")
         print("Please run data preparation scripts first")
         return
     
-    # 加载数据
-    print("\n[1/5] Loading data...")
-    train_data, val_data = load_data()
-    print(f"Training samples: {len(train_data)}")
-    print(f"Validation samples: {len(val_data)}")
-    
-    # 转换为 Dataset
-    train_dataset = Dataset.from_list(train_data)
-    val_dataset = Dataset.from_list(val_data)
-    
     # 加载模型
-    print("\n[2/5] Loading model...")
+    print("\n[1/5] Loading model...")
     model, tokenizer = FastLanguageModel.from_pretrained(
         model_name=MODEL_NAME,
         max_seq_length=MAX_SEQ_LENGTH,
@@ -80,6 +56,26 @@ def main():
         load_in_4bit=True,  # 4-bit 量化节省显存
     )
     
+    # 加载数据（有匹配的预分词存储时直接内存映射读取，SFTTrainer 不再格式化和分词；
+    # 存储按分词器内容定位，prepare_dataset.py --tokenize 默认的 1.5B 分词器与 7B 相同，可直接共用）
+    print("\n[2/5] Loading data...")
+    stores = open_store(tokenizer)
+    if stores:
+        print(f"Using token store: {stores['train'].directory}")
+        train_dataset = TokenDataset(stores["train"], MAX_SEQ_LENGTH)
+        val_dataset = TokenDataset(stores["val"], MAX_SEQ_LENGTH)
+        data_kwargs = dict(
+            dataset_kwargs={"skip_prepare_dataset": True},
+            data_collator=StoreCollator(tokenizer.pad_token_id),
+        )
+    else:
+        train_data, val_data = load_data()
+        train_dataset = Dataset.from_list(train_data)
+        val_dataset = Dataset.from_list(val_data)
+        data_kwargs = dict(formatting_func=format_prompt)
+    print(f"Training samples: {len(train_dataset)}")
+    print(f"Validation samples: {len(val_dataset)}")
+    
     # 添加 LoRA 适配器
     print("\n[3/5] Adding LoRA adapter...")
     model = FastLanguageModel.get_peft_model(
@@ -125,8 +121,8 @@ def main():
         train_dataset=train_dataset,
         eval_dataset=val_dataset,
         args=training_args,
-        formatting_func=format_prompt,
         max_seq_length=MAX_SEQ_LENGTH,
+        **data_kwargs,
     )
     
     # 开始训练
@@ -4,9 +4,13 @@ LoRA 微调脚本 (Mac MPS 版本)
 
 使用 PEFT + Transformers 在 Mac M系列上微调
 适用于较小的模型如 Qwen2.5-1.5B 或 Qwen2.5-3B
+
+默认动态填充：按长度分组组批（每个 epoch 重新打乱），每批只填充到批内最长；
+--padding max_length 恢复固定填充到 MAX_SEQ_LENGTH。
+--packing 把多条样本拼进一行训练（见 seq_packing.py），--benchmark N 在 CPU 上对比三种方式的吞吐。
+训练日志里的 padding_efficiency 是最近一个日志区间内有效 token 占实际计算 token 的比例。
 """
 
-import json
 import torch
 from pathlib import Path
 from datasets import Dataset
@@ -19,6 +23,12 @@ from transformers import (
 )
 from peft import LoraConfig, get_peft_model, TaskType
 
+from chat_format import format_prompt, read_dataset
+from seq_packing import (
+    ISOLATION_TOLERANCE, PackedCollator, PackedDataset, PaddingStats, benchmark, isolation_error, isolation_report,
+)
+from token_store import StoreCollator, TokenDataset, open_store
+
 # 配置
 BASE_DIR = Path(__file__).parent.parent
 TRAIN_DATA_PATH = BASE_DIR / "data/processed/training_data.json"
@@ -28,6 +38,8 @@ OUTPUT_DIR = BASE_DIR / "models/lora_adapter"
 # 模型配置 - 使用 1.5B 加速训练
 MODEL_NAME = "Qwen/Qwen2.5-1.5B-Instruct"  # 更快的训练速度
 MAX_SEQ_LENGTH = 512  # 减少序列长度加速
+BATCH_SIZE = 2
+PAD_TO_MULTIPLE_OF = 8  # 动态填充时批宽度取 8 的倍数，对齐矩阵运算
 
 # LoRA 配置
 LORA_CONFIG = LoraConfig(
@@ -42,27 +54,11 @@ LORA_CONFIG = LoraConfig(
 
 def load_data():
     """加载训练数据"""
-    with open(TRAIN_DATA_PATH, 'r', encoding='utf-8') as f:
-        train_data = json.load(f)
-    
-    with open(VAL_DATA_PATH, 'r', encoding='utf-8') as f:
-        val_data = json.load(f)
-    
-    return train_data, val_data
-
+    return read_dataset(TRAIN_DATA_PATH), read_dataset(VAL_DATA_PATH)
 
-def format_prompt(sample):
-    """格式化为 Qwen 聊天模板"""
-    return f"""<|im_start|>system
-你是 NanoBananaPro 提示词生成专家。根据用户的简单描述，生成高质量的图像生成提示词。<|im_end|>
-<|im_start|>user
-{sample['instruction']}<|im_end|>
-<|im_start|>assistant
-{sample['output']}<|im_end|>"""
 
-
-def tokenize_function(examples, tokenizer):
-    """Tokenize 数据"""
+def tokenize_function(examples, tokenizer, padding="max_length"):
+    """Tokenize 数据；动态填充时不填充，记录长度供按长度分组组批"""
     texts = [format_prompt({"instruction": inst, "output": out}) 
              for inst, out in zip(examples['instruction'], examples['output'])]
     
@@ -70,13 +66,65 @@ def tokenize_function(examples, tokenizer):
         texts,
         truncation=True,
         max_length=MAX_SEQ_LENGTH,
-        padding="max_length",
+        padding=padding,
     )
-    result["labels"] = result["input_ids"].copy()
+    if padding == "max_length":
+        result["labels"] = result["input_ids"].copy()
+    else:
+        # 长短不一的 labels 无法堆叠，交给数据整理器按填充后的 input_ids 生成
+        result["length"] = [len(ids) for ids in result["input_ids"]]
     return result
 
 
+def load_token_ids(stores, tokenizer) -> tuple:
+    """不填充的 token 序列（打包和基准测试用）；有预分词存储时直接返回存储本身，按需取内存映射切片"""
+    if stores:
+        return stores["train"], stores["val"]
+    train_data, val_data = load_data()
+    return tuple(
+        tokenizer([format_prompt(s) for s in data], truncation=True, max_length=MAX_SEQ_LENGTH)["input_ids"]
+        for data in (train_data, val_data)
+    )
+
+
+def load_lora_model(device, dtype):
+    model = AutoModelForCausalLM.from_pretrained(
+        MODEL_NAME,
+        torch_dtype=dtype,
+        trust_remote_code=True,
+    )
+    # 训练不需要 KV 缓存；打包时有缓存会让 transformers 跳过按 position_ids 构造的块对角掩码
+    model.config.use_cache = False
+    model = model.to(device)
+    print("Adding LoRA adapter...")
+    model = get_peft_model(model, LORA_CONFIG)
+    model.print_trainable_parameters()
+    return model
+
+
+class PaddingStatsTrainer(Trainer):
+    """训练日志附带 padding_efficiency（数据整理器为 PaddingStats）"""
+
+    def log(self, logs, *args, **kwargs):
+        efficiency = self.data_collator.take()
+        # 评估日志的区间里混有验证批次，只在训练日志中报告
+        if efficiency is not None and "loss" in logs:
+            logs["padding_efficiency"] = round(efficiency, 4)
+        super().log(logs, *args, **kwargs)
+
+
 def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="LoRA 微调 (Mac MPS / CPU)")
+    parser.add_argument("--padding", choices=["dynamic", "max_length"], default="dynamic",
+                        help="dynamic 按长度分组组批、只填充到批内最长；max_length 每条填充到 MAX_SEQ_LENGTH")
+    parser.add_argument("--packing", action="store_true",
+                        help="序列打包：多条样本拼成满长度的行，position_ids 分段重置，样本间互不可见")
+    parser.add_argument("--benchmark", type=int, metavar="STEPS",
+                        help="不训练，在 CPU 上各跑 STEPS 步，对比固定填充、动态填充和打包的有效 token/s")
+    args = parser.parse_args()
+    dynamic = args.padding == "dynamic" and not args.packing
+    
     print("=" * 50)
     print("NanoBananaPro LoRA Training (Mac MPS)")
     print("=" * 50)
@@ -90,59 +138,75 @@ def main():
         print(f"Using device: CPU")
     
     # 检查数据
-    if not TRAIN_DATA_PATH.exists():
+    if not TRAIN_DATA_PATH.exists() and not TRAIN_DATA_PATH.with_suffix(".jsonl").exists():
         print(f"Error: Training data not found: {TRAIN_DATA_PATH}")
         return
     
-    # 加载数据
-    print("\n[1/5] Loading data...")
-    train_data, val_data = load_data()
-    print(f"Training samples: {len(train_data)}")
-    print(f"Validation samples: {len(val_data)}")
-    
-    # 转换为 Dataset
-    train_dataset = Dataset.from_list(train_data)
-    val_dataset = Dataset.from_list(val_data)
-    
     # 加载 tokenizer
-    print("\n[2/5] Loading tokenizer...")
+    print("\n[1/5] Loading tokenizer...")
     tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, trust_remote_code=True)
     if tokenizer.pad_token is None:
         tokenizer.pad_token = tokenizer.eos_token
     
-    # Tokenize 数据
-    print("\n[3/5] Tokenizing data...")
-    train_dataset = train_dataset.map(
-        lambda x: tokenize_function(x, tokenizer),
-        batched=True,
-        remove_columns=train_dataset.column_names
-    )
-    val_dataset = val_dataset.map(
-        lambda x: tokenize_function(x, tokenizer),
-        batched=True,
-        remove_columns=val_dataset.column_names
-    )
+    # 加载数据（有匹配的预分词存储时直接内存映射读取，跳过分词）
+    print("\n[2/5] Loading data...")
+    stores = open_store(tokenizer)
+    if args.benchmark:
+        train_ids, _ = load_token_ids(stores, tokenizer)
+        print(f"\nBenchmarking on CPU ({args.benchmark} steps each, batch size {BATCH_SIZE})...")
+        model = load_lora_model(torch.device("cpu"), torch.float32)
+        print(benchmark(model, train_ids, BATCH_SIZE, MAX_SEQ_LENGTH, tokenizer.pad_token_id, args.benchmark))
+        return
+    if args.packing:
+        print("\n[3/5] Packing samples...")
+        train_ids, val_ids = load_token_ids(stores, tokenizer)
+        train_dataset = PackedDataset(train_ids, MAX_SEQ_LENGTH, tokenizer.pad_token_id)
+        val_dataset = PackedDataset(val_ids, MAX_SEQ_LENGTH, tokenizer.pad_token_id)
+        print(train_dataset.summary())
+        # 隔离检查用 CPU 上的 fp32 模型，舍入误差远小于串样本时的差异（见 seq_packing.ISOLATION_TOLERANCE）
+        print("Checking packing isolation on CPU (fp32)...")
+        check_model = load_lora_model(torch.device("cpu"), torch.float32)
+        error = isolation_error(check_model, train_dataset)
+        del check_model
+        print(isolation_report(error))
+        if error > ISOLATION_TOLERANCE:
+            print("Error: packed samples attend to each other (requires transformers >= 4.54 and use_cache=False)")
+            return
+    elif stores:
+        print(f"\n[3/5] Using token store: {stores['train'].directory}")
+        train_dataset = TokenDataset(stores["train"], MAX_SEQ_LENGTH)
+        val_dataset = TokenDataset(stores["val"], MAX_SEQ_LENGTH)
+    else:
+        train_data, val_data = load_data()
+        train_dataset = Dataset.from_list(train_data)
+        val_dataset = Dataset.from_list(val_data)
+        
+        # Tokenize 数据
+        print("\n[3/5] Tokenizing data...")
+        padding = False if dynamic else "max_length"
+        train_dataset = train_dataset.map(
+            lambda x: tokenize_function(x, tokenizer, padding),
+            batched=True,
+            remove_columns=train_dataset.column_names
+        )
+        val_dataset = val_dataset.map(
+            lambda x: tokenize_function(x, tokenizer, padding),
+            batched=True,
+            remove_columns=val_dataset.column_names
+        )
+    print(f"Training {'rows' if args.packing else 'samples'}: {len(train_dataset)}")
+    print(f"Validation {'rows' if args.packing else 'samples'}: {len(val_dataset)}")
     
-    # 加载模型
+    # 加载模型并添加 LoRA
     print("\n[4/5] Loading model...")
-    model = AutoModelForCausalLM.from_pretrained(
-        MODEL_NAME,
-        torch_dtype=torch.float16,
-        trust_remote_code=True,
-    )
-    # 移动到 MPS 设备
-    model = model.to(device)
-    
-    # 添加 LoRA
-    print("Adding LoRA adapter...")
-    model = get_peft_model(model, LORA_CONFIG)
-    model.print_trainable_parameters()
+    model = load_lora_model(device, torch.float16)
     
     # 训练参数 - 针对 M3 Pro 36GB 优化
     training_args = TrainingArguments(
         output_dir=str(OUTPUT_DIR),
         num_train_epochs=1,  # 减少到 1 个 epoch 快速验证
-        per_device_train_batch_size=2,  # 1.5B 可以用更大 batch
+        per_device_train_batch_size=BATCH_SIZE,  # 1.5B 可以用更大 batch
+        group_by_length=dynamic,  # 长度相近的样本组成一批，每个 epoch 重新随机分组
         gradient_accumulation_steps=4,
         learning_rate=2e-4,
         lr_scheduler_type="cosine",
@@ -163,14 +227,26 @@ def main():
         use_cpu=False,
     )
     
-    # 数据整理器
-    data_collator = DataCollatorForLanguageModeling(
-        tokenizer=tokenizer,
-        mlm=False,
-    )
+    # 数据整理器（打包模式不输出 attention_mask，由 position_ids 标出样本边界；
+    # 动态填充时填充到批内最长，填充位置的 label 为 -100；预分词存储的样本在这里才转成 int64 并填充）
+    if args.packing:
+        data_collator = PackedCollator()
+    elif stores:
+        data_collator = StoreCollator(
+            tokenizer.pad_token_id,
+            pad_to=None if dynamic else MAX_SEQ_LENGTH,
+            pad_to_multiple_of=PAD_TO_MULTIPLE_OF if dynamic else None,
+        )
+    else:
+        data_collator = DataCollatorForLanguageModeling(
+            tokenizer=tokenizer,
+            mlm=False,
+            pad_to_multiple_of=PAD_TO_MULTIPLE_OF if dynamic else None,
+        )
+    data_collator = PaddingStats(data_collator, tokenizer.pad_token_id)
     
     # 创建训练器
-    trainer = Trainer(
+    trainer = PaddingStatsTrainer(
         model=model,
         args=training_args,
         train_dataset=train_dataset,
@@ -190,6 +266,7 @@ def main():
     print("\n[5/5] Starting training...")
     print("-" * 50)
     trainer.train(resume_from_checkpoint=resume_from)
+    print(data_collator.summary())
     
     # 保存模型
     print("\n[Done] Saving model...")